@@ -0,0 +1,565 @@
+# Acquisition engine for StellarNet spectrometers
+# The spectrometer is owned by a separate process which acquires continuously and
+# writes every frame into a fixed size shared memory ring buffer.  The GUI and any
+# other consumer read the latest frame from shared memory and never wait on USB.
+
+import time
+import signal
+import multiprocessing as mp
+from functools import partial
+from multiprocessing import shared_memory, resource_tracker
+from collections import namedtuple
+
+import numpy as np
+
+# one acquired spectrum; ydata is a view into the ring buffer, copy it if it must outlive the next few frames
+Frame = namedtuple('Frame', ['seq', 'timestamp', 'int_time', 'averages', 'ydata'])
+
+
+## start StellarNet device functions (these run inside the acquisition process)
+def load_driver(driver='stellarnet'):
+    """Driver module by name: 'stellarnet' (the StellarNet driver) or 'simulated' (no hardware needed)."""
+    if driver == 'stellarnet':
+        from stellarnet_driverLibs import stellarnet_driver3 as sn
+    elif driver == 'simulated':
+        import simulated_driver as sn
+    else:
+        raise ValueError("Unknown spectrometer driver " + repr(driver))
+    return sn
+
+
+def open_spectrometer(index=0, driver='stellarnet'):
+    """Open spectrometer number *index*, returns (driver module, spectrometer)."""
+    sn = load_driver(driver)
+    spectrometer = sn.array_get_spec_only(index)
+    return sn, spectrometer
+## end StellarNet device functions
+
+
+class FrameRing:
+    """
+    Fixed size ring of spectra in shared memory.
+
+    Layout of the block (all 8 byte values):
+        head  : int64[1]                sequence number of the newest complete frame (0 = none yet)
+        seqs  : int64[nslots]           sequence number held by each slot (-1 while being written)
+        meta  : float64[nslots, 3]      timestamp, integration time (ms), averages
+        data  : float64[nslots, npix]   the spectra
+
+    There is one writer (the acquisition process); readers check ``is_valid(seq)``
+    after using a view to find out whether the writer lapped them meanwhile.
+    """
+
+    def __init__(self, npix, nslots=8, name=None):
+        self.npix = npix
+        self.nslots = nslots
+        size = 8 * (1 + nslots + 3 * nslots + nslots * npix)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        buf = self.shm.buf
+        offset = 0
+        self.head = np.ndarray((1,), dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8
+        self.seqs = np.ndarray((nslots,), dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * nslots
+        self.meta = np.ndarray((nslots, 3), dtype=np.float64, buffer=buf, offset=offset)
+        offset += 8 * 3 * nslots
+        self.data = np.ndarray((nslots, npix), dtype=np.float64, buffer=buf, offset=offset)
+        if self.owner:
+            self.head[0] = 0
+            self.seqs[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, ydata, timestamp, int_time, averages):
+        """Store a new frame (writer side only), returns its sequence number."""
+        seq, slot = self.begin_write()
+        slot[:] = ydata
+        self.commit(seq, timestamp, int_time, averages)
+        return seq
+
+    def begin_write(self):
+        """Claim the next slot for filling in place (writer side only), returns (seq, slot array)."""
+        seq = int(self.head[0]) + 1
+        slot = seq % self.nslots
+        self.seqs[slot] = -1  # readers of the old frame in this slot now see it as invalid
+        return seq, self.data[slot]
+
+    def commit(self, seq, timestamp, int_time, averages):
+        slot = seq % self.nslots
+        self.meta[slot, 0] = timestamp
+        self.meta[slot, 1] = int_time
+        self.meta[slot, 2] = averages
+        self.seqs[slot] = seq
+        self.head[0] = seq
+
+    def latest_seq(self):
+        return int(self.head[0])
+
+    def frame(self, seq):
+        """Frame *seq* as a view into shared memory, or None if it is not (or no longer) held."""
+        slot = seq % self.nslots
+        if seq <= 0 or self.seqs[slot] != seq:
+            return None
+        timestamp, int_time, averages = self.meta[slot]
+        return Frame(seq, timestamp, int(int_time), int(averages), self.data[slot])
+
+    def latest(self):
+        return self.frame(self.latest_seq())
+
+    def closest(self, timestamp):
+        """The held frame acquired closest to *timestamp*, or None if the ring is empty."""
+        held = self.seqs > 0
+        if not held.any():
+            return None
+        slot = int(np.argmin(np.where(held, np.abs(self.meta[:, 0] - timestamp), np.inf)))
+        return self.frame(int(self.seqs[slot]))
+
+    def is_valid(self, seq):
+        return seq > 0 and self.seqs[seq % self.nslots] == seq
+
+    def read(self, seq, out):
+        """Frame *seq* copied into *out* (its ydata), or None if it was overwritten before or during the copy."""
+        if not self.is_valid(seq):
+            return None
+        slot = seq % self.nslots
+        timestamp, int_time, averages = self.meta[slot]
+        np.copyto(out, self.data[slot])
+        if not self.is_valid(seq):
+            return None
+        return Frame(seq, timestamp, int(int_time), int(averages), out)
+
+    def close(self):
+        # the numpy views hold exported pointers into the block and must go before close()
+        del self.head, self.seqs, self.meta, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _acquire_loop(conn, open_device, int_time, averages, nslots):
+    """Body of the acquisition process."""
+    # Ctrl-C is for the GUI/server, which stops this process through the pipe
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        sn, spectrometer = open_device()
+        wavelengths = np.asarray(sn.getSpectrum_X(spectrometer), dtype=float)
+        # below parameters are (spectrometer, IntTime, Averages, smoothing=0, xtiming=1, True=throw out first data to get settings in place)
+        sn.setParam(spectrometer, int_time, averages, 0, 1, True)
+        config = spectrometer['device'].get_config()
+    except Exception as err:
+        conn.send(('error', "No spectrometer attached (" + str(err) + ")"))
+        conn.close()
+        return
+    int_time = config['int_time']
+    averages = config['scans_to_avg']
+    conn.send(('ready', {'wavelengths': wavelengths, 'model': config['model'],
+                         'int_time': int_time, 'averages': averages}))
+    msg = conn.recv()
+    if msg[0] != 'ring':
+        return
+    ring = FrameRing(len(wavelengths), nslots, name=msg[1])
+    try:
+        while True:
+            # commands are handled between acquisitions, the driver is not thread safe
+            while conn.poll():
+                msg = conn.recv()
+                if msg[0] == 'stop':
+                    return
+                elif msg[0] == 'config':
+                    spectrometer['device'].set_config(int_time=msg[1], scans_to_avg=msg[2])
+                    # read back new configuration from spectrometer to verify new settings
+                    config = spectrometer['device'].get_config()
+                    int_time = config['int_time']
+                    averages = config['scans_to_avg']
+                    conn.send(('config', int_time, averages))
+            ydata = sn.getSpectrum_Y(spectrometer)
+            ring.write(ydata, time.time(), int_time, averages)
+    except (EOFError, OSError):
+        pass  # the GUI side went away
+    except Exception as err:
+        conn.send(('error', str(err)))
+    finally:
+        ring.close()
+
+
+class AcquisitionEngine:
+    """
+    Runs the spectrometer in its own process and publishes frames in a FrameRing.
+
+    Parameters
+    ----------
+    open_device : callable
+        Module level function returning (driver module, spectrometer); it is
+        called inside the acquisition process, which then owns the USB handle.
+    int_time, averages : int
+        Initial integration time (ms) and number of scans to average.
+    nslots : int
+        Number of frames held in the ring buffer.
+    """
+
+    def __init__(self, open_device=open_spectrometer, int_time=20, averages=1, nslots=32):
+        self.open_device = open_device
+        self.int_time = int_time
+        self.averages = averages
+        self.nslots = nslots
+        self.ring = None
+        self.process = None
+        self.error = None
+        self.wavelengths = None
+        self.model = ''
+
+    def start(self, timeout=30):
+        """Start the acquisition process; raises RuntimeError if no spectrometer could be opened."""
+        self.launch()
+        if not self.connect(timeout):
+            self.stop()
+            raise RuntimeError("Spectrometer did not respond")
+
+    def launch(self):
+        """Start the acquisition process without waiting for the spectrometer, see connect()."""
+        # the acquisition process must share our resource tracker, or its own tracker would
+        # unlink the ring buffer when the process exits
+        resource_tracker.ensure_running()
+        self.conn, child_conn = mp.Pipe()
+        self.process = mp.Process(target=_acquire_loop, daemon=True,
+                                  args=(child_conn, self.open_device, self.int_time, self.averages, self.nslots))
+        self.process.start()
+        child_conn.close()
+
+    def connect(self, timeout=0):
+        """True once the spectrometer is open and frames are on their way, False if it is not ready yet.
+
+        Raises RuntimeError if the spectrometer could not be opened."""
+        if self.ring is not None:
+            return True
+        if not self.conn.poll(timeout):
+            return False
+        msg = self.conn.recv()
+        if msg[0] == 'error':
+            self.stop()
+            raise RuntimeError(msg[1])
+        info = msg[1]
+        self.wavelengths = info['wavelengths']
+        self.model = info['model']
+        self.int_time = info['int_time']
+        self.averages = info['averages']
+        self.ring = FrameRing(len(self.wavelengths), self.nslots)
+        self.conn.send(('ring', self.ring.name))
+        return True
+
+    def latest(self):
+        """Newest frame (a view into shared memory) or None before the first frame arrives."""
+        return self.ring.latest()
+
+    def latest_seq(self):
+        return self.ring.latest_seq()
+
+    def frame(self, seq):
+        """Frame *seq* if the ring still holds it, else None."""
+        return self.ring.frame(seq)
+
+    def read(self, seq, out):
+        """Frame *seq* copied into *out*, or None if it is no longer held (see FrameRing.read)."""
+        return self.ring.read(seq, out)
+
+    def wait_frame(self, min_seq, timeout=None):
+        """Block until a frame with sequence number >= *min_seq* is available and return it."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            seq = self.ring.latest_seq()
+            if seq >= min_seq:
+                frame = self.ring.frame(seq)
+                if frame is not None:
+                    return frame
+            if self.error is not None or not self.process.is_alive():
+                raise RuntimeError(self.error or "Acquisition process stopped")
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            self.poll()
+            time.sleep(0.002)
+
+    def set_config(self, int_time, averages):
+        """Ask for new settings; they are applied between acquisitions and confirmed through poll()."""
+        self.conn.send(('config', int_time, averages))
+
+    def poll(self):
+        """Handle replies from the acquisition process; returns True when the configuration was read back."""
+        changed = False
+        try:
+            while self.conn.poll():
+                msg = self.conn.recv()
+                if msg[0] == 'config':
+                    self.int_time = msg[1]
+                    self.averages = msg[2]
+                    changed = True
+                elif msg[0] == 'error':
+                    self.error = msg[1]
+        except (EOFError, OSError):
+            if self.error is None:
+                self.error = "Acquisition process stopped"
+        return changed
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.conn.send(('stop',))
+            except (OSError, ValueError):
+                pass
+            self.process.join(2)  # a long integration may be in progress
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+            self.conn.close()
+            self.process = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+class MultiAcquisition:
+    """
+    All attached spectrometers, each acquiring concurrently in its own AcquisitionEngine.
+
+    Frames from the devices are combined into one stitched spectrum over the
+    joint wavelength range; where two devices overlap, each contributes the half
+    of the overlap nearest its own range.  Combined frames are kept in a local
+    FrameRing, so this class offers the same frame interface as a single engine.
+    With one device it simply passes that engine's frames through.
+
+    With *align* the spectra of a combined frame are the ones acquired closest in
+    time to the newest frame of the slowest device, so a combined frame is a
+    consistent snapshot; otherwise each device's newest frame is used.  The
+    integration time and averages of a combined frame are those of the device it
+    was aligned to.
+    """
+
+    def __init__(self, engines, align=True, nslots=32):
+        self.engines = sorted(engines, key=lambda engine: engine.wavelengths[0])  # index order follows wavelength
+        self.align = align
+        self.model = " + ".join(engine.model for engine in self.engines)
+        self.error = None
+        self.single = len(self.engines) == 1
+        if self.single:
+            self.ring = self.engines[0].ring
+            self.wavelengths = self.engines[0].wavelengths
+            return
+        # pixel range each device contributes to the stitched spectrum
+        self.slices = []
+        for i, engine in enumerate(self.engines):
+            wl = engine.wavelengths
+            lo, hi = -np.inf, np.inf
+            if i > 0:
+                lower = self.engines[i - 1].wavelengths
+                lo = (wl[0] + lower[-1]) / 2 if lower[-1] >= wl[0] else wl[0]
+            if i < len(self.engines) - 1:
+                upper = self.engines[i + 1].wavelengths
+                hi = (upper[0] + wl[-1]) / 2 if wl[-1] >= upper[0] else np.inf
+            self.slices.append((int(np.searchsorted(wl, lo, side='left')), int(np.searchsorted(wl, hi, side='left'))))
+        self.wavelengths = np.concatenate([engine.wavelengths[i0:i1] for engine, (i0, i1) in zip(self.engines, self.slices)])
+        self.ring = FrameRing(len(self.wavelengths), nslots)
+        self.sources = None  # sequence numbers of the device frames in the newest combined frame
+
+    @property
+    def int_time(self):
+        return self.engines[0].int_time
+
+    @property
+    def averages(self):
+        return self.engines[0].averages
+
+    def _combine(self, frames=None):
+        """Write a combined frame into the ring if any device has produced a new one."""
+        if frames is None:
+            newest = [engine.latest() for engine in self.engines]
+            if any(frame is None for frame in newest):
+                return  # every device has to deliver once first
+            if self.align:
+                reference = min(newest, key=lambda frame: frame.timestamp)
+                frames = [engine.ring.closest(reference.timestamp) or frame for engine, frame in zip(self.engines, newest)]
+            else:
+                reference = max(newest, key=lambda frame: frame.timestamp)
+                frames = newest
+        else:
+            reference = min(frames, key=lambda frame: frame.timestamp)
+        sources = [frame.seq for frame in frames]
+        if sources == self.sources:
+            return
+        seq, slot = self.ring.begin_write()
+        start = 0
+        for frame, (i0, i1) in zip(frames, self.slices):
+            np.copyto(slot[start:start + i1 - i0], frame.ydata[i0:i1])
+            start += i1 - i0
+        self.ring.commit(seq, reference.timestamp, reference.int_time, reference.averages)
+        self.sources = sources
+
+    def latest(self):
+        if not self.single:
+            self._combine()
+        return self.ring.latest()
+
+    def latest_seq(self):
+        if not self.single:
+            self._combine()
+        return self.ring.latest_seq()
+
+    def frame(self, seq):
+        return self.ring.frame(seq)
+
+    def read(self, seq, out):
+        return self.ring.read(seq, out)
+
+    def wait_frame(self, min_seq, timeout=None):
+        if self.single:
+            return self.engines[0].wait_frame(min_seq, timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            frame = self.latest()
+            if frame is not None and frame.seq >= min_seq:
+                return frame
+            self.poll()
+            if self.error is not None:
+                raise RuntimeError(self.error)
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(0.002)
+
+    def set_config(self, int_time, averages, device=0):
+        self.engines[device].set_config(int_time, averages)
+
+    def poll(self):
+        changed = False
+        for engine in self.engines:
+            changed = engine.poll() or changed
+            if engine.error is not None:
+                self.error = engine.model + ": " + engine.error
+        return changed
+
+    def stop(self):
+        for engine in self.engines:
+            engine.stop()
+        if not self.single and self.ring is not None:
+            self.ring.close()
+        self.ring = None
+
+
+class AcquisitionStartup:
+    """
+    Non-blocking version of start_acquisition() for the GUI: spectrometers are
+    opened one after the other in their acquisition processes while the caller
+    keeps running; call poll() until it returns the MultiAcquisition.
+    """
+
+    def __init__(self, driver='stellarnet', int_time=20, averages=1, max_devices=4, align=True, timeout=30):
+        self.driver = driver
+        self.int_time = int_time
+        self.averages = averages
+        self.max_devices = max_devices
+        self.align = align
+        self.timeout = timeout  # seconds a spectrometer may take to open
+        self.engines = []
+        self.pending = None
+        self.result = None
+
+    def poll(self, timeout=0):
+        """MultiAcquisition when every spectrometer is open, None while still connecting; RuntimeError if there is none."""
+        if self.result is not None:
+            return self.result
+        if self.pending is None:
+            self.pending = AcquisitionEngine(partial(open_spectrometer, len(self.engines), self.driver),
+                                             int_time=self.int_time, averages=self.averages)
+            self.pending.launch()
+            self.deadline = time.monotonic() + self.timeout
+        try:
+            if not self.pending.connect(timeout):
+                if time.monotonic() < self.deadline:
+                    return None
+                self.pending.stop()
+                raise RuntimeError("Spectrometer did not respond")
+            self.engines.append(self.pending)
+            done = len(self.engines) == self.max_devices
+        except RuntimeError:
+            done = True  # no spectrometer with this index, enumeration is done
+        self.pending = None
+        if not done:
+            return None
+        if not self.engines:
+            raise RuntimeError("No spectrometer attached")
+        self.result = MultiAcquisition(self.engines, align=self.align)
+        return self.result
+
+    def stop(self):
+        """Stop whatever has been started, e.g. when the program quits while still connecting."""
+        if self.result is not None:
+            self.result.stop()
+            return
+        if self.pending is not None:
+            self.pending.stop()
+            self.pending = None
+        for engine in self.engines:
+            engine.stop()
+
+
+class FrameCache:
+    """
+    Copies of the most recent frames a consumer has seen, newest last.
+
+    Frames from the ring buffer are views that the acquisition process soon
+    overwrites; the cache keeps the frame on screen, and a short history of
+    the ones before it, so actions such as saving or taking a reference can
+    use them instead of waiting for another acquisition.
+    """
+
+    def __init__(self, npix, history=16):
+        self.data = np.empty((history, npix))
+        self.meta = [None] * history  # (seq, timestamp, int_time, averages) of each slot
+        self.count = 0  # frames put so far
+
+    def put(self, frame):
+        """Keep a copy of *frame*, which must not change while it is copied (see read())."""
+        slot = self.count % len(self.data)
+        np.copyto(self.data[slot], frame.ydata)
+        self.meta[slot] = (frame.seq, frame.timestamp, frame.int_time, frame.averages)
+        self.count += 1
+
+    def read(self, engine, seq):
+        """Copy frame *seq* straight out of *engine*'s ring buffer; the cached Frame, or None if it was overwritten."""
+        slot = self.count % len(self.data)
+        frame = engine.read(seq, self.data[slot])
+        if frame is None:
+            return None  # the torn copy stays in an unused slot
+        self.meta[slot] = (frame.seq, frame.timestamp, frame.int_time, frame.averages)
+        self.count += 1
+        return frame
+
+    def latest(self):
+        """The newest frame, or None if there is none yet."""
+        frames = self.recent(1)
+        return frames[0] if frames else None
+
+    def recent(self, n, since_seq=0):
+        """Up to *n* of the newest frames with a sequence number above *since_seq*, newest first."""
+        frames = []
+        for k in range(min(n, self.count, len(self.data))):
+            slot = (self.count - 1 - k) % len(self.data)
+            seq, timestamp, int_time, averages = self.meta[slot]
+            if seq <= since_seq:
+                break
+            frames.append(Frame(seq, timestamp, int_time, averages, self.data[slot]))
+        return frames
+
+
+def start_acquisition(driver='stellarnet', int_time=20, averages=1, max_devices=4, align=True, timeout=30):
+    """Start an AcquisitionEngine for every attached spectrometer; raises RuntimeError if there is none."""
+    startup = AcquisitionStartup(driver, int_time, averages, max_devices, align, timeout)
+    while True:
+        engine = startup.poll(0.05)
+        if engine is not None:
+            return engine
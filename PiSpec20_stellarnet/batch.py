@@ -0,0 +1,230 @@
+# Offline batch processing of saved spectra
+# Turns directories of spectra saved with the Save button (a "# Wavelength (nm), Count"
+# header and wavelength,value rows) into one table: the value at each monitored
+# wavelength, band integrals, and concentrations from a Beer-Lambert calibration
+# against standards.  The dark/incident/absorbance math is the app's own
+# (processing.SpectrumProcessor, monitor.MonitorTable).  Files are parsed and
+# processed in chunks across a process pool, so thousands of files use every core.
+#
+#   python3 batch.py runs/ --dark dark.txt --incident blank.txt --monitor 520 --band 600:10 \
+#                    --standards standards.csv --output summary.csv
+#
+# standards.csv has one "file name, concentration" row per standard; the other files
+# get a concentration from the calibration of the first monitored wavelength or band.
+
+import io
+import os
+import csv
+import sys
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from processing import SpectrumProcessor, RAW, ABSORBANCE, TRANSMITTANCE
+from monitor import MonitorTable
+
+MODES = {'raw': RAW, 'absorbance': ABSORBANCE, 'transmittance': TRANSMITTANCE}
+HEADERS = {'Count': RAW, 'Absorbance': ABSORBANCE, 'Transmittance': TRANSMITTANCE}  # column name in a saved file
+
+
+def read_spectrum(path):
+    """(wavelengths, values, mode) of a saved spectrum; mode is what the values are, from the header."""
+    with open(path, 'rb') as f:
+        text = f.read()
+    mode = RAW
+    if text.startswith(b'#'):
+        header, _, text = text.partition(b'\n')
+        name = header.decode(errors='replace').rsplit(',', 1)[-1].strip()
+        mode = HEADERS.get(name, RAW)
+    # numpy's C parser in one pass over the whole file instead of a Python loop over lines;
+    # unlike np.fromstring it rejects a bad value or a row of the wrong length instead of stopping there
+    try:
+        data = np.loadtxt(io.BytesIO(text), delimiter=',', ndmin=2) if text.strip() else None
+    except ValueError:
+        data = None
+    if data is None or data.shape[1] != 2:
+        raise ValueError(os.path.basename(path) + " is not a wavelength,value file")
+    return data[:, 0], data[:, 1], mode
+
+
+def find_spectra(paths, pattern='*.txt'):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            files.append(path)
+    return files
+
+
+# state of each worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(wavelengths, dark, incident, mode, monitors):
+    processor = SpectrumProcessor(len(wavelengths))
+    processor.set_dark(dark)
+    processor.set_incident(incident)
+    table = MonitorTable(wavelengths)
+    for center, width in monitors:
+        table.add(center, width)
+    _worker.update(wavelengths=wavelengths, processor=processor, mode=mode, table=table)
+
+
+def _process_chunk(paths):
+    # values of every monitor row for a chunk of files; errors are returned, not raised, so one bad file does not stop the batch
+    wavelengths, processor, mode, table = (_worker[key] for key in ('wavelengths', 'processor', 'mode', 'table'))
+    values = np.full((len(paths), len(table)), np.nan)
+    errors = [None] * len(paths)
+    for i, path in enumerate(paths):
+        try:
+            x, y, filemode = read_spectrum(path)
+            if len(x) < 2:
+                raise ValueError("no spectrum")
+            if len(x) != len(wavelengths) or not np.allclose(x, wavelengths, atol=1e-3):
+                y = np.interp(wavelengths, x, y, left=np.nan, right=np.nan)  # another spectrometer or a cropped file
+            if filemode == RAW:
+                y = processor.process(y, mode)
+            elif filemode != mode:
+                raise ValueError("file holds " + [k for k, v in MODES.items() if v == filemode][0] + " values")
+            values[i] = table.evaluate(y)
+        except (OSError, ValueError) as err:
+            errors[i] = str(err)
+    return values, errors
+
+
+def process_files(paths, wavelengths, dark, incident, monitors, mode=ABSORBANCE, workers=None, chunk=64):
+    """
+    Values of the *monitors* ((center, width) rows as in MonitorTable) for every file, as a
+    files x rows array, and the error of each file that failed (None if fine).
+    """
+    chunks = [paths[i:i + chunk] for i in range(0, len(paths), chunk)]
+    values, errors = [], []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(wavelengths, dark, incident, mode, list(monitors))) as pool:
+        for chunk_values, chunk_errors in pool.map(_process_chunk, chunks):
+            values.append(chunk_values)
+            errors.extend(chunk_errors)
+    return (np.vstack(values) if values else np.empty((0, len(monitors)))), errors
+
+
+def fit_beer_lambert(concentrations, values, path_length=1.0):
+    """
+    Least squares A = slope * c + intercept for each column of *values*.
+
+    Returns an array of (slope, intercept, r2, epsilon) rows, epsilon = slope / path_length.
+    """
+    fits = np.full((values.shape[1], 4), np.nan)
+    for k in range(values.shape[1]):
+        ok = np.isfinite(values[:, k]) & np.isfinite(concentrations)
+        if ok.sum() < 2:
+            continue
+        c, a = concentrations[ok], values[ok, k]
+        slope, intercept = np.polyfit(c, a, 1)
+        residual = a - (slope * c + intercept)
+        total = ((a - a.mean()) ** 2).sum()
+        r2 = 1 - (residual ** 2).sum() / total if total > 0 else np.nan
+        fits[k] = slope, intercept, r2, slope / path_length
+    return fits
+
+
+def read_standards(path):
+    """{file name: concentration} from a two column CSV; a header row is skipped."""
+    standards = {}
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0].startswith('#'):
+                continue
+            try:
+                standards[os.path.basename(row[0].strip())] = float(row[1])
+            except ValueError:
+                continue  # header
+    return standards
+
+
+def parse_band(text):
+    center, _, width = text.partition(':')
+    return float(center), float(width or 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch process saved spectra into one summary table")
+    parser.add_argument('spectra', nargs='+', help="spectrum files or directories of them")
+    parser.add_argument('--pattern', default='*.txt', help="files to take from directories (default *.txt)")
+    parser.add_argument('--dark', help="saved dark spectrum (raw counts)")
+    parser.add_argument('--incident', help="saved 100%% T spectrum (raw counts)")
+    parser.add_argument('--mode', choices=list(MODES), default='absorbance')
+    parser.add_argument('--monitor', type=float, action='append', default=[], help="wavelength (nm) to report, may be repeated")
+    parser.add_argument('--band', type=parse_band, action='append', default=[], metavar='CENTER:WIDTH',
+                        help="integrate CENTER +/- WIDTH nm, may be repeated")
+    parser.add_argument('--standards', help="CSV of file name, concentration for the Beer-Lambert calibration")
+    parser.add_argument('--path-length', type=float, default=1.0, help="cuvette path length (cm) for the molar absorptivity")
+    parser.add_argument('--output', help="summary CSV (default: standard output)")
+    parser.add_argument('--workers', type=int, help="worker processes (default: one per core)")
+    parser.add_argument('--chunk', type=int, default=64, help="files per task")
+    args = parser.parse_args()
+
+    mode = MODES[args.mode]
+    references = [path for path in (args.dark, args.incident) if path]
+    excluded = set(os.path.abspath(path) for path in references)
+    files = [path for path in find_spectra(args.spectra, args.pattern) if os.path.abspath(path) not in excluded]
+    if not files:
+        parser.error("no spectra found")
+    # the wavelength grid of the first reference (or file) is the one everything is evaluated on
+    wavelengths = read_spectrum(references[0] if references else files[0])[0]
+    dark = read_spectrum(args.dark)[1] if args.dark else np.zeros(len(wavelengths))
+    incident = read_spectrum(args.incident)[1] if args.incident else np.ones(len(wavelengths))
+    if mode != RAW and not args.incident:
+        print("warning: no --incident given, raw count files cannot be converted to " + args.mode, file=sys.stderr)
+    for name, spectrum in (('dark', dark), ('incident', incident)):
+        if len(spectrum) != len(wavelengths):
+            parser.error("the " + name + " spectrum has a different number of points")
+
+    monitors = [(center, 0.0) for center in args.monitor] + args.band
+    if not monitors:
+        monitors = [(float(np.median(wavelengths)), 0.0)]  # the app's default monitored wavelength
+    table = MonitorTable(wavelengths)
+    for center, width in monitors:
+        table.add(center, width)
+    labels = [table.label(row) for row in range(len(table))]
+
+    values, errors = process_files(files, wavelengths, dark, incident, monitors, mode, args.workers, args.chunk)
+
+    names = [os.path.basename(path) for path in files]
+    concentrations = np.full(len(files), np.nan)
+    fits = None
+    if args.standards:
+        standards = read_standards(args.standards)
+        for i, name in enumerate(names):
+            concentrations[i] = standards.get(name, np.nan)
+        fits = fit_beer_lambert(concentrations, values, args.path_length)
+        print("Beer-Lambert calibration, " + str(int(np.isfinite(concentrations).sum())) + " standards", file=sys.stderr)
+        for label, (slope, intercept, r2, epsilon) in zip(labels, fits):
+            print(f"  {label:<18} slope {slope:.6g}  intercept {intercept:.6g}  R^2 {r2:.5f}  epsilon {epsilon:.6g}", file=sys.stderr)
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        writer = csv.writer(out)
+        header = ['file'] + labels
+        if fits is not None:
+            header += ['concentration (standard)', 'concentration (fit, ' + labels[0] + ')']
+        writer.writerow(header + ['error'])
+        for i, name in enumerate(names):
+            row = [name] + ['%.6g' % value for value in values[i]]
+            if fits is not None:
+                slope, intercept = fits[0, 0], fits[0, 1]
+                fitted = (values[i, 0] - intercept) / slope if slope else np.nan
+                row += ['' if np.isnan(concentrations[i]) else '%.6g' % concentrations[i], '%.6g' % fitted]
+            writer.writerow(row + [errors[i] or ''])
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    failed = sum(error is not None for error in errors)
+    if failed:
+        print(str(failed) + " of " + str(len(files)) + " files could not be processed", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
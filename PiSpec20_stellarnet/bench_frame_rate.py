@@ -0,0 +1,179 @@
+# Frame rate benchmark for the display hot loop, runs on the simulated spectrometer
+# Reports sustained frames/sec, per-frame latency percentiles and memory growth for
+#   raw         acquisition engine -> raw counts -> line/annotation update -> BlitManager.update
+#   absorbance  the same with the absorbance calculation
+#   transmittance  the same with the transmittance calculation
+#   blit        BlitManager.update alone on a fixed spectrum
+# Example:  python3 bench_frame_rate.py --frames 500 --pixels 2048 --min-fps 20
+# --timing runs the stage timing of the display loop as well and prints its
+# histograms; compare with a run without it to see what the timing costs.
+# A non-zero exit status means a benchmark fell below --min-fps, so it can gate a deploy.
+
+import os
+import sys
+import time
+import argparse
+from functools import partial
+
+import numpy as np
+
+
+def rss_kb():
+    """Current resident set size in kB (Linux), falls back to the peak RSS elsewhere."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_figure(wavelengths, ydata, timing=None):
+    # same artists as App, drawn on an Agg canvas so no display is needed
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from stellarnet_spec import BlitManager
+    from display import LineDecimator
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax1 = fig.add_subplot(111)
+    line, = ax1.plot([], [], lw=1, color='blue')
+    ax1.set_xlim(wavelengths[0], wavelengths[-1])
+    ax1.set_ylim(0, max(ydata) * 1.1)
+    text = ax1.annotate('', (1, 1), xycoords="axes fraction", xytext=(10, -10),
+                        textcoords="offset points", ha="right", va="top", fontsize=14, animated=True)
+    bm = BlitManager(fig.canvas, [line, text], timing)
+    fig.canvas.draw()
+    decimator = LineDecimator(wavelengths)
+    decimator.set_geometry(wavelengths[0], wavelengths[-1], ax1.bbox.width)
+    return line, text, bm, decimator
+
+
+def summarize(name, frame_times, elapsed, rss_start, rss_end, dropped=0):
+    ms = np.asarray(frame_times) * 1000.0
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    fps = len(ms) / elapsed
+    print(f"{name:<13} {fps:8.1f} fps  p50 {p50:7.2f} ms  p90 {p90:7.2f} ms  p99 {p99:7.2f} ms  "
+          f"max {ms.max():7.2f} ms  dropped {dropped:5d}  mem {rss_end - rss_start:+7d} kB")
+    return fps
+
+
+def bench_display(engine, mode, nframes, warmup, timing=None):
+    """Consume frames from the engine the way App.update_graph does."""
+    from processing import SpectrumProcessor, RAW, ABSORBANCE, TRANSMITTANCE
+    from timing import AGE, ACQUIRE, PROCESS, ARTISTS
+    wavelengths = engine.wavelengths
+    first = np.array(engine.wait_frame(1).ydata)
+    line, text, bm, decimator = make_figure(wavelengths, first, timing)
+    processor = SpectrumProcessor(len(wavelengths))
+    processor.set_dark(first * 0.05)
+    processor.set_incident(first)
+    code = {'raw': RAW, 'absorbance': ABSORBANCE, 'transmittance': TRANSMITTANCE}[mode]
+    monitorindex = len(wavelengths) // 2
+    frame_times = []
+    lastseq = engine.latest().seq
+    dropped = 0
+    rss_start = None
+    for i in range(warmup + nframes):
+        if i == warmup:
+            rss_start = rss_kb()
+            start = time.perf_counter()
+            dropped = 0  # drops during warm up are expected while caches fill
+        frame = engine.wait_frame(lastseq + 1)
+        t0 = time.perf_counter()
+        # --- mirrors App.update_graph ---
+        if timing is not None:
+            timing.start()
+            timing.add(AGE, time.time() - frame.timestamp)
+        dropped += frame.seq - lastseq - 1
+        lastseq = frame.seq
+        if timing is not None:
+            timing.lap(ACQUIRE)
+        ydata = processor.process(frame.ydata, code)
+        monitor = np.round(ydata[monitorindex], decimals=3)
+        x, y = decimator.decimate(ydata)
+        if timing is not None:
+            timing.lap(PROCESS)
+        line.set_data(x, y)
+        text.set_text(f"{monitor}")
+        if timing is not None:
+            timing.lap(ARTISTS)
+        bm.update()
+        if timing is not None:
+            timing.end_frame()
+        # --- end of App.update_graph ---
+        if i >= warmup:
+            frame_times.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    fps = summarize(mode, frame_times, elapsed, rss_start, rss_kb(), dropped)
+    if timing is not None:
+        print(timing.report())
+    return fps
+
+
+def bench_blit(wavelengths, ydata, nframes, warmup):
+    line, text, bm, decimator = make_figure(wavelengths, ydata)
+    line.set_data(*decimator.decimate(ydata))
+    frame_times = []
+    rss_start = None
+    for i in range(warmup + nframes):
+        if i == warmup:
+            rss_start = rss_kb()
+            start = time.perf_counter()
+        t0 = time.perf_counter()
+        text.set_text(f"{i}")
+        bm.update()
+        if i >= warmup:
+            frame_times.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    return summarize('blit', frame_times, elapsed, rss_start, rss_kb())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame rate benchmark on the simulated spectrometer")
+    parser.add_argument('--frames', type=int, default=300, help="frames measured per benchmark")
+    parser.add_argument('--warmup', type=int, default=20, help="frames run before measuring")
+    parser.add_argument('--pixels', type=int, default=2048, help="simulated detector pixels")
+    parser.add_argument('--int-time', type=int, default=3, help="integration time in ms")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="fraction of the integration time the simulator really waits (0 = as fast as possible)")
+    parser.add_argument('--noise', type=float, default=1.0, help="simulated noise scale")
+    parser.add_argument('--only', choices=['raw', 'absorbance', 'transmittance', 'blit'], action='append', help="run only these benchmarks")
+    parser.add_argument('--min-fps', type=float, default=0.0, help="exit with status 1 if any benchmark is slower")
+    parser.add_argument('--timing', action='store_true', help="time the stages of the display loop and print their histograms")
+    args = parser.parse_args()
+
+    # the acquisition process reads its simulator settings from the environment
+    os.environ['PISPEC_SIM_PIXELS'] = str(args.pixels)
+    os.environ['PISPEC_SIM_LATENCY'] = str(args.latency)
+    os.environ['PISPEC_SIM_NOISE'] = str(args.noise)
+    import matplotlib
+    matplotlib.use('Agg')
+    from acquisition import AcquisitionEngine, open_spectrometer
+    from timing import StageTimer
+
+    which = args.only or ['raw', 'absorbance', 'transmittance', 'blit']
+    print(f"{args.pixels} pixels, {args.int_time} ms integration, simulator latency x{args.latency}, {args.frames} frames")
+    results = {}
+    engine = AcquisitionEngine(partial(open_spectrometer, 0, 'simulated'), int_time=args.int_time)
+    engine.start()
+    try:
+        for mode in ('raw', 'absorbance', 'transmittance'):
+            if mode in which:
+                results[mode] = bench_display(engine, mode, args.frames, args.warmup,
+                                              StageTimer() if args.timing else None)
+        wavelengths = engine.wavelengths
+        ydata = np.array(engine.wait_frame(1).ydata)
+    finally:
+        engine.stop()
+    if 'blit' in which:
+        results['blit'] = bench_blit(wavelengths, ydata, args.frames, args.warmup)
+
+    slow = [name for name, fps in results.items() if fps < args.min_fps]
+    if slow:
+        print("below --min-fps " + str(args.min_fps) + ": " + ", ".join(slow))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Display helpers for the live spectrum
+# The detector has far more pixels than the plot is wide, and many of them can be
+# outside the current xmin/xmax zoom.  LineDecimator hands matplotlib only the
+# visible part of the spectrum, reduced to two points (min and max) per screen
+# column so narrow absorption features and emission lines still show.
+
+import numpy as np
+
+
+class LineDecimator:
+    """
+    Min/max decimation of a spectrum to the plot width.
+
+    set_geometry() does the index bookkeeping and is only called when the
+    wavelength window or the plot size changes; decimate() runs every frame and
+    only slices (views) and reduces into preallocated buffers.
+    """
+
+    def __init__(self, wavelengths):
+        self.wavelengths = wavelengths
+        self.key = None
+        self.i0 = 0
+        self.i1 = len(wavelengths)
+        self.starts = None
+        self.x = wavelengths
+        self.y = None
+
+    def set_geometry(self, xmin, xmax, width):
+        """Set the visible window (nm) and plot width (pixels); returns True when the mapping changed."""
+        width = max(int(width), 1)
+        key = (xmin, xmax, width)
+        if key == self.key:
+            return False
+        self.key = key
+        wl = self.wavelengths
+        # one pixel beyond each edge so the line reaches the sides of the plot
+        self.i0 = max(int(np.searchsorted(wl, xmin, side='left')) - 1, 0)
+        self.i1 = min(int(np.searchsorted(wl, xmax, side='right')) + 1, len(wl))
+        n = self.i1 - self.i0
+        if n <= 2 * width:
+            # no more points than the min/max pairs would give, draw them all
+            self.starts = None
+            self.x = wl[self.i0:self.i1]
+            self.y = None
+        else:
+            self.starts = (np.arange(width) * n) // width  # first pixel of each screen column
+            ends = np.append(self.starts[1:], n)
+            centers = (self.starts + ends - 1) // 2
+            self.x = np.repeat(wl[self.i0:self.i1][centers], 2)
+            self.y = np.empty(2 * width)
+        return True
+
+    def decimate(self, ydata):
+        """(x, y) to draw for a full resolution spectrum; y is reused by the next call."""
+        visible = ydata[self.i0:self.i1]
+        if self.starts is None:
+            return self.x, visible
+        # fmin/fmax skip NaN, so a column only becomes a gap if all its pixels are undefined
+        np.fmin.reduceat(visible, self.starts, out=self.y[0::2])
+        np.fmax.reduceat(visible, self.starts, out=self.y[1::2])
+        return self.x, self.y
@@ -0,0 +1,73 @@
+# Automatic integration time
+# Detector counts grow linearly with the integration time above a fixed offset:
+#   peak = offset + rate * int_time
+# From the peak counts of one frame the integration time that puts the peak at
+# the target fraction of full scale is calculated directly, assuming no offset
+# (which errs on the short side).  The frame at that time is a second point on
+# the line, so offset and rate are both known and the next step lands on the
+# target: 2-3 acquisitions instead of a trial and error search.  A saturated
+# frame says nothing about the rate, so the time is cut geometrically until the
+# peak is back on scale.
+
+
+class AutoExposure:
+    """
+    Integration time controller.
+
+    Parameters
+    ----------
+    full_scale : float
+        Counts of a saturated pixel (65535 for the 16 bit StellarNet detectors).
+    target : float
+        Fraction of full scale to bring the peak to.
+    tolerance : float
+        Peaks within target +/- tolerance (fractions of full scale) are left alone.
+    min_int_time, max_int_time : int
+        Allowed integration times (ms).
+    backoff : float
+        The integration time is multiplied by this after a saturated frame.
+    saturation : float
+        Peaks at or above this fraction of full scale count as saturated.
+    """
+
+    def __init__(self, full_scale=65535, target=0.8, tolerance=0.1, min_int_time=3, max_int_time=65000,
+                 backoff=0.25, saturation=0.98):
+        self.full_scale = float(full_scale)
+        self.target = target
+        self.tolerance = tolerance
+        self.min_int_time = min_int_time
+        self.max_int_time = max_int_time
+        self.backoff = backoff
+        self.saturation = saturation
+        self.points = []  # (int_time, peak) of the last unsaturated frames, at two different integration times
+        self.converged = False
+
+    def update(self, int_time, peak):
+        """Integration time (ms) for the next frames, or None to keep *int_time*."""
+        level = peak / self.full_scale
+        if level >= self.saturation:
+            self.points = []  # the peak was clipped, it is no point on the line
+            wanted = int_time * self.backoff
+        else:
+            if abs(level - self.target) <= self.tolerance:
+                self.converged = True
+                return None
+            self.points = [point for point in self.points if point[0] != int_time][-1:] + [(int_time, peak)]
+            wanted = self.solve()
+        self.converged = False
+        new = int(round(min(max(wanted, self.min_int_time), self.max_int_time)))
+        return None if new == int_time else new
+
+    def solve(self):
+        # integration time that puts the peak on target, from the line through the last two points
+        goal = self.target * self.full_scale
+        int_time, peak = self.points[-1]
+        if len(self.points) == 2:
+            (t0, p0), (t1, p1) = self.points
+            rate = (p1 - p0) / (t1 - t0)
+            offset = p1 - rate * t1
+            if rate > 0 and 0 <= offset < goal:
+                return (goal - offset) / rate
+        if peak <= 0:
+            return int_time / self.backoff  # no light at all, grow geometrically
+        return int_time * goal / peak  # first point: no offset assumed, which can only undershoot
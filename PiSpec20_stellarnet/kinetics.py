@@ -0,0 +1,169 @@
+# Kinetics (time series) log
+# Timestamped values of the monitored wavelength, and optionally the full raw
+# spectra, are appended to a memory-mapped file that grows in chunks.  Python
+# memory use stays constant however long the run is, the strip chart reads
+# straight from the file, and a run that crashes can still be opened because the
+# header always holds the number of complete records.
+
+import os
+import time
+
+import numpy as np
+
+MAGIC = b'PSKIN001'
+HEADER = np.dtype([('magic', 'S8'), ('count', '<i8'), ('npix', '<i8'), ('display_code', '<i8'),
+                   ('monitorwave', '<f8'), ('start', '<f8'), ('dropped', '<i8'), ('reserved', '<f8', (1,))])  # 64 bytes
+
+
+def record_dtype(npix):
+    fields = [('timestamp', '<f8'), ('seq', '<i8'), ('value', '<f8')]
+    if npix:
+        fields.append(('spectrum', '<f4', (npix,)))  # detector counts fit exactly in float32
+    return np.dtype(fields)
+
+
+class KineticsLog:
+    """
+    Append-only memory-mapped kinetics log.
+
+    Parameters
+    ----------
+    path : str
+        File to create (it is overwritten).
+    npix : int
+        Pixels per spectrum to store with each value, 0 to store values only.
+    monitorwave : float
+        Monitored wavelength (nm), kept in the header.
+    display_code : int
+        Display mode the values were computed in (0 raw counts, 1 absorbance).
+    chunk_bytes : int
+        The file grows by about this much whenever it is full.
+    """
+
+    def __init__(self, path, npix=0, monitorwave=np.nan, display_code=0, chunk_bytes=4 * 1024 * 1024,
+                 flush_interval=1.0, _readonly=False):
+        self.path = path
+        self.readonly = _readonly
+        if _readonly:
+            header = np.fromfile(path, dtype=HEADER, count=1)
+            if len(header) != 1 or header['magic'][0] != MAGIC:
+                raise ValueError(path + " is not a kinetics log")
+            npix = int(header['npix'][0])
+        self.dtype = record_dtype(npix)
+        self.npix = npix
+        self.chunk = max(256, chunk_bytes // self.dtype.itemsize)
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        if _readonly:
+            self.header = np.memmap(path, dtype=HEADER, mode='r', shape=(1,))
+            self.capacity = (os.path.getsize(path) - HEADER.itemsize) // self.dtype.itemsize
+            self.records = np.memmap(path, dtype=self.dtype, mode='r', offset=HEADER.itemsize, shape=(self.capacity,))
+        else:
+            with open(path, 'wb') as f:
+                f.truncate(HEADER.itemsize + self.chunk * self.dtype.itemsize)
+            self.capacity = self.chunk
+            self.header = np.memmap(path, dtype=HEADER, mode='r+', shape=(1,))
+            self.header['magic'] = MAGIC
+            self.header['count'] = 0
+            self.header['npix'] = npix
+            self.header['display_code'] = display_code
+            self.header['monitorwave'] = monitorwave
+            self.header['start'] = time.time()
+            self.header['dropped'] = 0
+            self.header.flush()
+            self._map_records()
+
+    @classmethod
+    def open(cls, path):
+        """Open an existing log read-only, including one left behind by a crash."""
+        return cls(path, _readonly=True)
+
+    @property
+    def count(self):
+        return min(int(self.header['count'][0]), self.capacity)
+
+    @property
+    def start(self):
+        return float(self.header['start'][0])
+
+    @property
+    def dropped(self):
+        """Frames that were overwritten before they could be logged (0 in logs made before this was counted)."""
+        return int(self.header['dropped'][0])
+
+    def missed(self, count):
+        self.header['dropped'] = self.dropped + count
+
+    @property
+    def monitorwave(self):
+        return float(self.header['monitorwave'][0])
+
+    @property
+    def display_code(self):
+        return int(self.header['display_code'][0])
+
+    def _map_records(self):
+        self.records = np.memmap(self.path, dtype=self.dtype, mode='r+', offset=HEADER.itemsize, shape=(self.capacity,))
+
+    def _grow(self):
+        self.records.flush()
+        del self.records
+        self.capacity += self.chunk
+        with open(self.path, 'r+b') as f:
+            f.truncate(HEADER.itemsize + self.capacity * self.dtype.itemsize)
+        self._map_records()
+
+    def append(self, timestamp, seq, value, spectrum=None):
+        count = int(self.header['count'][0])
+        if count == self.capacity:
+            self._grow()
+        record = self.records[count]
+        record['timestamp'] = timestamp
+        record['seq'] = seq
+        record['value'] = value
+        if self.npix:
+            record['spectrum'] = spectrum
+        self.header['count'] = count + 1  # the record is complete before it is counted
+        now = time.monotonic()
+        if now - self.last_flush > self.flush_interval:
+            self.flush()
+            self.last_flush = now
+
+    def tail(self, n):
+        """The last *n* records (a view of the file)."""
+        count = self.count
+        return self.records[max(count - n, 0):count]
+
+    def flush(self):
+        self.records.flush()
+        self.header.flush()
+
+    def close(self):
+        if not self.readonly:
+            count = self.count
+            self.flush()
+            del self.records, self.header
+            with open(self.path, 'r+b') as f:
+                f.truncate(HEADER.itemsize + count * self.dtype.itemsize)  # drop the unused part of the last chunk
+        else:
+            del self.records, self.header
+
+    def export_csv(self, path, spectra=False, wavelengths=None, block=10000):
+        """Write time (s from start), sequence number and value (and the spectra if asked) as CSV, a block at a time."""
+        count = self.count
+        columns = "# Time (s), Frame, Value"
+        if spectra and self.npix:
+            if wavelengths is None:
+                columns += "".join(", Pixel " + str(i) for i in range(self.npix))
+            else:
+                columns += "".join(", " + str(w) + " nm" for w in np.round(wavelengths, 3))
+        with open(path, 'w') as f:
+            f.write(columns + '\n')
+            for i in range(0, count, block):
+                rows = self.records[i:min(i + block, count)]
+                table = np.column_stack((rows['timestamp'] - self.start, rows['seq'], rows['value']))
+                fmt = ['%.4f', '%d', '%.6g']
+                if spectra and self.npix:
+                    table = np.column_stack((table, rows['spectrum']))
+                    fmt += ['%.6g'] * self.npix
+                np.savetxt(f, table, delimiter=',', fmt=fmt)
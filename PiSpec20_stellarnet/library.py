@@ -0,0 +1,309 @@
+# Reference spectrum library
+# Saved spectra of known dyes, LEDs, ... are resampled once onto the instrument's
+# wavelength grid and kept as one matrix of mean-centred, unit-length rows.  The
+# cosine similarity of a live spectrum with every reference is then a single
+# matrix-vector product; the same on first derivatives ranks by a least squares
+# fit of the spectral shape that ignores baselines.  A mixture of the best
+# matches can be fitted with non-negative amounts.  LiveMatcher does the search
+# on a worker thread (NumPy releases the GIL), so the display never waits on it.
+#
+# A library is a directory:
+#   index.json        names, source files and display mode (raw/absorbance/...) of each reference
+#   wavelengths.npy   float64[npix]      the grid the spectra were resampled to
+#   spectra.npy       float32[n, npix]   normalized spectra, memory-mapped when loaded
+#   scale.npy         float64[n, 2]      mean and norm taken out of each spectrum
+#
+#   python3 library.py build refs/ --grid sample.txt --output dyes/
+#   python3 library.py match sample.txt --library dyes/ --derivative --mixture 3
+
+import os
+import sys
+import json
+import threading
+import argparse
+
+import numpy as np
+
+from batch import read_spectrum, find_spectra, MODES
+
+VERSION = 1
+
+
+def _fill(spectrum):
+    """Pixels that are NaN or infinite (absorbance where there is no light) set to the mean of the others, in place."""
+    finite = np.isfinite(spectrum)
+    if not finite.all():
+        spectrum[~finite] = spectrum[finite].mean() if finite.any() else 0.0
+    return spectrum
+
+
+def _normalize(spectra, valid):
+    """Mean-centre every row over its valid pixels and scale it to unit length, in place; returns (mean, norm) rows."""
+    counts = np.maximum(valid.sum(axis=1), 1)
+    np.copyto(spectra, 0.0, where=~valid)
+    mean = spectra.sum(axis=1) / counts
+    spectra -= mean[:, None]
+    np.copyto(spectra, 0.0, where=~valid)  # pixels outside a reference's range take no part in the similarity
+    norm = np.sqrt(np.einsum('ij,ij->i', spectra, spectra))
+    norm[norm == 0] = 1.0
+    spectra /= norm[:, None]
+    return np.column_stack((mean, norm))
+
+
+class ReferenceLibrary:
+    """
+    Normalized reference spectra on one wavelength grid, ranked against a spectrum by similarity.
+
+    Build one with ReferenceLibrary.build(), save() it, and load() it with the
+    instrument's wavelengths; a library made on another grid is resampled then.
+    """
+
+    def __init__(self, wavelengths, names, sources, modes, spectra, scale):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.names = list(names)
+        self.sources = list(sources)
+        self.modes = np.asarray(modes, dtype=np.int64)
+        self.spectra = spectra  # float32[n, npix], rows mean-centred and unit length
+        self.scale = np.asarray(scale, dtype=float)  # (mean, norm) of each row before normalizing
+        self._derivatives = None
+        self.step = max(len(self.wavelengths) // 256, 1)  # pixels a derivative is taken over, so noise does not dominate it
+        self._scores = np.empty(len(self.names), dtype=np.float32)
+        self._live = np.empty(len(self.wavelengths), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def build(cls, paths, wavelengths):
+        """Library of the saved spectra *paths*, resampled to *wavelengths*; files that cannot be read are skipped."""
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        rows, names, sources, modes, skipped = [], [], [], [], []
+        for path in paths:
+            try:
+                x, y, mode = read_spectrum(path)
+            except (OSError, ValueError):
+                skipped.append(path)
+                continue
+            rows.append(np.interp(wavelengths, x, y, left=np.nan, right=np.nan))
+            names.append(os.path.splitext(os.path.basename(path))[0])
+            sources.append(os.path.abspath(path))
+            modes.append(mode)
+        spectra = np.array(rows, dtype=float).reshape(len(rows), len(wavelengths))
+        scale = _normalize(spectra, np.isfinite(spectra))
+        library = cls(wavelengths, names, sources, modes, spectra.astype(np.float32), scale)
+        library.skipped = skipped
+        return library
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'version': VERSION, 'npix': len(self.wavelengths), 'names': self.names,
+                       'sources': self.sources, 'modes': self.modes.tolist()}, f)
+        np.save(os.path.join(path, 'wavelengths.npy'), self.wavelengths)
+        np.save(os.path.join(path, 'spectra.npy'), np.ascontiguousarray(self.spectra, dtype=np.float32))
+        np.save(os.path.join(path, 'scale.npy'), self.scale)
+
+    @classmethod
+    def load(cls, path, wavelengths=None):
+        """Library saved in directory *path*, on the grid *wavelengths* (default: the one it was built on)."""
+        try:
+            with open(os.path.join(path, 'index.json')) as f:
+                index = json.load(f)
+            grid = np.load(os.path.join(path, 'wavelengths.npy'))
+            spectra = np.load(os.path.join(path, 'spectra.npy'), mmap_mode='r')
+            scale = np.load(os.path.join(path, 'scale.npy'))
+        except (OSError, ValueError) as err:
+            raise ValueError(path + " is not a reference library (" + str(err) + ")")
+        if index.get('version') != VERSION or spectra.shape != (len(index['names']), len(grid)):
+            raise ValueError(path + " is not a reference library of this version")
+        library = cls(grid, index['names'], index['sources'], index['modes'], spectra, scale)
+        if wavelengths is not None and (len(wavelengths) != len(grid) or not np.allclose(wavelengths, grid, atol=1e-3)):
+            library = library.resampled(wavelengths)
+        return library
+
+    def resampled(self, wavelengths):
+        """The same references on another wavelength grid (done once, when a library is loaded for an instrument)."""
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        spectra = np.empty((len(self), len(wavelengths)))
+        for i, row in enumerate(self.spectra):
+            mean, norm = self.scale[i]
+            original = np.where(row != 0, row * norm + mean, np.nan)  # pixels outside the reference's range are 0
+            spectra[i] = np.interp(wavelengths, self.wavelengths, original, left=np.nan, right=np.nan)
+        scale = _normalize(spectra, np.isfinite(spectra))
+        return ReferenceLibrary(wavelengths, self.names, self.sources, self.modes, spectra.astype(np.float32), scale)
+
+    @property
+    def derivatives(self):
+        # differences over self.step pixels of the normalized rows, made unit length again; computed on first use
+        if self._derivatives is None:
+            derivatives = self.spectra[:, self.step:] - self.spectra[:, :-self.step]
+            norm = np.sqrt(np.einsum('ij,ij->i', derivatives, derivatives))
+            norm[norm == 0] = 1.0
+            derivatives /= norm[:, None]
+            self._derivatives = derivatives
+        return self._derivatives
+
+    def scores(self, ydata, derivative=False):
+        """
+        Similarity of *ydata* with every reference, -1..1.
+
+        Cosine similarity of the mean-centred spectra, or with *derivative* of their
+        derivatives (differences over self.step pixels): then 1 - score**2 is the
+        residual of the least squares fit of a reference's derivative to that of
+        *ydata* (both unit length).
+        """
+        live = self._live
+        np.copyto(live, ydata, casting='unsafe')
+        _fill(live)
+        if derivative:
+            live = live[self.step:] - live[:-self.step]
+            matrix = self.derivatives
+        else:
+            live -= live.mean()
+            matrix = self.spectra
+        norm = np.sqrt(np.dot(live, live))
+        if norm > 0:
+            live /= norm
+        return np.dot(matrix, live, out=self._scores)  # one matrix-vector product for the whole library
+
+    def match(self, ydata, top=5, derivative=False, mode=None):
+        """(index, score) of the *top* best references, best first; *mode* limits them to spectra of that kind."""
+        scores = self.scores(ydata, derivative)
+        if mode is not None:
+            scores[self.modes != mode] = -np.inf
+        top = min(top, len(scores))
+        if top == 0:
+            return []
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best])]
+        return [(int(i), float(scores[i])) for i in best if np.isfinite(scores[i])]
+
+    def mixture(self, ydata, indices):
+        """
+        Non-negative amounts of the references *indices* (plus a free baseline) that best add up to *ydata*.
+
+        Returns (amounts, r2); an amount is relative to the reference as it was saved.
+        """
+        y = _fill(np.array(ydata, dtype=float))
+        rows = np.asarray(self.spectra[indices], dtype=float).T
+        active = list(range(len(indices)))
+        coefficients = np.zeros(len(indices))
+        while active:
+            # least squares on the active references, dropping the most negative one until none is
+            design = np.column_stack((rows[:, active], np.ones(len(y))))
+            solution = np.linalg.lstsq(design, y, rcond=None)[0]
+            if solution[:-1].min() >= 0:
+                coefficients[active] = solution[:-1]
+                break
+            del active[int(np.argmin(solution[:-1]))]
+        fitted = rows @ coefficients
+        residual = y - fitted - (y - fitted).mean()
+        total = ((y - y.mean()) ** 2).sum()
+        r2 = 1 - (residual ** 2).sum() / total if total > 0 else np.nan
+        # a row is (spectrum - mean) / norm, so the amount of the spectrum itself is coefficient / norm
+        return coefficients / self.scale[indices, 1], r2
+
+
+class LiveMatcher:
+    """
+    Library search on a worker thread.  offer() hands over the newest spectrum (a
+    copy into a one-spectrum mailbox, older ones not searched yet are dropped);
+    results holds the latest answer as (seq, matches, mixture) for the GUI to show.
+    """
+
+    def __init__(self, library, top=5, derivative=False, mixture=0, mode=None):
+        self.library = library
+        self.top = top
+        self.derivative = derivative
+        self.mixture = mixture  # fit a mixture of this many best matches, 0 for none
+        self.mode = mode
+        self.results = None
+        self.error = None
+        self.pending = np.empty(len(library.wavelengths))
+        self.pending_seq = 0
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.thread = threading.Thread(target=self._search, daemon=True)
+        self.thread.start()
+
+    def offer(self, seq, ydata):
+        with self.lock:
+            np.copyto(self.pending, ydata)
+            self.pending_seq = seq
+        self.ready.set()
+
+    def _search(self):
+        spectrum = np.empty_like(self.pending)
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            if self.stopping:
+                return
+            with self.lock:
+                np.copyto(spectrum, self.pending)
+                seq = self.pending_seq
+            try:
+                matches = self.library.match(spectrum, self.top, self.derivative, self.mode)
+                mixture = None
+                if self.mixture > 1 and len(matches) > 1:
+                    indices = [index for index, score in matches[:self.mixture]]
+                    amounts, r2 = self.library.mixture(spectrum, indices)
+                    mixture = (indices, amounts, r2)
+                self.results = (seq, matches, mixture)
+            except (ValueError, np.linalg.LinAlgError) as err:
+                self.error = str(err)
+
+    def stop(self):
+        self.stopping = True
+        self.ready.set()
+        self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a reference spectrum library or identify saved spectra with one")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="resample saved spectra into a library")
+    build.add_argument('spectra', nargs='+', help="spectrum files or directories of them")
+    build.add_argument('--pattern', default='*.txt', help="files to take from directories (default *.txt)")
+    build.add_argument('--grid', help="saved spectrum from the instrument whose wavelength grid to use (default: the first reference)")
+    build.add_argument('--output', required=True, help="library directory")
+    match = commands.add_parser('match', help="rank the references against saved spectra")
+    match.add_argument('spectra', nargs='+', help="spectrum files or directories of them")
+    match.add_argument('--pattern', default='*.txt')
+    match.add_argument('--library', required=True, help="library directory")
+    match.add_argument('--top', type=int, default=5, help="matches to list (default 5)")
+    match.add_argument('--derivative', action='store_true', help="compare first derivatives (least squares), ignoring baselines")
+    match.add_argument('--mixture', type=int, default=0, metavar='N', help="also fit a mixture of the N best matches")
+    args = parser.parse_args()
+
+    files = find_spectra(args.spectra, args.pattern)
+    if not files:
+        parser.error("no spectra found")
+    if args.command == 'build':
+        grid = read_spectrum(args.grid if args.grid else files[0])[0]
+        library = ReferenceLibrary.build(files, grid)
+        library.save(args.output)
+        print(str(len(library)) + " references on " + str(len(grid)) + " wavelengths in " + args.output, file=sys.stderr)
+        for path in library.skipped:
+            print("skipped " + path + " (not a wavelength,value file)", file=sys.stderr)
+        return
+    names = {mode: name for name, mode in MODES.items()}
+    library = None
+    for path in files:
+        x, y, mode = read_spectrum(path)
+        if library is None or len(x) != len(library.wavelengths) or not np.allclose(x, library.wavelengths, atol=1e-3):
+            library = ReferenceLibrary.load(args.library, x)
+        matches = library.match(y, args.top, args.derivative, mode)
+        print(os.path.basename(path) + " (" + names.get(mode, '?') + ")")
+        for index, score in matches:
+            print(f"  {score:8.4f}  {library.names[index]}")
+        if args.mixture > 1 and len(matches) > 1:
+            indices = [index for index, score in matches[:args.mixture]]
+            amounts, r2 = library.mixture(y, indices)
+            print("  mixture (R^2 {:.4f}): ".format(r2) + " + ".join(
+                "{:.3g} {}".format(amount, library.names[index]) for index, amount in zip(indices, amounts)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Monitored wavelengths and bands
+# Any number of single wavelengths and bands (center +/- half width) can be
+# watched.  Their pixel bounds are looked up with searchsorted only when the
+# table changes.  Each frame then costs one cumulative sum over the spectrum,
+# however many bands there are: the integral over a band is the difference of
+# two cumulative sums.
+
+import numpy as np
+
+
+class MonitorTable:
+    """
+    Values of monitored wavelengths and band integrals for each frame.
+
+    A single wavelength gives the value of its pixel; a band gives the integral
+    of the spectrum over center - width .. center + width (value x nm).  Pixels
+    that are NaN (undefined absorbance or transmittance) count as zero.
+    """
+
+    def __init__(self, wavelengths):
+        self.wavelengths = np.asarray(wavelengths)
+        npix = len(self.wavelengths)
+        self.dlambda = np.gradient(self.wavelengths)  # nm covered by each pixel
+        self.entries = []  # (center, width), width 0 for a single wavelength
+        self._weighted = np.empty(npix)
+        self._cumsum = np.zeros(npix + 1)  # _cumsum[i] = integral over pixels 0..i-1
+        self._nan = np.empty(npix, dtype=bool)
+        self._bounds()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, center, width=0.0):
+        """Add a wavelength (width 0) or a band; returns its row."""
+        self.entries.append((float(center), abs(float(width))))
+        self._bounds()
+        return len(self.entries) - 1
+
+    def set(self, row, center, width=0.0):
+        self.entries[row] = (float(center), abs(float(width)))
+        self._bounds()
+
+    def remove(self, row):
+        del self.entries[row]
+        self._bounds()
+
+    def _bounds(self):
+        # pixel bounds of every row, only redone when the table changes
+        n = len(self.entries)
+        centers = np.array([center for center, width in self.entries], dtype=float)
+        widths = np.array([width for center, width in self.entries], dtype=float)
+        last = len(self.wavelengths) - 1
+        self.index = np.minimum(np.searchsorted(self.wavelengths, centers, side='left'), last)
+        self.lo = np.searchsorted(self.wavelengths, centers - widths, side='left')
+        self.hi = np.searchsorted(self.wavelengths, centers + widths, side='right')
+        self.band = widths > 0
+        self.any_band = bool(self.band.any())
+        self.values = np.empty(n)
+        self._clo = np.empty(n)
+        self._chi = np.empty(n)
+
+    def label(self, row):
+        center, width = self.entries[row]
+        if width > 0:
+            return "{:.1f} ± {:g} nm".format(center, width)
+        return "{:.2f} nm".format(self.wavelengths[self.index[row]])
+
+    def span(self, row):
+        """Wavelength range of a row as drawn: (x, x) for a wavelength, (low, high) for a band."""
+        center, width = self.entries[row]
+        if width > 0:
+            return center - width, center + width
+        x = self.wavelengths[self.index[row]]
+        return x, x
+
+    def evaluate(self, ydata):
+        """Values of every row for one (processed) spectrum, in self.values which the next call overwrites."""
+        np.take(ydata, self.index, out=self.values)
+        if self.any_band:
+            np.multiply(ydata, self.dlambda, out=self._weighted)
+            np.isnan(self._weighted, out=self._nan)
+            np.copyto(self._weighted, 0.0, where=self._nan)
+            np.cumsum(self._weighted, out=self._cumsum[1:])
+            np.take(self._cumsum, self.lo, out=self._clo)
+            np.take(self._cumsum, self.hi, out=self._chi)
+            np.subtract(self._chi, self._clo, out=self.values, where=self.band)
+        return self.values
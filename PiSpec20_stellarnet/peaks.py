@@ -0,0 +1,190 @@
+# Live peak analysis
+# Peaks are found in every displayed spectrum with whole-array NumPy operations:
+# local maxima are the candidates, and the prominence of all of them is taken at
+# once from a (candidates x window) matrix of the pixels on either side.  The
+# strongest peaks are refined to sub-pixel position and height with a parabola
+# through the top three pixels, and their full width at half prominence is read
+# off the same matrices.  The cost is bounded by the window, not by how far the
+# spectrum wanders, so it keeps up with the display on a Pi.  PeakTracker gives
+# peaks that stay put the same number from frame to frame (nearest neighbour
+# within a search window), and PeakLog writes them to CSV for drift and kinetics.
+
+import csv
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+PEAK = np.dtype([('index', '<i8'), ('wavelength', '<f8'), ('height', '<f8'), ('prominence', '<f8'), ('fwhm', '<f8')])
+
+
+class PeakFinder:
+    """
+    Peaks of a spectrum on the grid *wavelengths*.
+
+    Parameters
+    ----------
+    min_prominence : float
+        Peaks must stand out from their surroundings by this fraction of the
+        range (max - min) of the searched spectrum.
+    window : int
+        Pixels searched on each side of a peak for its prominence and width;
+        broader peaks get a smaller prominence and no width (NaN).
+    max_peaks : int
+        Only the most prominent peaks are kept.
+    """
+
+    def __init__(self, wavelengths, min_prominence=0.05, window=64, max_peaks=8):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.pixels = np.arange(len(self.wavelengths), dtype=float)
+        self.min_prominence = min_prominence
+        self.window = window
+        self.max_peaks = max_peaks
+        npix = len(self.wavelengths)
+        self._work = np.empty(npix)
+        self._nan = np.empty(npix, dtype=bool)
+        # the spectrum with +inf on both ends, which stops the searches at the edges like a higher peak would
+        self._padded = np.full(npix + 2 * window, np.inf)
+        self._cols = np.arange(window)
+
+    def find(self, ydata, lo=0, hi=None):
+        """Peaks in ydata[lo:hi] as a PEAK array in order of wavelength; index is the pixel in ydata."""
+        hi = len(ydata) if hi is None else hi
+        n = hi - lo
+        if n < 3:
+            return np.empty(0, dtype=PEAK)
+        y = self._work[:n]
+        np.copyto(y, ydata[lo:hi])
+        nan = np.isnan(y, out=self._nan[:n])
+        if nan.all():
+            return np.empty(0, dtype=PEAK)
+        if nan.any():
+            np.copyto(y, np.nanmin(y), where=nan)  # undefined absorbance is no peak, and no base either
+        center = y[1:-1]
+        candidates = np.flatnonzero((center > y[:-2]) & (center >= y[2:])) + 1
+        # no prominence can exceed the height above the lowest pixel: most noise maxima go before the windows are built
+        threshold = self.min_prominence * (y.max() - y.min())
+        candidates = candidates[y[candidates] - y.min() >= threshold]
+        if not len(candidates):
+            return np.empty(0, dtype=PEAK)
+        w = self.window
+        padded = self._padded[:n + 2 * w]
+        padded[w:w + n] = y
+        padded[w + n:] = np.inf  # a wider search before left its pixels here
+        windows = sliding_window_view(padded, w + 1)  # windows[i] = y[i - w .. i]
+        left = windows[candidates, ::-1][:, 1:]       # y[i - 1], y[i - 2], ... nearest first
+        right = windows[candidates + w, 1:]          # y[i + 1], y[i + 2], ...
+        heights = y[candidates]
+        prominence = heights - np.maximum(self._base(left, heights), self._base(right, heights))
+        keep = prominence >= threshold
+        if keep.sum() > self.max_peaks:
+            keep[keep] = False
+            keep[np.argpartition(prominence, -self.max_peaks)[-self.max_peaks:]] = True
+        candidates, prominence, left, right = candidates[keep], prominence[keep], left[keep], right[keep]
+
+        peaks = np.empty(len(candidates), dtype=PEAK)
+        # parabola through the top three pixels: vertex offset -0.5 .. 0.5 pixel and its height
+        ym1, y0, yp1 = y[candidates - 1], y[candidates], y[candidates + 1]
+        curvature = ym1 - 2 * y0 + yp1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(curvature < 0, 0.5 * (ym1 - yp1) / curvature, 0.0)
+        np.clip(delta, -0.5, 0.5, out=delta)
+        height = y0 - 0.25 * (ym1 - yp1) * delta
+        peaks['index'] = candidates + lo
+        peaks['wavelength'] = np.interp(candidates + lo + delta, self.pixels, self.wavelengths)
+        peaks['height'] = height
+        peaks['prominence'] = prominence
+        # full width at half prominence, between the interpolated crossings on both sides
+        level = height - prominence / 2
+        x0 = self._crossing(left, y0, level)
+        x1 = self._crossing(right, y0, level)
+        peaks['fwhm'] = np.interp(candidates + lo + x1, self.pixels, self.wavelengths) - \
+                        np.interp(candidates + lo - x0, self.pixels, self.wavelengths)
+        return peaks
+
+    def _base(self, rows, heights):
+        # lowest pixel before the first higher one (or the edge of the window) on one side of each candidate
+        higher = rows > heights[:, None]
+        stop = np.where(higher.any(axis=1), higher.argmax(axis=1), self.window)
+        return np.where(self._cols < stop[:, None], rows, np.inf).min(axis=1)
+
+    def _crossing(self, rows, top, level):
+        # pixels from the peak to where one side first drops to *level*, NaN if not within the window
+        below = rows <= level[:, None]
+        found = below.any(axis=1)
+        j = below.argmax(axis=1)
+        k = np.arange(len(rows))
+        before = np.where(j > 0, rows[k, np.maximum(j - 1, 0)], top)
+        after = rows[k, j]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.where(before > after, (before - level) / (before - after), 0.0)
+        return np.where(found, j + fraction, np.nan)
+
+
+class PeakTracker:
+    """
+    Numbers peaks consistently from frame to frame.
+
+    Each peak is matched to the nearest track within *search* nm of where that
+    track was last seen; a track missing for more than *hold* frames is dropped
+    and unmatched peaks start new tracks.
+    """
+
+    def __init__(self, search=2.0, hold=10):
+        self.search = search
+        self.hold = hold
+        self.ids = np.empty(0, dtype=np.int64)
+        self.positions = np.empty(0)
+        self.missed = np.empty(0, dtype=np.int64)
+        self.next_id = 1
+
+    def update(self, peaks):
+        """Track number of each peak in *peaks* (a PEAK array)."""
+        found = peaks['wavelength']
+        ids = np.zeros(len(found), dtype=np.int64)
+        matched = np.zeros(len(self.ids), dtype=bool)
+        if len(self.ids) and len(found):
+            distance = np.abs(self.positions[:, None] - found[None, :])
+            distance[distance > self.search] = np.inf
+            # closest pairs first, each track and each peak used once
+            for flat in np.argsort(distance, axis=None):
+                track, peak = divmod(int(flat), len(found))
+                if not np.isfinite(distance[track, peak]):
+                    break
+                if matched[track] or ids[peak]:
+                    continue
+                matched[track] = True
+                ids[peak] = self.ids[track]
+                self.positions[track] = found[peak]
+        self.missed[matched] = 0
+        self.missed[~matched] += 1
+        alive = self.missed <= self.hold
+        new = ids == 0
+        ids[new] = np.arange(self.next_id, self.next_id + new.sum())
+        self.next_id += int(new.sum())
+        self.ids = np.concatenate((self.ids[alive], ids[new]))
+        self.positions = np.concatenate((self.positions[alive], found[new]))
+        self.missed = np.concatenate((self.missed[alive], np.zeros(new.sum(), dtype=np.int64)))
+        return ids
+
+    def reset(self):
+        self.__init__(self.search, self.hold)
+
+
+class PeakLog:
+    """CSV of the tracked peaks of every analysed frame: one row per peak."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', newline='', buffering=1 << 16)  # written in blocks, not a line at a time
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['timestamp', 'seq', 'peak', 'wavelength (nm)', 'height', 'prominence', 'fwhm (nm)'])
+
+    def append(self, timestamp, seq, peaks, ids):
+        self.writer.writerows(zip([f"{timestamp:.6f}"] * len(peaks), [seq] * len(peaks), ids.tolist(),
+                                  [f"{value:.4f}" for value in peaks['wavelength']],
+                                  [f"{value:.6g}" for value in peaks['height']],
+                                  [f"{value:.6g}" for value in peaks['prominence']],
+                                  [f"{value:.4f}" for value in peaks['fwhm']]))
+
+    def close(self):
+        self.file.close()
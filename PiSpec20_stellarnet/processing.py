@@ -0,0 +1,77 @@
+# Per-frame spectrum processing: raw counts, transmittance and absorbance
+# Everything that only depends on the dark and incident references is computed once
+# when a reference is measured.  Each frame is then evaluated into preallocated
+# buffers with out= ufuncs, so the display loop allocates no arrays.
+
+import numpy as np
+
+# display modes, the values match App.DisplayCode
+RAW = 0
+ABSORBANCE = 1
+TRANSMITTANCE = 2
+
+
+class SpectrumProcessor:
+    """
+    Turns raw frames into the displayed spectrum.
+
+    Pixels where the sample or the reference is not above the dark level have no
+    defined transmittance or absorbance; they are set to NaN, which matplotlib
+    draws as a gap, instead of producing inf or divide warnings.
+    """
+
+    def __init__(self, npix):
+        self.dark = np.zeros(npix)      #dummy values set to zero
+        self.incident = np.ones(npix)   #dummy values to prevent error in Absorbance when no dark recorded
+        self.reference = np.empty(npix)        # incident - dark
+        self.log_reference = np.empty(npix)    # log10(incident - dark)
+        self.reference_ok = np.empty(npix, dtype=bool)
+        self.out = np.empty(npix)
+        self._ok = np.empty(npix, dtype=bool)
+        self._bad = np.empty(npix, dtype=bool)
+        self._update_reference()
+
+    def set_dark(self, ydata):
+        np.copyto(self.dark, ydata)
+        self._update_reference()
+
+    def set_incident(self, ydata):
+        np.copyto(self.incident, ydata)
+        self._update_reference()
+
+    def _update_reference(self):
+        np.subtract(self.incident, self.dark, out=self.reference)
+        np.greater(self.reference, 0, out=self.reference_ok)
+        self.log_reference.fill(np.nan)
+        np.log10(self.reference, out=self.log_reference, where=self.reference_ok)
+
+    def process(self, ydata, mode, out=None):
+        """Evaluate one frame in *mode* (RAW, ABSORBANCE or TRANSMITTANCE) into *out*, by default self.out which the next call overwrites."""
+        if out is None:
+            out = self.out
+        if mode == RAW:
+            np.copyto(out, ydata)
+            return out
+        np.subtract(ydata, self.dark, out=out)
+        np.greater(out, 0, out=self._ok)
+        np.logical_and(self._ok, self.reference_ok, out=self._ok)
+        if mode == ABSORBANCE:
+            # A = log10(I0 - dark) - log10(I - dark)
+            np.log10(out, out=out, where=self._ok)
+            np.subtract(self.log_reference, out, out=out, where=self._ok)
+        else:
+            np.divide(out, self.reference, out=out, where=self._ok)
+        np.logical_not(self._ok, out=self._bad)
+        np.copyto(out, np.nan, where=self._bad)
+        return out
+
+    def value_at(self, ydata, index, mode):
+        """A single pixel of process(), for frames that are logged but not drawn."""
+        if mode == RAW:
+            return float(ydata[index])
+        signal = ydata[index] - self.dark[index]
+        if signal <= 0 or not self.reference_ok[index]:
+            return np.nan
+        if mode == ABSORBANCE:
+            return float(self.log_reference[index] - np.log10(signal))
+        return float(signal / self.reference[index])
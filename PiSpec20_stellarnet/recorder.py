@@ -0,0 +1,259 @@
+# Continuous spectrum recorder
+# Every acquired frame is recorded with its integration time, averages and the dark
+# and incident references in use, in a chunked binary file.  Frames are collected
+# into preallocated chunk buffers; full chunks go through a bounded queue to a
+# writer thread, so the SD card is never written from the display/acquisition path.
+# If the card cannot keep up, chunks are dropped (and counted) rather than stalling.
+#
+# File layout (little endian, every block padded to 8 bytes):
+#   b'PSREC001', uint64 length, JSON metadata
+#   chunks:  tag(4s) codec(u4) count(u4) npix(u4) raw_size(u8) stored_size(u8), payload
+#     b'WAVE'  float64[npix]               wavelengths
+#     b'REFS'  float64[2, npix]            dark and incident, count = reference number
+#     b'FRMS'  FRAME_META[count] + float32[count, npix]   frames
+# A recording cut short by a crash can be read up to its last complete chunk.
+
+import mmap
+import json
+import zlib
+import queue
+import struct
+import threading
+
+import numpy as np
+
+MAGIC = b'PSREC001'
+CHUNK = struct.Struct('<4sIIIQQ')
+RAW, ZLIB = 0, 1  # chunk codecs
+FRAME_META = np.dtype([('seq', '<i8'), ('timestamp', '<f8'), ('int_time', '<i4'), ('averages', '<i4'),
+                       ('reference', '<i4'), ('reserved', '<i4')])  # 32 bytes keeps the spectra 8 byte aligned
+
+
+def _padding(n):
+    return -n % 8
+
+
+class SpectrumRecorder:
+    """
+    Record frames to *path* through a background writer thread.
+
+    Parameters
+    ----------
+    wavelengths : array
+        Wavelength of each pixel.
+    chunk_frames : int
+        Frames per chunk written to disk.
+    compress : bool
+        zlib compress chunks (smaller files, more CPU on the writer thread).
+    queue_chunks : int
+        Full chunks that may wait for the writer before new ones are dropped.
+    metadata : dict
+        Extra information kept in the file header (model, display mode, ...).
+    """
+
+    def __init__(self, path, wavelengths, chunk_frames=64, compress=False, queue_chunks=8, metadata=None):
+        self.path = path
+        self.npix = len(wavelengths)
+        self.chunk_frames = chunk_frames
+        self.codec = ZLIB if compress else RAW
+        self.frames = 0       # frames accepted, or missed
+        self.dropped = 0      # frames lost because the writer fell behind, or missed
+        self.error = None
+        self.reference = -1
+        self.queue = queue.Queue(maxsize=queue_chunks)
+        # chunk buffers are reused: the writer hands them back through the free list
+        self.free = queue.Queue()
+        for i in range(queue_chunks + 2):
+            self.free.put((np.zeros(chunk_frames, dtype=FRAME_META), np.empty((chunk_frames, self.npix), dtype=np.float32)))
+        self.meta, self.data = self.free.get()
+        self.count = 0
+        self.file = open(path, 'wb')
+        header = dict(metadata or {})
+        header['npix'] = self.npix
+        header['compression'] = 'zlib' if compress else 'none'
+        text = json.dumps(header).encode()
+        self.file.write(MAGIC + struct.pack('<Q', len(text)) + text + b'\0' * _padding(len(text)))
+        self._put(b'WAVE', 0, np.asarray(wavelengths, dtype='<f8'))
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def set_references(self, dark, incident):
+        """Store new dark/incident references; frames added from now on refer to them."""
+        self.reference += 1
+        self._flush_chunk()  # frames already collected belong to the previous reference
+        self._put(b'REFS', self.reference, np.array([dark, incident], dtype='<f8'))
+
+    def add(self, frame):
+        """Add one Frame (see acquisition.Frame); the spectrum is copied, nothing is written here."""
+        meta = self.meta[self.count]
+        meta['seq'] = frame.seq
+        meta['timestamp'] = frame.timestamp
+        meta['int_time'] = frame.int_time
+        meta['averages'] = frame.averages
+        meta['reference'] = self.reference
+        self.data[self.count] = frame.ydata
+        self.count += 1
+        self.frames += 1
+        if self.count == self.chunk_frames:
+            self._flush_chunk()
+
+    def missed(self, count):
+        """Count *count* frames that never reached add() (overwritten before they were taken) as dropped."""
+        self.frames += count
+        self.dropped += count
+
+    def _flush_chunk(self):
+        if self.count == 0:
+            return
+        try:
+            self.queue.put_nowait((b'FRMS', self.count, (self.meta, self.data)))
+        except queue.Full:
+            self.dropped += self.count
+            self.count = 0
+            return
+        self.count = 0
+        self.meta, self.data = self.free.get()  # blocks only if every buffer is queued, which the queue size prevents
+
+    def _put(self, tag, count, array):
+        # small blocks (wavelengths, references) must not be dropped, so wait for room
+        self.queue.put((tag, count, array))
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            tag, count, payload = item
+            try:
+                if self.error is not None:
+                    pass  # nothing more goes into a file that failed (e.g. a full card), see error
+                elif tag == b'FRMS':
+                    meta, data = payload
+                    self._write_chunk(tag, count, [meta[:count], data[:count]])
+                else:
+                    self._write_chunk(tag, count, [payload])
+            except Exception as err:  # keep draining so the producer never blocks
+                self.error = err
+            finally:
+                if tag == b'FRMS':
+                    self.free.put(payload)
+
+    def _write_chunk(self, tag, count, parts):
+        raw_size = sum(part.nbytes for part in parts)
+        if self.codec == ZLIB:
+            compressor = zlib.compressobj(1)
+            parts = [b''.join([compressor.compress(part) for part in parts] + [compressor.flush()])]
+            stored_size = len(parts[0])
+        else:
+            stored_size = raw_size  # the arrays are written straight from the chunk buffers
+        self.file.write(CHUNK.pack(tag, self.codec, count, self.npix, raw_size, stored_size))
+        for part in parts:
+            self.file.write(part)
+        self.file.write(b'\0' * _padding(stored_size))
+
+    def close(self):
+        self._flush_chunk()
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.file.close()
+        except OSError as err:
+            self.error = self.error or err
+        if self.error is not None:
+            raise self.error
+
+
+class Recording:
+    """
+    Read a recording.  Uncompressed chunks are memory-mapped, so a recording much
+    larger than RAM can be analysed; compressed chunks are decompressed on access.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:8] != MAGIC:
+            raise ValueError(path + " is not a spectrum recording")
+        length = struct.unpack_from('<Q', self.mm, 8)[0]
+        self.metadata = json.loads(bytes(self.mm[16:16 + length]).decode())
+        self.npix = self.metadata['npix']
+        self.wavelengths = None
+        self.references = []   # (dark, incident) by reference number
+        self.chunks = []       # (first frame, count, codec, offset, stored_size)
+        self.frame_starts = []
+        frames = 0
+        offset = 16 + length + _padding(length)
+        size = len(self.mm)
+        while offset + CHUNK.size <= size:
+            tag, codec, count, npix, raw_size, stored_size = CHUNK.unpack_from(self.mm, offset)
+            start = offset + CHUNK.size
+            if start + stored_size > size:
+                break  # incomplete last chunk
+            if tag == b'FRMS':
+                self.chunks.append((frames, count, codec, start, stored_size))
+                self.frame_starts.append(frames)
+                frames += count
+            elif tag == b'WAVE':
+                self.wavelengths = self._array(codec, start, stored_size, '<f8', (npix,))
+            elif tag == b'REFS':
+                refs = self._array(codec, start, stored_size, '<f8', (2, npix))
+                self.references.append((refs[0], refs[1]))
+            offset = start + stored_size + _padding(stored_size)
+        self.nframes = frames
+
+    def _payload(self, codec, start, stored_size):
+        if codec == ZLIB:
+            return zlib.decompress(self.mm[start:start + stored_size])
+        return memoryview(self.mm)[start:start + stored_size]
+
+    def _array(self, codec, start, stored_size, dtype, shape):
+        return np.frombuffer(self._payload(codec, start, stored_size), dtype=dtype).reshape(shape)
+
+    def __len__(self):
+        return self.nframes
+
+    def chunk(self, k):
+        """(meta, spectra) of chunk *k*; views into the file for uncompressed recordings."""
+        first, count, codec, start, stored_size = self.chunks[k]
+        payload = self._payload(codec, start, stored_size)
+        meta = np.frombuffer(payload, dtype=FRAME_META, count=count)
+        spectra = np.frombuffer(payload, dtype='<f4', offset=count * FRAME_META.itemsize).reshape(count, self.npix)
+        return meta, spectra
+
+    def frame(self, i):
+        """(meta, spectrum) of frame *i*."""
+        if not 0 <= i < self.nframes:
+            raise IndexError(i)
+        k = int(np.searchsorted(self.frame_starts, i, side='right')) - 1
+        meta, spectra = self.chunk(k)
+        j = i - self.chunks[k][0]
+        return meta[j], spectra[j]
+
+    def __iter__(self):
+        for k in range(len(self.chunks)):
+            meta, spectra = self.chunk(k)
+            for j in range(len(meta)):
+                yield meta[j], spectra[j]
+
+    def read(self, start=0, stop=None):
+        """Frames start..stop as (meta, spectra) arrays, copied into memory."""
+        stop = self.nframes if stop is None else min(stop, self.nframes)
+        meta = np.empty(max(stop - start, 0), dtype=FRAME_META)
+        spectra = np.empty((len(meta), self.npix), dtype=np.float32)
+        for k, (first, count, codec, offset, stored_size) in enumerate(self.chunks):
+            lo, hi = max(start, first), min(stop, first + count)
+            if lo < hi:
+                m, s = self.chunk(k)
+                meta[lo - start:hi - start] = m[lo - first:hi - first]
+                spectra[lo - start:hi - start] = s[lo - first:hi - first]
+        return meta, spectra
+
+    def close(self):
+        self.wavelengths = None
+        self.references = []
+        try:
+            self.mm.close()
+        except BufferError:
+            pass  # arrays handed out still use the map, it is released with them
+        self.file.close()
@@ -0,0 +1,286 @@
+# Replay of recorded sessions
+# A recording (recorder.SpectrumRecorder) or a directory of spectra saved with the
+# Save button is played back through the same frame interface as the acquisition
+# engine (latest, latest_seq, frame, wait_frame, ...), so the display, absorbance,
+# monitors, kinetics log and recorder run on it unchanged.  Frames are released
+# into a local FrameRing as the replay clock reaches them: at the recorded pace,
+# a multiple of it, or as fast as the consumer takes them.  The consumer calls
+# acknowledge() with the last frame it has dealt with; no frame is released that
+# would overwrite one it has not, so a consumer that falls behind (or is paused)
+# holds the replay up instead of losing frames.  A background thread
+# reads (and decompresses or parses) blocks of frames ahead into a bounded queue,
+# so the display never waits on the disk and a session larger than memory can be
+# replayed.
+#
+#   python3 stellarnet_spec.py --replay session.psr --speed 10
+#   python3 stellarnet_spec.py --replay runs/ --speed max
+
+import os
+import glob
+import time
+import queue
+import threading
+
+import numpy as np
+
+from acquisition import FrameRing
+from recorder import Recording
+from processing import RAW
+
+MAX = None  # speed: release frames as fast as they are consumed
+
+
+def parse_speed(text):
+    """Replay speed from the command line: a multiple of the recorded pace, or 'max'."""
+    if text == 'max':
+        return MAX
+    speed = float(text)
+    if speed <= 0:
+        raise ValueError("the replay speed must be above 0")
+    return speed
+
+
+class ReplaySource:
+    """
+    Frames of a recording or a directory of saved spectra, offered like a MultiAcquisition.
+
+    Parameters
+    ----------
+    path : str
+        Recording file, or a directory of spectra saved with the Save button (raw counts).
+    speed : float or None
+        1 replays at the recorded pace, 10 ten times faster, MAX (None) as fast as possible.
+    loop : bool
+        Start over at the end instead of stopping.
+    block : int
+        Frames per block read ahead by the prefetch thread.
+    prefetch : int
+        Blocks that may wait in memory.
+    max_gap : float
+        Pauses in the recording longer than this (s) are shortened to it.
+    nslots : int
+        Frames held in the ring buffer.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False, block=64, prefetch=4, max_gap=2.0, nslots=32):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.block = block
+        self.max_gap = max_gap
+        self.recording = None
+        if os.path.isdir(path):
+            from batch import read_spectrum  # the parser of saved spectra
+            self.read_spectrum = read_spectrum
+            self.files = sorted(glob.glob(os.path.join(path, '*.txt')))
+            if not self.files:
+                raise RuntimeError("No saved spectra in " + path)
+            try:
+                self.wavelengths = self.read_spectrum(self.files[0])[0]
+            except (OSError, ValueError) as err:
+                raise RuntimeError(str(err))
+            self.references = []
+            self.model = "Replay of " + os.path.basename(os.path.normpath(path))
+            self.nframes = len(self.files)
+        else:
+            try:
+                self.recording = Recording(path)
+            except (OSError, ValueError, KeyError) as err:
+                raise RuntimeError("Cannot replay " + path + " (" + str(err) + ")")
+            if self.recording.wavelengths is None or not len(self.recording):
+                self.recording.close()
+                raise RuntimeError(path + " holds no frames")
+            self.wavelengths = np.array(self.recording.wavelengths)
+            self.references = self.recording.references  # (dark, incident) by reference number
+            self.model = "Replay of " + self.recording.metadata.get('model', os.path.basename(path))
+            self.nframes = len(self.recording)
+        self.engines = [self]  # a single "device", as far as the settings menus are concerned
+        self.int_time = 0
+        self.averages = 0
+        self.error = None
+        self.finished = False
+        self.skipped = 0  # saved spectra that were not raw counts or had another wavelength grid
+        self.config_pending = False
+        self.ring = FrameRing(len(self.wavelengths), nslots)
+        self.acked = 0  # last frame the consumer has dealt with, see acknowledge()
+        self.refnums = np.full(nslots, -1, dtype=np.int64)  # reference number of the frame in each ring slot
+        self.current = None  # block being released: (timestamps, int_times, averages, references, spectra)
+        self.index = 0       # next frame of the current block
+        self.last_time = None  # recorded time of the last frame released
+        self.due = time.monotonic()  # when the next frame is released
+        self.scheduled = False  # self.due is already that of the next frame
+        self.blocks = queue.Queue(maxsize=prefetch)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._prefetch, daemon=True)
+        self.thread.start()
+
+    ## prefetch thread
+    def _prefetch(self):
+        try:
+            while not self.stopping.is_set():
+                blocks = self._recording_blocks() if self.recording is not None else self._directory_blocks()
+                for block in blocks:
+                    if not self._offer(block):
+                        return
+                if not self.loop:
+                    break
+        except Exception as err:  # handed to the consumer, which reports it like an acquisition error
+            self._offer(err)
+            return
+        self._offer(None)  # end of the replay
+
+    def _offer(self, item):
+        # waits for room in the queue, but gives up when the replay is stopped
+        while not self.stopping.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _recording_blocks(self):
+        for start in range(0, self.nframes, self.block):
+            meta, spectra = self.recording.read(start, start + self.block)  # copied out of the map (and decompressed)
+            yield (meta['timestamp'], meta['int_time'], meta['averages'], meta['reference'], spectra)
+
+    def _directory_blocks(self):
+        npix = len(self.wavelengths)
+        for start in range(0, self.nframes, self.block):
+            paths = self.files[start:start + self.block]
+            spectra = np.empty((len(paths), npix))
+            timestamps = np.empty(len(paths))
+            count = 0
+            for path in paths:
+                try:
+                    x, y, mode = self.read_spectrum(path)
+                    timestamps[count] = os.path.getmtime(path)
+                except (OSError, ValueError):
+                    mode, x = None, ()
+                if mode != RAW or len(x) != npix:
+                    self.skipped += 1  # absorbance files cannot go through the processing again
+                    continue
+                spectra[count] = y
+                count += 1
+            if count:
+                zeros = np.zeros(count, dtype=np.int64)  # integration time and averages are not saved
+                yield (timestamps[:count], zeros, zeros, zeros - 1, spectra[:count])
+
+    ## consumer side
+    def _advance(self):
+        """Release the frames that are due into the ring buffer."""
+        if self.finished:
+            return
+        now = time.monotonic()
+        # the slot of a new frame holds the one nslots before it, which must already be dealt with
+        while self.ring.latest_seq() + 1 - self.acked < self.ring.nslots:
+            if self.current is None:
+                try:
+                    item = self.blocks.get_nowait()
+                except queue.Empty:
+                    return  # the prefetch thread is behind, the frames come on a later call
+                if item is None or isinstance(item, Exception):
+                    self.finished = True
+                    if item is not None:
+                        self.error = str(item)
+                    return
+                self.current, self.index = item, 0
+            timestamps, int_times, averages, references, spectra = self.current
+            i = self.index
+            if self.speed is not MAX:
+                if not self.scheduled:
+                    if self.last_time is not None:
+                        gap = min(max(timestamps[i] - self.last_time, 0.0), self.max_gap)
+                        self.due = max(self.due + gap / self.speed, now - self.max_gap)  # a slow consumer does not build up a backlog
+                    self.scheduled = True
+                if self.due > now:
+                    return
+            self.last_time = timestamps[i]
+            self.scheduled = False
+            seq, slot = self.ring.begin_write()
+            np.copyto(slot, spectra[i])
+            self.refnums[seq % self.ring.nslots] = references[i]
+            self.int_time = int(int_times[i])
+            self.averages = int(averages[i])
+            # stamped with the time it is released, like a frame fresh from the spectrometer
+            self.ring.commit(seq, time.time(), self.int_time, self.averages)
+            self.index += 1
+            if self.index == len(timestamps):
+                self.current = None
+
+    def acknowledge(self, seq):
+        """The consumer is done with every frame up to *seq*; frames after it are never overwritten before that."""
+        self.acked = max(self.acked, seq)
+
+    def latest(self):
+        self._advance()
+        return self.ring.latest()
+
+    def latest_seq(self):
+        self._advance()
+        return self.ring.latest_seq()
+
+    def frame(self, seq):
+        return self.ring.frame(seq)
+
+    def read(self, seq, out):
+        return self.ring.read(seq, out)
+
+    def reference(self, seq):
+        """(dark, incident) recorded with frame *seq*, or None."""
+        number = self.refnums[seq % self.ring.nslots]
+        if not self.ring.is_valid(seq) or not 0 <= number < len(self.references):
+            return None
+        return self.references[number]
+
+    def wait_frame(self, min_seq, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            frame = self.latest()
+            if frame is not None and frame.seq >= min_seq:
+                return frame
+            if self.error is not None:
+                raise RuntimeError(self.error)
+            if self.finished and self.current is None:
+                raise RuntimeError("End of the replay")
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(0.002)
+
+    def set_config(self, int_time, averages, device=0):
+        # recorded frames keep their settings; poll() "reads back" the recorded ones
+        self.config_pending = True
+
+    def poll(self):
+        changed, self.config_pending = self.config_pending, False
+        return changed
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        if self.recording is not None:
+            self.recording.close()
+            self.recording = None
+
+
+class ReplayStartup:
+    """Stand-in for acquisition.AcquisitionStartup: poll() returns the ReplaySource."""
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.result = None
+
+    def poll(self, timeout=0):
+        """ReplaySource; RuntimeError if the path cannot be replayed."""
+        if self.result is None:
+            self.result = ReplaySource(self.path, self.speed, self.loop)
+        return self.result
+
+    def stop(self):
+        if self.result is not None:
+            self.result.stop()
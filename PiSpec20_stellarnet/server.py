@@ -0,0 +1,260 @@
+# Headless acquisition server
+# Runs the acquisition engine without Tk or matplotlib and streams frames to any
+# number of clients over TCP (or a Unix socket), e.g. student laptops watching one
+# instrument.  Every frame acquired is sent to every client.  Each client has a
+# mailbox of the last BACKLOG frames: a client that falls further behind loses the
+# oldest ones, for it alone, so it never holds up the spectrometer or the other clients.
+#
+#   python3 server.py --host 0.0.0.0 --port 8765            (add --simulate to run without hardware)
+#
+# Messages in both directions are  tag (4 bytes) + length (uint32, little endian) + payload
+#   server -> client
+#     b'INFO'  JSON: model, wavelengths, settings, display mode, monitor wavelength
+#     b'FRAM'  FRAME_HEADER (seq, timestamp, int_time, averages, mode, monitor value) + float32[npix]
+#              a gap in seq means frames were dropped: for this client, or for all when the server fell behind the ring buffer
+#     b'REPL'  JSON reply to a command, {"ok": true/false, ...}
+#     b'EROR'  JSON {"error": ...}: the acquisition stopped, the server closes the connection and exits
+#   client -> server
+#     b'CMND'  JSON command, one of
+#       {"cmd": "config", "int_time": 100, "averages": 1, "device": 0}   (like setconfig)
+#       {"cmd": "dark", "frames": 1}   {"cmd": "incident", "frames": 1}   (like getdark/getincident)
+#       {"cmd": "monitor", "wavelength": 520.0}
+#       {"cmd": "mode", "mode": "raw" | "absorbance" | "transmittance"}
+
+import json
+import signal
+import collections
+import struct
+import asyncio
+import argparse
+
+import numpy as np
+
+from acquisition import start_acquisition
+from processing import SpectrumProcessor, RAW, ABSORBANCE, TRANSMITTANCE
+from stats import WelfordStats
+
+MESSAGE = struct.Struct('<4sI')
+FRAME_HEADER = struct.Struct('<qdiiid')
+MODES = {'raw': RAW, 'absorbance': ABSORBANCE, 'transmittance': TRANSMITTANCE}
+BACKLOG = 64  # frames waiting for a client before its oldest are dropped
+
+
+def pack(tag, payload):
+    return MESSAGE.pack(tag, len(payload)) + payload
+
+
+async def read_message(reader):
+    """(tag, payload) of the next message; raises asyncio.IncompleteReadError when the peer closed."""
+    tag, length = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+    return tag, await reader.readexactly(length)
+
+
+def unpack_frame(payload):
+    """(header dict, float32 spectrum) of a b'FRAM' payload."""
+    seq, timestamp, int_time, averages, mode, monitor = FRAME_HEADER.unpack_from(payload)
+    spectrum = np.frombuffer(payload, dtype='<f4', offset=FRAME_HEADER.size)
+    return {'seq': seq, 'timestamp': timestamp, 'int_time': int_time, 'averages': averages,
+            'mode': mode, 'monitor': monitor}, spectrum
+
+
+class Subscriber:
+    # one connected client: new frames wait in a bounded queue until the client's writer takes them
+    def __init__(self, writer, backlog=BACKLOG):
+        self.writer = writer
+        self.pending = collections.deque(maxlen=backlog)
+        self.ready = asyncio.Event()
+        self.last = False
+
+    def offer(self, message, last=False):
+        self.pending.append(message)  # pushes out the oldest frame once the client is backlog frames behind
+        self.last = last
+        self.ready.set()
+
+    async def send_frames(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            messages = b''.join(self.pending)
+            self.pending.clear()
+            self.writer.write(messages)
+            if self.last:
+                self.writer.close()  # the client sees the end of the stream once it has read the message
+                return
+            await self.writer.drain()  # only this client's task waits on a slow connection
+
+
+class SpectrometerServer:
+    """Acquisition loop plus frame fan-out and remote commands."""
+
+    def __init__(self, engine, poll_interval=0.005):
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.wavelengths = engine.wavelengths
+        self.processor = SpectrumProcessor(len(self.wavelengths))
+        self.mode = RAW
+        self.monitorindex = len(self.wavelengths) // 2
+        self.subscribers = set()
+        self.captures = []  # reference captures in progress: (setreference, stats, frames, first seq, future)
+        self.spectrum = np.empty(len(self.wavelengths), dtype='<f4')
+        self.raw = np.empty(len(self.wavelengths))  # each frame is copied out of the ring before it is used
+        self.lastseq = engine.latest_seq()  # frames from here on are published
+        self.error = None
+
+    def info(self):
+        return {'model': self.engine.model, 'wavelengths': self.wavelengths.tolist(),
+                'int_time': [engine.int_time for engine in self.engine.engines],
+                'averages': [engine.averages for engine in self.engine.engines],
+                'mode': self.mode, 'monitorwave': float(self.wavelengths[self.monitorindex])}
+
+    async def acquire(self):
+        """Publish every new frame to every subscriber; returns when the acquisition has stopped."""
+        while True:
+            upto = self.engine.latest_seq()
+            self.engine.poll()
+            if self.engine.error is not None:
+                self.fail(self.engine.error)
+                return
+            for seq in range(self.lastseq + 1, upto + 1):
+                frame = self.engine.read(seq, self.raw)
+                if frame is None:
+                    continue  # overwritten before the server got to it, a gap in seq for every client
+                if self.captures:
+                    self.feed_captures(frame)
+                self.publish(frame)
+            self.lastseq = max(self.lastseq, upto)
+            await asyncio.sleep(self.poll_interval)
+
+    def publish(self, frame):
+        ydata = self.processor.process(frame.ydata, self.mode)
+        self.spectrum[:] = ydata
+        # packed once, the same bytes go to every client
+        header = FRAME_HEADER.pack(frame.seq, frame.timestamp, frame.int_time, frame.averages, self.mode,
+                                   float(ydata[self.monitorindex]))
+        message = pack(b'FRAM', header + self.spectrum.tobytes())
+        for subscriber in self.subscribers:
+            subscriber.offer(message)
+
+    def feed_captures(self, frame):
+        for setreference, stats, frames, first, future in self.captures:
+            if frame.seq >= first and stats.count < frames:
+                stats.update(frame.ydata)
+        for capture in list(self.captures):
+            setreference, stats, frames, first, future = capture
+            if stats.count >= frames:
+                setreference(stats.mean)
+                self.captures.remove(capture)
+                future.set_result(stats.count)
+
+    def fail(self, error):
+        # captures waiting for frames that will never come get the error as their reply, then every client is told
+        self.error = error
+        for setreference, stats, frames, first, future in self.captures:
+            if not future.done():
+                future.set_exception(RuntimeError(error))
+        self.captures = []
+        message = pack(b'EROR', json.dumps({'error': error}).encode())
+        for subscriber in self.subscribers:
+            subscriber.offer(message, last=True)
+
+    async def command(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'config':
+            device = int(request.get('device', 0))
+            engine = self.engine.engines[device]
+            int_time = int(request.get('int_time', engine.int_time))
+            averages = int(request.get('averages', engine.averages))
+            if not 3 <= int_time <= 65000 or averages < 1:
+                return {'ok': False, 'error': "integration time must be 3 to 65000 ms and averages at least 1"}
+            self.engine.set_config(int_time, averages, device)
+            # the acquisition in progress finishes first, so allow for the old integration time
+            timeout = (engine.int_time * engine.averages) / 1000.0 + 5
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while (engine.int_time, engine.averages) != (int_time, averages) and loop.time() < deadline:
+                self.engine.poll()
+                if self.engine.error is not None:
+                    raise RuntimeError(self.engine.error)
+                await asyncio.sleep(0.01)
+            return {'ok': True, 'int_time': engine.int_time, 'averages': engine.averages, 'device': device}
+        elif cmd in ('dark', 'incident'):
+            frames = max(int(request.get('frames', 1)), 1)
+            setreference = self.processor.set_dark if cmd == 'dark' else self.processor.set_incident
+            future = asyncio.get_running_loop().create_future()
+            # frames whose acquisition starts after the command
+            self.captures.append((setreference, WelfordStats(len(self.wavelengths)), frames,
+                                  self.engine.latest_seq() + 2, future))
+            return {'ok': True, 'reference': cmd, 'frames': await future}
+        elif cmd == 'monitor':
+            wavelength = float(request['wavelength'])
+            if not self.wavelengths[0] <= wavelength <= self.wavelengths[-1]:
+                return {'ok': False, 'error': "monitored wavelength must be within the detected range"}
+            self.monitorindex = int(np.searchsorted(self.wavelengths, wavelength, side='left'))
+            return {'ok': True, 'monitorwave': float(self.wavelengths[self.monitorindex])}
+        elif cmd == 'mode':
+            if request.get('mode') not in MODES:
+                return {'ok': False, 'error': "mode must be one of " + ", ".join(MODES)}
+            self.mode = MODES[request['mode']]
+            return {'ok': True, 'mode': self.mode}
+        return {'ok': False, 'error': "unknown command " + repr(cmd)}
+
+    async def handle_client(self, reader, writer):
+        subscriber = Subscriber(writer)
+        writer.write(pack(b'INFO', json.dumps(self.info()).encode()))
+        self.subscribers.add(subscriber)
+        sender = asyncio.ensure_future(subscriber.send_frames())
+        try:
+            while True:
+                tag, payload = await read_message(reader)
+                if tag != b'CMND':
+                    continue
+                try:
+                    reply = await self.command(json.loads(payload.decode()))
+                except (ValueError, KeyError, IndexError, TypeError, RuntimeError) as err:
+                    reply = {'ok': False, 'error': str(err)}
+                # replies bypass the frame mailbox, they must never be dropped
+                writer.write(pack(b'REPL', json.dumps(reply).encode()))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            sender.cancel()
+            writer.close()
+
+
+async def serve(engine, host='127.0.0.1', port=8765, unix=None):
+    server = SpectrometerServer(engine)
+    if unix:
+        listener = await asyncio.start_unix_server(server.handle_client, path=unix)
+    else:
+        listener = await asyncio.start_server(server.handle_client, host, port)
+    acquire = asyncio.ensure_future(server.acquire())
+    try:
+        async with listener:
+            await acquire  # clients are served until the acquisition stops
+    finally:
+        acquire.cancel()
+    return server.error
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless StellarNet acquisition server")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on, 0.0.0.0 for every network interface")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help="listen on this Unix socket path instead of TCP")
+    parser.add_argument('--simulate', action='store_true', help="use the simulated spectrometer instead of the StellarNet driver")
+    args = parser.parse_args()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # stop cleanly as a service too
+    engine = start_acquisition('simulated' if args.simulate else 'stellarnet')
+    try:
+        error = asyncio.run(serve(engine, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        error = None
+    finally:
+        engine.stop()
+    if error is not None:
+        raise SystemExit("Acquisition stopped: " + error)  # non-zero exit, so a service manager restarts it
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# Simulated stand-in for stellarnet_driverLibs.stellarnet_driver3
+# Provides the calls used by this project (array_get_spec_only, getSpectrum_X,
+# getSpectrum_Y, setParam and the device get_config/set_config) so the interface,
+# benchmarks and the acquisition engine can run without a spectrometer attached.
+# Settings can be changed with configure() or with PISPEC_SIM_* environment
+# variables, which are also seen by the acquisition process.
+
+import os
+import time
+
+import numpy as np
+
+settings = {
+    'pixels': int(os.environ.get('PISPEC_SIM_PIXELS', 2048)),
+    'devices': int(os.environ.get('PISPEC_SIM_DEVICES', 1)),
+    'latency': float(os.environ.get('PISPEC_SIM_LATENCY', 1.0)),  # fraction of IntTime x Averages actually waited
+    'noise': float(os.environ.get('PISPEC_SIM_NOISE', 1.0)),      # scales the shot and read noise
+    'saturation': float(os.environ.get('PISPEC_SIM_SATURATION', 65535)),
+    'counts_per_ms': float(os.environ.get('PISPEC_SIM_COUNTS_PER_MS', 1500)),  # lamp peak counts per ms of integration
+}
+
+MODEL = 'Simulated BLACK-Comet'
+
+
+def configure(**kwargs):
+    """Change simulator settings (pixels, devices, latency, noise, saturation, counts_per_ms)."""
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError(key)
+        settings[key] = value
+
+
+class SimulatedDevice:
+    def __init__(self, index):
+        self.index = index
+        self.config = {'model': MODEL, 'device_id': 'SIM%d' % index, 'int_time': 20, 'scans_to_avg': 1,
+                       'x_smooth': 0, 'x_timing': 1}
+        npix = settings['pixels']
+        # second and later devices cover the NIR so benches with two units can be simulated
+        if index == 0:
+            self.wavelengths = np.linspace(280.0, 900.0, npix)
+        else:
+            self.wavelengths = np.linspace(900.0, 1700.0, npix)
+        # tungsten halogen lamp (Planck curve at 3000 K) with two absorption bands, peak normalised to 1
+        wl = self.wavelengths * 1e-9
+        lamp = 1.0 / (wl ** 5 * (np.exp(1.4388e-2 / (wl * 3000.0)) - 1.0))
+        lamp /= lamp.max()
+        bands = 1.0 - 0.5 * np.exp(-0.5 * ((self.wavelengths - 520.0) / 15.0) ** 2) \
+                    - 0.3 * np.exp(-0.5 * ((self.wavelengths - 1200.0) / 30.0) ** 2)
+        self.shape = lamp * bands
+        self.dark = 800.0 + 50.0 * np.sin(np.arange(npix) / 37.0)  # fixed pattern dark counts
+        self.rng = np.random.default_rng(index)
+
+    def get_config(self):
+        return dict(self.config)
+
+    def set_config(self, **kwargs):
+        self.config.update(kwargs)
+
+    def spectrum(self):
+        int_time = self.config['int_time']
+        averages = max(1, int(self.config['scans_to_avg']))
+        if settings['latency'] > 0:
+            time.sleep(settings['latency'] * int_time * averages / 1000.0)
+        signal = self.shape * settings['counts_per_ms'] * int_time
+        noise = settings['noise'] * (np.sqrt(signal) + 10.0) / np.sqrt(averages)
+        counts = self.dark + signal + noise * self.rng.standard_normal(signal.shape)
+        np.clip(counts, 0.0, settings['saturation'], out=counts)
+        return counts
+
+
+## start stellarnet_driver3 compatible calls
+def array_get_spec_only(index=0):
+    if index >= settings['devices']:
+        raise RuntimeError("No simulated spectrometer with index " + str(index))
+    return {'device': SimulatedDevice(index)}
+
+
+def getSpectrum_X(spectrometer):
+    return spectrometer['device'].wavelengths.copy()
+
+
+def getSpectrum_Y(spectrometer):
+    return spectrometer['device'].spectrum()
+
+
+def setParam(spectrometer, int_time, scans_to_avg, x_smooth, x_timing, clear=True):
+    device = spectrometer['device']
+    device.set_config(int_time=int_time, scans_to_avg=scans_to_avg, x_smooth=x_smooth, x_timing=x_timing)
+    if clear:
+        device.spectrum()  # the real driver throws out one acquisition to get the settings in place
+## end stellarnet_driver3 compatible calls
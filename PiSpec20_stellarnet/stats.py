@@ -0,0 +1,124 @@
+# Streaming per-pixel statistics over frames
+# All updates are done in place in preallocated buffers and cost O(pixels) per
+# frame, however long the averaging window is.
+#   BoxcarAverage        mean and noise of the last N frames (running sums)
+#   ExponentialAverage   exponential moving average and exponentially weighted variance
+#   WelfordStats         mean and variance of every frame given, e.g. for references
+
+import numpy as np
+
+
+class BoxcarAverage:
+    """Mean and per-pixel standard deviation of the last *window* frames."""
+
+    def __init__(self, npix, window):
+        self.window = max(int(window), 1)
+        self.frames = np.zeros((self.window, npix))
+        self.sum = np.zeros(npix)
+        self.sumsq = np.zeros(npix)
+        self.mean = np.zeros(npix)
+        self._scratch = np.empty(npix)
+        self.count = 0
+        self.index = 0
+
+    def update(self, ydata):
+        """Add a frame, drop the oldest once the window is full; returns the mean."""
+        oldest = self.frames[self.index]
+        if self.count == self.window:
+            np.subtract(self.sum, oldest, out=self.sum)
+            np.multiply(oldest, oldest, out=self._scratch)
+            np.subtract(self.sumsq, self._scratch, out=self.sumsq)
+        else:
+            self.count += 1
+        np.copyto(oldest, ydata)
+        np.add(self.sum, oldest, out=self.sum)
+        np.multiply(oldest, oldest, out=self._scratch)
+        np.add(self.sumsq, self._scratch, out=self.sumsq)
+        self.index = (self.index + 1) % self.window
+        np.divide(self.sum, self.count, out=self.mean)
+        return self.mean
+
+    @property
+    def effective_frames(self):
+        return max(self.count, 1)
+
+    def std(self, out):
+        """Per-pixel standard deviation of single frames in the window, written to *out*."""
+        np.divide(self.sumsq, max(self.count, 1), out=out)
+        np.multiply(self.mean, self.mean, out=self._scratch)
+        np.subtract(out, self._scratch, out=out)
+        np.maximum(out, 0, out=out)  # running sums can round a tiny variance below zero
+        return np.sqrt(out, out=out)
+
+
+class ExponentialAverage:
+    """Exponential moving average with weight *alpha* for the newest frame."""
+
+    def __init__(self, npix, alpha):
+        self.alpha = float(alpha)
+        self.mean = np.zeros(npix)
+        self.var = np.zeros(npix)
+        self._delta = np.empty(npix)
+        self.count = 0
+
+    @classmethod
+    def from_frames(cls, npix, frames):
+        """EMA with the same noise reduction as a boxcar of *frames* frames."""
+        return cls(npix, 2.0 / (max(int(frames), 1) + 1))
+
+    def update(self, ydata):
+        if self.count == 0:
+            np.copyto(self.mean, ydata)
+            self.var.fill(0)
+        else:
+            np.subtract(ydata, self.mean, out=self._delta)
+            # var = (1 - a) * (var + a * delta**2), then mean += a * delta
+            np.multiply(self._delta, self._delta, out=self._delta)
+            np.multiply(self._delta, self.alpha, out=self._delta)
+            np.add(self.var, self._delta, out=self.var)
+            np.multiply(self.var, 1 - self.alpha, out=self.var)
+            np.subtract(ydata, self.mean, out=self._delta)
+            np.multiply(self._delta, self.alpha, out=self._delta)
+            np.add(self.mean, self._delta, out=self.mean)
+        self.count += 1
+        return self.mean
+
+    @property
+    def effective_frames(self):
+        return min(self.count, (2 - self.alpha) / self.alpha) if self.count else 1
+
+    def std(self, out):
+        return np.sqrt(self.var, out=out)
+
+
+class WelfordStats:
+    """Mean and variance of all frames given (Welford's algorithm)."""
+
+    def __init__(self, npix):
+        self.mean = np.zeros(npix)
+        self.m2 = np.zeros(npix)
+        self._delta = np.empty(npix)
+        self._delta2 = np.empty(npix)
+        self.count = 0
+
+    def update(self, ydata):
+        self.count += 1
+        np.subtract(ydata, self.mean, out=self._delta)
+        np.divide(self._delta, self.count, out=self._delta2)
+        np.add(self.mean, self._delta2, out=self.mean)
+        np.subtract(ydata, self.mean, out=self._delta2)
+        np.multiply(self._delta, self._delta2, out=self._delta)
+        np.add(self.m2, self._delta, out=self.m2)
+        return self.mean
+
+    @property
+    def effective_frames(self):
+        return max(self.count, 1)
+
+    def std(self, out):
+        """Per-pixel sample standard deviation (zero until there are two frames)."""
+        if self.count < 2:
+            out.fill(0)
+            return out
+        np.divide(self.m2, self.count - 1, out=out)
+        return np.sqrt(out, out=out)
@@ -1,4 +1,6 @@
 # Update version May 2024
+import time
+STARTED = time.perf_counter()  #start of the import phase, for --profile-startup
 
 ## start Shared Imports (OO/Stellarnet)
 from sys import version_info
@@ -13,17 +15,10 @@ elif version_info.major == 3:
 
 from tkinter import Spinbox
 from tkinter import messagebox
-from tkinter.filedialog import asksaveasfilename
-
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
-from matplotlib import pyplot as plt
-from matplotlib.lines import Line2D
-from matplotlib import style
-style.use("ggplot")
-plt.rcParams['axes.facecolor']='#F8F8F8'
-#plt.rcParams['lines.color']='blue'
-plt.rcParams['figure.figsize'] = [8.0, 6.0]
+from tkinter.filedialog import asksaveasfilename, askdirectory
+
+# matplotlib is imported when the plot is built, after the window is shown (see App.build_plot);
+# pyplot and the style library are not needed at all, the ggplot look is set in PLOT_STYLE
 LARGE_FONT= ("Verdana", 12)
 NORM_FONT= ("Verdana", 10)
 
@@ -32,53 +27,76 @@ import numpy as np
 import os #for filename and path handling
 import csv  #easier file writing
 import gc  #garbage collection
+import zlib  #crc32 of the displayed data, to skip unchanged frames
+import sys
+import platform
+import argparse  #command line options
 ## end Shared Imports
 
 ## Stellarnet Specific Imports
-from stellarnet_driverLibs import stellarnet_driver3 as sn
+# the StellarNet driver is only imported inside the acquisition process, which owns the spectrometer
+from acquisition import AcquisitionStartup, FrameCache
+from replay import ReplayStartup, parse_speed
 ##
+from processing import SpectrumProcessor
+from display import LineDecimator
+from monitor import MonitorTable
+from peaks import PeakFinder, PeakTracker, PeakLog
+from library import ReferenceLibrary, LiveMatcher
+from kinetics import KineticsLog
+from recorder import SpectrumRecorder
+from stats import BoxcarAverage, ExponentialAverage, WelfordStats
+from exposure import AutoExposure
+from timing import StageTimer, AGE, ACQUIRE, PROCESS, ARTISTS, RESTORE, DRAW, BLIT, FLUSH, GC
+IMPORTED = time.perf_counter()
+
+# matplotlib's "ggplot" style plus our own background and figure size
+PLOT_STYLE = {
+    'patch.linewidth': 0.5, 'patch.facecolor': '#348ABD', 'patch.edgecolor': '#EEEEEE', 'patch.antialiased': True,
+    'font.size': 10.0,
+    'axes.facecolor': '#F8F8F8', 'axes.edgecolor': 'white', 'axes.linewidth': 1, 'axes.grid': True,
+    'axes.titlesize': 'x-large', 'axes.labelsize': 'large', 'axes.labelcolor': '#555555', 'axes.axisbelow': True,
+    'xtick.color': '#555555', 'xtick.direction': 'out', 'ytick.color': '#555555', 'ytick.direction': 'out',
+    'grid.color': 'white', 'grid.linestyle': '-',
+    'figure.facecolor': 'white', 'figure.edgecolor': '0.50', 'figure.figsize': [8.0, 6.0],
+}
+PLOT_COLORS = ['#E24A33', '#348ABD', '#988ED5', '#777777', '#FBC15E', '#8EBA42', '#FFB5B8']
+
 
-## start StellarNet set up functions
-# Enumerate spectrometer
-try:
-    spectrometer = sn.array_get_spec_only(0)
-except:
-    messagebox.showerror("Error", "No spectrometer attached")
-    exit()
-
-# Spectrometer data collectors
-def get_wavelengths():
-    spec_x = sn.getSpectrum_X(spectrometer)
-    return spec_x
-def get_intensities():
-    spec_y = sn.getSpectrum_Y(spectrometer) 
-    return spec_y
-## end StellarNet set up functions
+def use_plot_style():
+    import matplotlib
+    from cycler import cycler
+    matplotlib.rcParams.update(PLOT_STYLE)
+    matplotlib.rcParams['axes.prop_cycle'] = cycler(color=PLOT_COLORS)
 
 class App(tk.Frame):
-    def __init__(self, master=None, **kwargs):
+    def __init__(self, master=None, driver='stellarnet', profile=None, timing=None, timing_log=None, max_fps=60,
+                 replay=None, speed=1.0, **kwargs):
         tk.Frame.__init__(self, master, **kwargs)
 #Spectrometer initial setup
-        self.wavelengths = np.around(get_wavelengths(), decimals=3) #round wavelengths to practical limits
-        self.ydata = np.array(get_intensities())
-        self.xmin = np.around(min(self.wavelengths), decimals=3)
-        self.xminlimit = self.xmin
-        self.xmax = np.around(max(self.wavelengths), decimals=3)
-        self.xmaxlimit = self.xmax
-        self.ymin = np.around(min(self.ydata * 0.8), decimals=3) #ymin is the display limit, data_min*0.8 to give a margin
-        self.ymax = np.around(max(self.ydata * 1.1), decimals=3)
-        self.waveres = np.around(self.wavelengths[1] - self.wavelengths[0], decimals=3)
         self.IntTime = 20 #set in milliseconds, this is 20ms set as a "reasonable" default value
         self.minIntTime = 3 #StellarNet Spectrometers usually have a 3 ms minimum integration time.
         self.Averages = 1  #set default to single acquisition
-        # below parameters are (spectrometer, self.IntTime, self.Averages, smoothing=0, xtiming=1, True=throw out first data to get settings in place)
-        sn.setParam(spectrometer, self.IntTime, self.Averages, 0, 1, True)
-        # set initial values in text boxes and spectrum window
-
-        #preload dark and incident values
-        self.dark = np.zeros(len(self.wavelengths))     #dummy values set to zero
-        self.incident = np.ones(len(self.wavelengths))  #dummy values to prevent error in Absorbance when no dark recorded
+        # every attached spectrometer runs in its own acquisition process, frames arrive through shared memory
+        # and several spectrometers are shown as one stitched spectrum.  They are opened in the background
+        # (see connect) so the window appears straight away; everything that depends on the wavelengths
+        # is set up in connected()
+        self.startup = AcquisitionStartup(driver, int_time=self.IntTime, averages=self.Averages)
+        # a recorded session or directory of saved spectra is played back through the same frame interface instead
+        self.replay = replay
+        if replay is not None:
+            self.startup = ReplayStartup(replay, speed)
+        self.engine = None
+        self.profile = profile    #StartupProfile when run with --profile-startup
+        self.timing = timing      #StageTimer for the display loop, None turns timing off
+        self.timing_log = timing_log  #file the timing histograms are appended to on quit
+        self.device = 0  #spectrometer whose integration time and averages are shown in the entry boxes
         self.DisplayCode = 0      #start in raw intensity mode
+        self.lastseq = 0          #sequence number of the last frame drawn
+        self.refresh_ms = 10      #how often the display checks for a new frame
+        self.frame_interval = 1.0 / max_fps  #no more redraws than the screen refreshes, however fast frames arrive
+        self.next_draw = 0.0
+        self.after_id = None
 
 #GUI entries
         self.menu_left = tk.Frame(self, width=150, bg="#ababab")
@@ -109,14 +127,12 @@ class App(tk.Frame):
         self.labelxmin.grid(column=0, row=3, pady=2)
         self.xminentry = tk.Entry(self.menu_left_upper, width='7')
         self.xminentry.grid(column=1, row=3, pady=2)
-        self.xminentry.insert(0, self.xmin)
         self.xminentry.bind('<Return>', self.xScaleChange) and self.xminentry.bind('<Tab>', self.xScaleChange)
         
         self.labelxmax = tk.Label(self.menu_left_upper, text='Maximum wavelength', relief='ridge')
         self.labelxmax.grid(column=0, row=4, pady=2)
         self.xmaxentry = tk.Entry(self.menu_left_upper, width='7')
         self.xmaxentry.grid(column=1, row=4, pady=2)
-        self.xmaxentry.insert(0, self.xmax)
         self.xmaxentry.bind('<Return>', self.xScaleChange) and self.xmaxentry.bind('<Tab>', self.xScaleChange)
         
         self.button_dark = tk.Button(self.menu_left_upper, text='Measure Dark', background='light grey')
@@ -133,22 +149,112 @@ class App(tk.Frame):
         self.labelmonitor = tk.Label(self.menu_left_upper, text='Wavelength to monitor (nm)', font=LARGE_FONT)
         self.labelmonitor.grid(column=0, row=7, pady=2)
 
-        self.monitorwave = np.median(self.wavelengths)  #set monitor wavelength to middle of hardware range
-        self.monitorindex = np.searchsorted(self.wavelengths, self.monitorwave, side='left')
         self.entrymonitor = tk.Entry(self.menu_left_upper, width='7')
         self.entrymonitor.grid(column=1, row=7, pady=2)
-        self.entrymonitor.insert(0, np.round(self.wavelengths[self.monitorindex], decimals=2))
         self.entrymonitor.bind('<Return>', self.entrymonitor_return) and self.entrymonitor.bind('<Tab>', self.entrymonitor_return)
         self.labelmonitor2 = tk.Label(self.menu_left_upper, text="press <Enter> to set new wavelength")
         self.labelmonitor2.grid(column=0, row=8, pady=2)
+        # more wavelengths and bands to watch, their values are listed on the spectrum
+        self.monitor_window = None
+        self.button_monitors = tk.Button(self.menu_left_upper, text='Monitor table', background='light grey', command=self.monitor_table)
+        self.button_monitors.grid(column=1, row=8, pady=2)
 
         self.button_reset_y = tk.Button(self.menu_left_upper, text='Reset Y axis scale', background='light blue')
         self.button_reset_y.grid(column=0, row=9, pady=10)
         self.button_reset_y.bind('<ButtonRelease-1>', self.reset_y)
-##
-##        self.button_saveFile = tk.Button(self.menu_left_upper, text='Save File', background='light slate blue')
-##        self.button_saveFile.grid(column=0, row=12, pady=3)
-##        self.button_saveFile.bind('<ButtonRelease-1>', self.saveFile)
+
+        # kinetics: log the monitored wavelength (and optionally every spectrum) to a file
+        self.kinetics = None
+        self.kinetics_window = None
+        self.button_kinetics = tk.Button(self.menu_left_upper, text='Start Kinetics', background='light grey')
+        self.button_kinetics.grid(column=0, row=10, pady=2)
+        self.button_kinetics.bind('<ButtonRelease-1>', self.kinetics_toggle)
+        self.kinetics_spectra = tk.IntVar(value=0)
+        self.check_kinetics_spectra = tk.Checkbutton(self.menu_left_upper, text='with spectra', variable=self.kinetics_spectra)
+        self.check_kinetics_spectra.grid(column=1, row=10, pady=2)
+
+        # continuous recording of every frame with its settings and references
+        self.recorder = None
+        self.button_record = tk.Button(self.menu_left_upper, text='Record', background='light grey')
+        self.button_record.grid(column=0, row=11, pady=2)
+        self.button_record.bind('<ButtonRelease-1>', self.record_toggle)
+        self.record_compress = tk.IntVar(value=0)
+        self.check_record_compress = tk.Checkbutton(self.menu_left_upper, text='compress', variable=self.record_compress)
+        self.check_record_compress.grid(column=1, row=11, pady=2)
+
+        # live average on the host: smoothed trace at the full frame rate, with per-pixel noise
+        self.average = None
+        self.liveavgnames = ['No live average', 'Boxcar average', 'Moving average (EMA)']
+        self.liveavgvar = tk.StringVar(value=self.liveavgnames[0])
+        self.menuliveavg = tk.OptionMenu(self.menu_left_upper, self.liveavgvar, *self.liveavgnames, command=self.live_average_change)
+        self.menuliveavg.grid(column=0, row=14, pady=2)
+        self.LiveFrames = 10  #frames in the live average
+        self.entrylive = tk.Entry(self.menu_left_upper, width='4')
+        self.entrylive.grid(column=1, row=14, pady=2)
+        self.entrylive.insert(0, self.LiveFrames)
+        self.entrylive.bind('<Return>', self.live_average_change) and self.entrylive.bind('<Tab>', self.live_average_change)
+
+        self.RefFrames = 1  #frames averaged for dark and 100% T references
+        self.refcapture = None
+        self.settings_seq = 0  #last frame acquired before the current integration time and averages took effect
+        self.labelref = tk.Label(self.menu_left_upper, text='Frames per reference', relief='ridge')
+        self.labelref.grid(column=0, row=15, pady=2)
+        self.entryref = tk.Entry(self.menu_left_upper, width='4')
+        self.entryref.grid(column=1, row=15, pady=2)
+        self.entryref.insert(0, self.RefFrames)
+        self.entryref.bind('<Return>', self.EntryRef_return) and self.entryref.bind('<Tab>', self.EntryRef_return)
+
+        self.showband = tk.IntVar(value=0)
+        self.check_band = tk.Checkbutton(self.menu_left_upper, text='Show noise band', variable=self.showband, command=self.band_change)
+        self.check_band.grid(column=0, row=16, pady=2)
+        # references are normally made from the frames already acquired at the current settings;
+        # fresh ones wait for frames whose acquisition starts after the click
+        self.freshref = tk.IntVar(value=0)
+        self.check_freshref = tk.Checkbutton(self.menu_left_upper, text='Fresh reference frames', variable=self.freshref)
+        self.check_freshref.grid(column=1, row=16, pady=2)
+
+        # automatic integration time: the peak in the xmin/xmax window is brought to a fraction of full scale
+        self.exposure = None
+        self.exposure_seq = 0       #last frame of the selected spectrometer looked at
+        self.exposure_pending = False  #new integration time sent, not confirmed yet
+        self.ExposureTarget = 80    #percent of full scale
+        self.autoexposure = tk.IntVar(value=0)
+        self.check_autoexposure = tk.Checkbutton(self.menu_left_upper, text='Auto integration time, % full scale', variable=self.autoexposure,
+                                                 command=self.auto_exposure_change, wraplength='130')
+        self.check_autoexposure.grid(column=0, row=17, pady=2)
+        self.entrytarget = tk.Entry(self.menu_left_upper, width='4')
+        self.entrytarget.grid(column=1, row=17, pady=2)
+        self.entrytarget.insert(0, self.ExposureTarget)
+        self.entrytarget.bind('<Return>', self.auto_exposure_change) and self.entrytarget.bind('<Tab>', self.auto_exposure_change)
+
+        # live peak analysis of the displayed range: numbered markers and a table, optionally logged to CSV
+        self.peakfinder = None
+        self.peaktracker = None
+        self.peaklog = None
+        self.findpeaks = tk.IntVar(value=0)
+        self.check_peaks = tk.Checkbutton(self.menu_left_upper, text='Find peaks', variable=self.findpeaks, command=self.peaks_change)
+        self.check_peaks.grid(column=0, row=18, pady=2)
+        self.button_peaklog = tk.Button(self.menu_left_upper, text='Log peaks', background='light grey')
+        self.button_peaklog.grid(column=1, row=18, pady=2)
+        self.button_peaklog.bind('<ButtonRelease-1>', self.peaklog_toggle)
+
+        # identification against a library of reference spectra, searched on a worker thread
+        self.library = None
+        self.matcher = None
+        self.match_seq = 0
+        self.match_after = None
+        self.button_library = tk.Button(self.menu_left_upper, text='Reference library', background='light grey')
+        self.button_library.grid(column=0, row=19, pady=2)
+        self.button_library.bind('<ButtonRelease-1>', self.load_library)
+        self.identifynames = ['No identification', 'Cosine', 'Derivative', 'Cosine + mixture', 'Derivative + mixture']
+        self.identifyvar = tk.StringVar(value=self.identifynames[0])
+        self.menuidentify = tk.OptionMenu(self.menu_left_upper, self.identifyvar, *self.identifynames, command=self.identify_change)
+        self.menuidentify.grid(column=1, row=19, pady=2)
+
+        # the spectrum on screen, taken from the frames already seen (see displayed_counts)
+        self.button_saveFile = tk.Button(self.menu_left_upper, text='Save File', background='light slate blue')
+        self.button_saveFile.grid(column=0, row=12, pady=3)
+        self.button_saveFile.bind('<ButtonRelease-1>', self.saveFile)
 
         
 # right display area -- Spectrograph Plot Area
@@ -167,8 +273,7 @@ class App(tk.Frame):
         
         #lower status bar
         self.status_frame = tk.Frame(self)
-        spec_config = spectrometer['device'].get_config()
-        self.status = tk.Label(self.status_frame, text = "Model:  " + spec_config['model'])
+        self.status = tk.Label(self.status_frame, text = "Connecting to spectrometer...")
         self.status.pack(fill="both", expand=False)
 
         #set locations of the major areas to the corners of the box
@@ -177,29 +282,146 @@ class App(tk.Frame):
         self.canvas_area.grid(row=1, column=1, sticky="nsew") 
         self.status_frame.grid(row=2, column=0, columnspan=2, sticky="ew")
 
+        # controls that need the spectrometer stay disabled until it is connected
+        self.device_widgets = [self.entryint, self.entryavg, self.xminentry, self.xmaxentry, self.button_dark,
+                               self.button_incident, self.button_AbMode, self.entrymonitor, self.button_monitors, self.button_reset_y,
+                               self.button_kinetics, self.button_record, self.button_saveFile, self.menuliveavg, self.entrylive,
+                               self.entryref, self.check_freshref, self.check_autoexposure, self.entrytarget,
+                               self.check_peaks, self.button_peaklog, self.button_library, self.menuidentify, self.btn]
+        for widget in self.device_widgets:
+            widget.configure(state='disabled')
+            widget.bindtags(widget.bindtags()[1:])  # bind() handlers fire on disabled widgets too, so detach them
+        self.fig = None
+        self.after_idle(self.build_plot)  # once the window is on screen
+        self.after(50, self.connect)
+
+## GUI end of entries
+
+    def build_plot(self):
+        # matplotlib takes seconds to import on a Raspberry Pi, so it is loaded after the window is up
+        if self.profile is not None:
+            self.profile.mark("window shown")
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
+        use_plot_style()
 #Create plot area
-        #create plot object and draw it with empty data before starting matplotlib line artists
+        #create plot object, the data dependent parts are set in connected()
         # 'ax1' is ax"one" not a letter
-        self.fig = plt.Figure()
+        self.fig = Figure()
         self.ax1 = self.fig.add_subplot(111)
         self.line, = self.ax1.plot([], [], lw=1, color='blue') #creates empty line !! comma is important for Blit
+        self.band_lo, = self.ax1.plot([], [], lw=0.5, color='blue', alpha=0.4)  #noise band, +/- one standard deviation
+        self.band_hi, = self.ax1.plot([], [], lw=0.5, color='blue', alpha=0.4)
         self.canvas = FigureCanvasTkAgg(self.fig, master=self)
-        self.canvas.draw()
         self.canvas.get_tk_widget().grid(row=1, column=1)
+        self.ax1.set_xlabel('Wavelength (nm)')
+        self.ax1.grid(True, color='0.3', ls='dotted')  # places dark grid on spectrum display
+        if self.profile is not None:
+            self.profile.mark("plot built")
+
+    def connect(self):
+        # open the spectrometers without blocking the Tk loop, then wait for the first frame
+        try:
+            if self.engine is None:
+                self.engine = self.startup.poll()
+                if self.engine is not None and self.profile is not None:
+                    self.profile.mark("device connected")
+            ready = self.engine is not None and self.fig is not None and self.engine.latest_seq() >= 1
+        except RuntimeError as err:
+            messagebox.showerror("Error", str(err))
+            self.ButtonQuit()
+            return
+        if not ready:
+            self.after(20, self.connect)
+            return
+        if self.profile is not None:
+            self.profile.mark("first frame")
+        self.connected()
+
+    def connected(self):
+        self.IntTime = self.engine.engines[self.device].int_time
+        self.Averages = self.engine.engines[self.device].averages
+        self.wavelengths = np.around(self.engine.wavelengths, decimals=3) #round wavelengths to practical limits
+        self.ydata = np.array(self.engine.wait_frame(1).ydata)
+        self.xmin = np.around(min(self.wavelengths), decimals=3)
+        self.xminlimit = self.xmin
+        self.xmax = np.around(max(self.wavelengths), decimals=3)
+        self.xmaxlimit = self.xmax
+        self.ymin = np.around(min(self.ydata * 0.8), decimals=3) #ymin is the display limit, data_min*0.8 to give a margin
+        self.ymax = np.around(max(self.ydata * 1.1), decimals=3)
+        self.waveres = np.around(self.wavelengths[1] - self.wavelengths[0], decimals=3)
+        #preload dark and incident values; the processor keeps them with the precomputed absorbance reference
+        self.processor = SpectrumProcessor(len(self.wavelengths))
+        self.cache = FrameCache(len(self.wavelengths))  #copies of the frames seen, newest on screen
+        self.consumed = np.empty(len(self.wavelengths))  #frame being fed to the live average, kinetics log and recorder
+        self.monitorwave = np.median(self.wavelengths)  #set monitor wavelength to middle of hardware range
+        self.monitorindex = np.searchsorted(self.wavelengths, self.monitorwave, side='left')
+        self.monitors = MonitorTable(self.wavelengths)  #row 0 is the monitored wavelength above
+        self.monitors.add(self.monitorwave)
+        self.monitor_labels = []
+        self.monitor_markers = []
 
+        # set initial values in text boxes and spectrum window
+        # recorded frames keep their integration time and averages
+        fixed = (self.entryint, self.entryavg, self.check_autoexposure, self.entrytarget) if self.replay else ()
+        for widget in self.device_widgets:
+            if widget not in fixed:
+                widget.configure(state='normal')
+                widget.bindtags((str(widget),) + widget.bindtags())
+        self.showconfig()
+        self.xminentry.insert(0, self.xmin)
+        self.xmaxentry.insert(0, self.xmax)
+        self.entrymonitor.insert(0, np.round(self.wavelengths[self.monitorindex], decimals=2))
+        self.status.configure(text = "Model:  " + self.engine.model)
+
+        # with more than one spectrometer, choose which one the integration time and averages apply to
+        if len(self.engine.engines) > 1:
+            self.devicenames = [str(i + 1) + ": " + engine.model + " (" + str(int(engine.wavelengths[0])) + "-" + str(int(engine.wavelengths[-1])) + " nm)"
+                                for i, engine in enumerate(self.engine.engines)]
+            self.labeldevice = tk.Label(self.menu_left_upper, text='Spectrometer settings', relief='ridge')
+            self.labeldevice.grid(column=0, row=13, pady=2)
+            self.devicevar = tk.StringVar(value=self.devicenames[0])
+            self.menudevice = tk.OptionMenu(self.menu_left_upper, self.devicevar, *self.devicenames, command=self.select_device)
+            self.menudevice.grid(column=1, row=13, pady=2)
+
+        self.noise = np.empty(len(self.wavelengths))
+        self.bandraw = np.empty(len(self.wavelengths))
+        self.bandout = np.empty(len(self.wavelengths))
 #Axis limits. Get from the spectrograph data
         self.ax1.set_ylim(self.ymin, self.ymax)
-        self.ax1.set_xlim(self.xmin, self.xmax) 
-        self.ax1.set_xlabel('Wavelength (nm)')
-        self.ax1.grid(True, color='0.3', ls='dotted')  # places dark grid on spectrum display
+        self.ax1.set_xlim(self.xmin, self.xmax)
 #Create the line artist objects for Blit
         monitor = np.round(self.ydata[self.monitorindex], decimals=3)
         self.text = self.ax1.annotate(monitor, (1, 1), xycoords="axes fraction", xytext=(10, -10),
                                       textcoords="offset points", ha="right", va="top", fontsize = 14, animated = True,)
-        self.ax1.axvline(x=self.monitorwave, lw=2, color='blue', alpha  = 0.5)
-        self.bm = BlitManager(self.fig.canvas, [self.line, self.text])
-
+        self.tabletext = self.ax1.annotate("", (0, 1), xycoords="axes fraction", xytext=(10, -10),
+                                           textcoords="offset points", ha="left", va="top", fontsize = 10, animated = True,)
+        # the markers are animated too, so moving them does not need a full canvas.draw()
+        self.monitorline = self.ax1.axvline(x=self.monitorwave, lw=2, color='blue', alpha  = 0.5, animated = True)
+        self.peakmarkers, = self.ax1.plot([], [], 'v', color='#E24A33', markersize=7, animated = True)
+        self.peaktext = self.ax1.annotate("", (1, 1), xycoords="axes fraction", xytext=(-10, -34),
+                                          textcoords="offset points", ha="right", va="top", fontsize = 10, animated = True,)
+        self.matchtext = self.ax1.annotate("", (0, 0), xycoords="axes fraction", xytext=(10, 10),
+                                           textcoords="offset points", ha="left", va="bottom", fontsize = 10, animated = True,)
+        self.bm = BlitManager(self.fig.canvas, self.blit_artists(), self.timing, flush=False)  #runs from the Tk loop, which repaints
+        # only the visible wavelengths, reduced to the plot width, are handed to the line artist
+        self.decimator = LineDecimator(self.wavelengths)
+        self.set_display_geometry()
+        self.fig.canvas.mpl_connect('resize_event', self.set_display_geometry)
+        self.canvas.draw()
 #end artist creation
+        self.config_pending = False  #settings sent, not read back yet
+        self.engine_error = None
+        self.after(500, self.check_engine)
+        if self.timing is not None:
+            self.after(1000, self.show_timing)
+        if self.replay is not None:
+            self.replay_reference = None
+            self.show_replay()
+        if self.profile is not None:
+            self.profile.mark("first draw")
+            self.profile.report()
+            self.ButtonQuit()
 
 ## GUI end of entries
 
@@ -207,60 +429,538 @@ class App(tk.Frame):
 ## start Stellarnet Specific defs
 # SET CONFIGURATION
     def setconfig(self):#,configurl):
-        spectrometer['device'].set_config(int_time = self.IntTime, scans_to_avg = self.Averages)
+        # the engine applies the settings between acquisitions, readconfig picks up the verified values
+        self.engine.set_config(self.IntTime, self.Averages, self.device)
+        self.config_pending = True
+        self.after(20, self.readconfig)
+
+    def readconfig(self):
         # read back new configuration from spectrometer to verify new settings
-        config_full = spectrometer['device'].get_config()
-        self.IntTime = config_full['int_time']
-        self.Averages = config_full['scans_to_avg']
+        if not self.config_pending:
+            return  # check_engine came across the reply first
+        if not self.engine.poll():
+            if self.engine.error is None:
+                self.after(20, self.readconfig)  # still waiting on the acquisition in progress
+            return
+        self.configread()
+
+    def configread(self):
+        self.config_pending = False
+        self.exposure_pending = False
+        self.settings_seq = self.engine.latest_seq()  #cached frames up to here are at the old settings
+        self.showconfig()
+        if self.average is not None:
+            self.reset_live_average()  #frames at the old settings would be mixed in otherwise
+
+    def showconfig(self):
+        self.IntTime = self.engine.engines[self.device].int_time
+        self.Averages = self.engine.engines[self.device].averages
+        if self.replay:
+            self.entryint.configure(state='normal')  #disabled entries ignore delete and insert
+            self.entryavg.configure(state='normal')
         self.entryint.delete(0, 5)
-        self.entryint.insert(0,self.IntTime)  #set text in integration time box
+        self.entryint.insert(0,self.IntTime or '')  #set text in integration time box; saved spectra do not record it
         self.entryavg.delete(0, 5)
-        self.entryavg.insert(0,self.Averages)  #set text in averages box
+        self.entryavg.insert(0,self.Averages or '')  #set text in averages box
+        if self.replay:
+            self.entryint.configure(state='disabled')
+            self.entryavg.configure(state='disabled')
+
+    def select_device(self, name):
+        # integration time and averages are set per spectrometer
+        self.device = self.devicenames.index(name)
+        self.showconfig()
+        if self.exposure is not None:
+            self.auto_exposure_change()  #start over on the newly selected spectrometer
+
+    def auto_exposure_change(self, event=None):
+        TargetTemp = self.entrytarget.get()
+        if TargetTemp.isdigit() == True and 5 <= int(TargetTemp) <= 95:
+            self.ExposureTarget = int(TargetTemp)
+        else:
+            msg = "The auto integration time target must be 5 to 95 % of full scale.  You tried " + str(TargetTemp) + "."
+            self.entrytarget.delete(0, 'end')
+            self.entrytarget.insert(0, self.ExposureTarget)
+            messagebox.showerror("Entry error", msg)
+        if self.autoexposure.get():
+            self.exposure = AutoExposure(target=self.ExposureTarget / 100.0, min_int_time=self.minIntTime)
+            self.exposure_seq = 0
+            if self.after_id is None:
+                self.on_click()  #frames are only looked at while the display runs
+        else:
+            self.exposure = None
+
+    def auto_exposure(self):
+        # next integration time from the peak counts of the newest frame inside the xmin/xmax window
+        engine = self.engine.engines[self.device]
+        frame = engine.latest()
+        if frame is None or frame.seq == self.exposure_seq or self.exposure_pending:
+            return
+        self.exposure_seq = frame.seq
+        if frame.int_time != engine.int_time:
+            return  #acquired before the last change
+        i0, i1 = np.searchsorted(engine.wavelengths, (self.xmin, self.xmax))
+        if i0 >= i1:
+            i0, i1 = 0, len(engine.wavelengths)  #this spectrometer is outside the window
+        IntTimeTemp = self.exposure.update(frame.int_time, float(frame.ydata[i0:i1].max()))
+        if IntTimeTemp is not None:
+            self.IntTime = IntTimeTemp
+            self.exposure_pending = True
+            self.setconfig()
 ## end Stellarnet Specific defs
 
 ## start Shared (OO/Stellarnet) defs
     def on_click(self):
         # Start button will start infinite cycle on whole spectrum or start an individual time series.
+        t0 = time.perf_counter()
         gc.collect()
-        self.bm = BlitManager(self.fig.canvas, [self.line, self.text]) 
+        if self.timing is not None:
+            self.timing.add(GC, time.perf_counter() - t0)  #not a frame, so not start()/lap()
         self.btn.config(text='Running')
-        return self.update_graph()
+        self.bm.invalidate()  # the first update redraws everything, so all lines and scaling get reset
+        if self.after_id is None:
+            self.update_graph()
 
     def update_graph(self):
         # if DisplayCode = 0 then do Raw Values;  else do Absorbance
-        self.canvas.draw()  # guarantees that all lines and scaling get reset
-
-        while self.DisplayCode == 0:
-            ydata = get_intensities()
-            ydata = np.array(ydata, dtype=float)
-            monitor = np.round(ydata[self.monitorindex], decimals=3)
-            self.line.set_data(self.wavelengths, ydata) # update matplotlib line data
+        # runs from the Tk event loop: draw the newest frame if there is one, then check again shortly
+        self.after_id = self.after(self.refresh_ms, self.update_graph)
+        frame = self.engine.latest()
+        if frame is None or frame.seq == self.lastseq:
+            return
+        now = time.monotonic()
+        if now < self.next_draw:
+            return  #faster than the screen refresh: the frames are taken, and the newest drawn, on a later tick
+        self.next_draw = now + self.frame_interval
+        timing = self.timing  # every stage below is timed unless timing is off
+        if timing is not None:
+            timing.start()
+            timing.add(AGE, time.time() - frame.timestamp)
+        if self.average is not None or self.kinetics is not None or self.recorder is not None:
+            self.consume_frames(frame.seq)
+        else:
+            if self.replay is not None:
+                self.replay_references(frame.seq)
+            cached = self.cache.read(self.engine, frame.seq)  #checked after the copy, a torn frame is never cached
+            if cached is not None:
+                frame = cached  #and the checked copy is what gets drawn
+        self.lastseq = frame.seq
+        if self.replay is not None:
+            self.engine.acknowledge(frame.seq)  #the replay does not release frames that would lap the ones not taken yet
+        if self.exposure is not None:
+            self.auto_exposure()
+        if timing is not None:
+            timing.lap(ACQUIRE)
+        rawdata = frame.ydata if self.average is None else self.average.mean
+        self.ydata = rawdata  #newest data, for monitor values shown before the next frame arrives
+        ydata = self.processor.process(rawdata, self.DisplayCode)  # preallocated buffer, no per-frame arrays
+        monitor = np.round(ydata[self.monitorindex], decimals=3)
+        x, y = self.decimator.decimate(ydata)
+        if self.peakfinder is not None:
+            self.show_peaks(frame, ydata)
+        if self.matcher is not None:
+            self.matcher.offer(frame.seq, ydata)  #searched on the worker thread, shown by show_matches
+        if timing is not None:
+            timing.lap(PROCESS)
+        self.line.set_data(x, y) # update matplotlib line data
+        if self.average is None:
             self.text.set_text(f"{monitor}")
-            self.bm.update()  #redraw with blit manager call
-            gc.collect()  # garbage collector
- 
         else:
-            np.seterr(divide='ignore', invalid='ignore')
-            while self.DisplayCode == 1:
-                ydata = get_intensities()
-                ydata = np.array(ydata, dtype=float)
-                ydata = np.log10((self.incident - self.dark) / (ydata - self.dark))
-                monitor = np.round(ydata[self.monitorindex], decimals=3)
-                self.line.set_data(self.wavelengths, ydata)
-                self.text.set_text(f"{monitor}")
-                self.bm.update()  # blit manager call
-                gc.collect()  # garbage collector
+            snr = self.update_noise()
+            self.text.set_text(f"{monitor}   S/N {snr:.0f}")
+        if len(self.monitors) > 1:
+            self.show_monitors(ydata)
+        if timing is not None:
+            timing.lap(ARTISTS)
+        # redraw with blit manager call, skipped if the picture would be the same
+        self.bm.update(key=(zlib.crc32(y), self.text.get_text(), self.tabletext.get_text(), self.peaktext.get_text(),
+                            self.matchtext.get_text()))
+        if timing is not None:
+            timing.end_frame()
+
+    def check_engine(self):
+        # a failed spectrometer read ends its acquisition process; say so instead of leaving a frozen spectrum
+        if self.engine.poll() and self.config_pending:
+            self.configread()
+        if self.engine.error is None:
+            self.after(500, self.check_engine)
+            return
+        self.engine_error = self.engine.error
+        self.status.configure(text = "Model:  " + self.engine.model + "      Acquisition stopped: " + self.engine_error)
+        messagebox.showerror("Acquisition error", self.engine_error + "\nNo new spectra will be shown; restart the program.")
+
+    def show_timing(self):
+        # frame rate and p50/p99 stage latencies next to the model name, once a second
+        if self.engine_error is not None:
+            return  #the status bar keeps the error
+        self.status.configure(text = "Model:  " + self.engine.model + "      " + self.timing.status())
+        self.after(1000, self.show_timing)
+
+    def replay_references(self, seq):
+        # the recorded dark and 100% T are taken up with the first frame recorded with them,
+        # a reference taken during the replay stays until the recording changes them
+        reference = self.engine.reference(seq)
+        if reference is not None and reference is not self.replay_reference:
+            self.replay_reference = reference
+            self.processor.set_dark(reference[0])
+            self.processor.set_incident(reference[1])
+            if self.recorder is not None:
+                self.recorder.set_references(self.processor.dark, self.processor.incident)
+
+    def show_replay(self):
+        # progress in the window title
+        frame = self.engine.latest()
+        if frame is not None and (self.engine.int_time, self.engine.averages) != (self.IntTime, self.Averages):
+            self.showconfig()  #the recorded settings of the frames being replayed
+        title = "Replay of " + os.path.basename(os.path.normpath(self.replay)) + ":  frame " + str(self.engine.latest_seq()) + \
+                " of " + str(self.engine.nframes)
+        if self.engine.finished:
+            title += ", finished"
+        if self.engine.skipped:
+            title += ", " + str(self.engine.skipped) + " files skipped (not raw counts)"
+        if self.engine.error is not None:
+            title += ", " + self.engine.error
+        self.master.wm_title(title)
+        self.after(500, self.show_replay)
 
+    def show_monitors(self, ydata):
+        # every row of the monitor table but the first, which is the large number at the top right
+        values = self.monitors.evaluate(ydata)
+        self.tabletext.set_text("\n".join([label + f"  {value:.4g}" for label, value in zip(self.monitor_labels, values[1:])]))
+
+    def blit_artists(self):
+        return [self.line, self.band_lo, self.band_hi, self.text, self.tabletext, self.monitorline,
+                self.peakmarkers, self.peaktext, self.matchtext] + self.monitor_markers
+
+    def monitor_table(self):
+        if self.monitor_window is not None and self.monitor_window.winfo_exists():
+            self.monitor_window.lift()
+        else:
+            self.monitor_window = MonitorWindow(self)
+
+    def add_monitor(self, center, width):
+        self.monitors.add(center, width)
+        self.monitors_changed()
+
+    def remove_monitor(self, row):
+        if row > 0:  #row 0 is set with the monitored wavelength entry
+            self.monitors.remove(row)
+            self.monitors_changed()
+
+    def monitors_changed(self):
+        # labels and markers are rebuilt only when the table changes; the values follow with each frame
+        for artist in self.monitor_markers:
+            self.bm.remove_artist(artist)
+            artist.remove()
+        self.monitor_markers = []
+        self.monitor_labels = []
+        for row in range(1, len(self.monitors)):
+            self.monitor_labels.append(str(row) + ":  " + self.monitors.label(row))
+            lo, hi = self.monitors.span(row)
+            if hi > lo:
+                marker = self.ax1.axvspan(lo, hi, color='green', alpha=0.15)
+            else:
+                marker = self.ax1.axvline(x=lo, lw=1.5, color='green', alpha=0.6)
+            number = self.ax1.annotate(str(row), ((lo + hi) / 2, 0), xycoords=("data", "axes fraction"), xytext=(0, 4),
+                                       textcoords="offset points", ha="center", va="bottom", color='green')
+            for artist in (marker, number):
+                self.bm.add_artist(artist)
+                self.monitor_markers.append(artist)
+        if len(self.monitors) > 1:
+            self.show_monitors(self.processor.process(self.ydata, self.DisplayCode))
+        else:
+            self.tabletext.set_text("")
+        if self.monitor_window is not None and self.monitor_window.winfo_exists():
+            self.monitor_window.refresh()
+        self.bm.update()
+
+    def update_noise(self):
+        # per-pixel noise of the live average: optional band of +/- one standard deviation, and S/N at the monitored wavelength
+        std = self.average.std(self.noise)
+        i = self.monitorindex
+        noise = std[i] / np.sqrt(self.average.effective_frames)  #noise of the averaged trace
+        signal = self.average.mean[i] - self.processor.dark[i]
+        snr = signal / noise if noise > 0 else np.inf
+        if self.showband.get():
+            np.subtract(self.average.mean, std, out=self.bandraw)
+            self.band_lo.set_data(*self.decimator.decimate(self.processor.process(self.bandraw, self.DisplayCode, out=self.bandout)))
+            np.add(self.average.mean, std, out=self.bandraw)
+            self.band_hi.set_data(*self.decimator.decimate(self.processor.process(self.bandraw, self.DisplayCode, out=self.bandout)))
+        return snr
+
+    def show_peaks(self, frame, ydata):
+        # peaks between xmin and xmax, numbered by the tracker so a peak keeps its number while it drifts
+        i0, i1 = np.searchsorted(self.wavelengths, (self.xmin, self.xmax), side='left')
+        peaks = self.peakfinder.find(ydata, i0, i1)
+        ids = self.peaktracker.update(peaks)
+        self.peakmarkers.set_data(peaks['wavelength'], peaks['height'])
+        self.peaktext.set_text("\n".join([f"{id}:  {wave:.2f} nm  {height:.4g}  FWHM {fwhm:.2f}"
+                                          for id, wave, height, fwhm in zip(ids, peaks['wavelength'], peaks['height'], peaks['fwhm'])]))
+        if self.peaklog is not None:
+            self.peaklog.append(frame.timestamp, frame.seq, peaks, ids)
+
+    def peaks_change(self):
+        if self.findpeaks.get():
+            self.peakfinder = PeakFinder(self.wavelengths)
+            self.peaktracker = PeakTracker()
+            if self.after_id is None:
+                self.on_click()  #peaks are found as frames are displayed
+        else:
+            if self.peaklog is not None:
+                self.peaklog_toggle(None)
+            self.peakfinder = None
+            self.peaktracker = None
+            self.peakmarkers.set_data([], [])
+            self.peaktext.set_text("")
+            self.bm.update()
+
+    def peaklog_toggle(self, event):
+        if self.peaklog is None:
+            filenameforWriting = asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv"),("All files", "*.*")])
+            if not filenameforWriting:
+                return  #exits on Cancel
+            self.peaklog = PeakLog(filenameforWriting)
+            self.button_peaklog.configure(text='Stop peak log', background='light green')
+            if self.peakfinder is None:
+                self.findpeaks.set(1)
+                self.peaks_change()
+        else:
+            self.peaklog.close()
+            self.peaklog = None
+            self.button_peaklog.configure(text='Log peaks', background='light grey')
+
+    def load_library(self, event):
+        path = askdirectory(title="Reference library directory")
+        if not path:
+            return  #exits on Cancel
+        try:
+            library = ReferenceLibrary.load(path, self.wavelengths)  #resampled once if it was built on another grid
+        except ValueError as err:
+            messagebox.showerror("Library error", str(err))
+            return
+        self.library = library
+        self.button_library.configure(text=os.path.basename(os.path.normpath(path)) + " (" + str(len(library)) + ")")
+        if self.identifyvar.get() == self.identifynames[0]:
+            self.identifyvar.set(self.identifynames[1])
+        self.identify_change(self.identifyvar.get())
+
+    def identify_change(self, name):
+        method = self.identifynames.index(name)
+        if self.matcher is not None:
+            self.matcher.stop()
+            self.matcher = None
+            self.after_cancel(self.match_after)
+        if method == 0:
+            self.matchtext.set_text("")
+            self.bm.update()
+            return
+        if self.library is None:
+            self.identifyvar.set(self.identifynames[0])
+            self.load_library(None)
+            return
+        # best 5 of the references of the displayed kind (counts or absorbance); mixtures of the best 3
+        self.matcher = LiveMatcher(self.library, top=5, derivative=method in (2, 4), mixture=3 if method >= 3 else 0,
+                                   mode=self.DisplayCode)
+        self.match_seq = 0
+        self.show_matches()
+        if self.after_id is None:
+            self.on_click()  #displayed frames are what gets identified
+
+    def show_matches(self):
+        # newest result of the worker thread, four times a second; drawn with the next frame
+        self.matcher.mode = self.DisplayCode  #only references of the kind on screen
+        results = self.matcher.results
+        if results is not None and results[0] != self.match_seq:
+            seq, matches, mixture = results
+            self.match_seq = seq
+            names = self.library.names
+            lines = [f"{score:.3f}  {names[index]}" for index, score in matches]
+            if mixture is not None:
+                indices, amounts, r2 = mixture
+                lines.append(f"mixture (R² {r2:.3f}): " + " + ".join(f"{amount:.3g} {names[index]}"
+                                                                    for index, amount in zip(indices, amounts) if amount > 0))
+            self.matchtext.set_text("\n".join(lines) if lines else "no " + ("counts" if self.DisplayCode == 0 else "absorbance") +
+                                    " references")
+        self.match_after = self.after(250, self.show_matches)
+
+    def band_change(self):
+        if not self.showband.get() or self.average is None:
+            self.band_lo.set_data([], [])
+            self.band_hi.set_data([], [])
+
+    def live_average_change(self, event=None):
+        LiveFramesTemp = self.entrylive.get()
+        if LiveFramesTemp.isdigit() == True and int(LiveFramesTemp) > 0:
+            self.LiveFrames = int(LiveFramesTemp)
+        else:
+            msg = "Frames in the live average must be a positive integer.  You tried " + str(LiveFramesTemp) + "."
+            self.entrylive.delete(0, 'end')
+            self.entrylive.insert(0, self.LiveFrames)
+            messagebox.showerror("Entry error", msg)
+        self.reset_live_average()
+
+    def reset_live_average(self):
+        # start over, e.g. after the integration time changed
+        mode = self.liveavgnames.index(self.liveavgvar.get())
+        npix = len(self.wavelengths)
+        if mode == 1:
+            self.average = BoxcarAverage(npix, self.LiveFrames)
+        elif mode == 2:
+            self.average = ExponentialAverage.from_frames(npix, self.LiveFrames)
+        else:
+            self.average = None
+        self.band_change()
+
+    def kinetics_toggle(self, event):
+        if self.kinetics is None:
+            filenameforWriting = asksaveasfilename(defaultextension=".kin", filetypes=[("Kinetics logs", "*.kin"),("All files", "*.*")])
+            if not filenameforWriting:
+                return  #exits on Cancel
+            npix = len(self.wavelengths) if self.kinetics_spectra.get() else 0
+            self.kinetics = KineticsLog(filenameforWriting, npix, self.wavelengths[self.monitorindex], self.DisplayCode)
+            # the run keeps the wavelength and units its header describes, whatever the display switches to
+            self.kinetics_index = self.monitorindex
+            self.kinetics_mode = self.DisplayCode
+            self.kinetics_from = self.engine.latest_seq()  # start with the next frame; lastseq is the other consumers'
+            ylabel = 'Absorbance' if self.DisplayCode == 1 else 'Counts'
+            self.kinetics_window = KineticsWindow(self, self.kinetics, ylabel)
+            self.button_kinetics.configure(text='Stop Kinetics', background='light green')
+            self.check_kinetics_spectra.configure(state='disabled')
+            if self.after_id is None:
+                self.on_click()
+        else:
+            path = self.kinetics.path
+            dropped = self.kinetics.dropped
+            self.kinetics.close()
+            self.kinetics = None
+            self.button_kinetics.configure(text='Start Kinetics', background='light grey')
+            self.check_kinetics_spectra.configure(state='normal')
+            if self.kinetics_window.winfo_exists():
+                self.kinetics_window.finished(path)
+            if dropped:
+                messagebox.showwarning("Kinetics", str(dropped) + " frames were overwritten before the display could log them.")
+
+    def consume_frames(self, upto):
+        # every frame since the last one drawn goes to the live average, kinetics log and recorder, not only the ones that get drawn
+        # each frame is copied out of the ring and checked afterwards, so one overwritten during the copy is not used
+        for seq in range(self.lastseq + 1, upto + 1):
+            # a log or recording started since the last frame drawn takes only the frames after its start
+            kinetics = self.kinetics is not None and seq > self.kinetics_from
+            recording = self.recorder is not None and seq > self.record_from
+            frame = self.engine.read(seq, self.consumed)
+            if frame is None:
+                # already overwritten in the ring buffer: the display loop fell behind, the loss is counted
+                if kinetics:
+                    self.kinetics.missed(1)
+                if recording:
+                    self.recorder.missed(1)
+                continue
+            if self.replay is not None:
+                self.replay_references(seq)  #before the frame is logged or recorded
+            self.cache.put(frame)
+            if self.average is not None:
+                self.average.update(frame.ydata)
+            if kinetics:
+                value = self.processor.value_at(frame.ydata, self.kinetics_index, self.kinetics_mode)
+                self.kinetics.append(frame.timestamp, seq, value, frame.ydata if self.kinetics.npix else None)
+            if recording:
+                self.recorder.add(frame)
+        if self.recorder is not None and self.recorder.error is not None:
+            self.stop_recording()  # the file cannot be written (e.g. the card is full), stop instead of dropping everything
+        if self.kinetics is not None and self.kinetics_window.winfo_exists():
+            self.kinetics_window.update_chart()
+
+    def record_toggle(self, event):
+        if self.recorder is None:
+            filenameforWriting = asksaveasfilename(defaultextension=".psr", filetypes=[("Spectrum recordings", "*.psr"),("All files", "*.*")])
+            if not filenameforWriting:
+                return  #exits on Cancel
+            metadata = {'model': self.engine.model, 'display_code': self.DisplayCode,
+                        'monitorwave': float(self.wavelengths[self.monitorindex]), 'start': time.time()}
+            self.recorder = SpectrumRecorder(filenameforWriting, self.wavelengths, compress=bool(self.record_compress.get()), metadata=metadata)
+            self.recorder.set_references(self.processor.dark, self.processor.incident)
+            self.record_from = self.engine.latest_seq()  # record from the next frame on, without moving lastseq
+            self.button_record.configure(text='Stop Recording', background='light green')
+            self.check_record_compress.configure(state='disabled')
+            if self.after_id is None:
+                self.on_click()
+        else:
+            self.stop_recording()
+
+    def stop_recording(self):
+        recorder = self.recorder
+        self.recorder = None
+        self.button_record.configure(text='Record', background='light grey')
+        self.check_record_compress.configure(state='normal')
+        try:
+            recorder.close()  # waits for the writer thread to finish the last chunk
+        except (OSError, ValueError) as err:
+            messagebox.showerror("Recording", "The recording stopped, " + os.path.basename(recorder.path) + " is incomplete:\n" + str(err))
+            return
+        if recorder.dropped:
+            msg = str(recorder.dropped) + " of " + str(recorder.frames) + " frames were dropped (the display or the card could not keep up)."
+            messagebox.showwarning("Recording", msg)
+
+    def set_display_geometry(self, event=None):
+        # recompute the decimation only when the wavelength window or the plot width changes
+        self.decimator.set_geometry(self.xmin, self.xmax, self.ax1.bbox.width)
 
     def getdark(self, event):
-        dark = get_intensities()
-        self.dark = np.array(dark, dtype=float)
-        self.button_dark.configure(background = 'light green')
+        self.start_reference(self.processor.set_dark, self.button_dark)
         
     def getincident(self, event):
-        incident = get_intensities()
-        self.incident = np.array(incident, dtype=float)
-        self.button_incident.configure(background = 'light green')
+        self.start_reference(self.processor.set_incident, self.button_incident)
+
+    def start_reference(self, setreference, button):
+        stats = WelfordStats(len(self.wavelengths))
+        if not self.freshref.get():
+            # the newest RefFrames frames already acquired at the current settings, no waiting
+            frames = self.cache.recent(self.RefFrames, self.settings_seq)
+            if len(frames) == self.RefFrames:
+                self.refcapture = None  #supersedes a capture still running
+                for frame in frames:
+                    stats.update(frame.ydata)
+                self.finish_reference(setreference, button, stats)
+                return
+        # average RefFrames frames whose acquisition starts after the click; collected from the Tk loop so the window stays live
+        self.refcapture = (setreference, button, stats, self.engine.latest_seq() + 2)
+        button.configure(background = 'yellow')
+        self.capture_reference()
+
+    def capture_reference(self):
+        if self.refcapture is None:
+            return  #finished by an earlier click
+        setreference, button, stats, nextseq = self.refcapture
+        latest = self.engine.latest_seq()
+        for seq in range(nextseq, latest + 1):
+            frame = self.engine.frame(seq)
+            if frame is not None and stats.count < self.RefFrames:
+                stats.update(frame.ydata)
+        if stats.count < self.RefFrames:
+            if self.replay is not None and self.after_id is None:
+                self.engine.acknowledge(latest)  #nothing else takes replayed frames while the display is stopped
+            self.refcapture = (setreference, button, stats, max(nextseq, latest + 1))
+            self.after(10, self.capture_reference)
+            return
+        self.refcapture = None
+        self.finish_reference(setreference, button, stats)
+
+    def finish_reference(self, setreference, button, stats):
+        setreference(stats.mean)
+        if self.recorder is not None:
+            self.recorder.set_references(self.processor.dark, self.processor.incident)
+        button.configure(background = 'light green')
+
+    def EntryRef_return(self, event):
+        RefFramesTemp = self.entryref.get()
+        if RefFramesTemp.isdigit() == True and int(RefFramesTemp) > 0:
+            self.RefFrames = int(RefFramesTemp)
+        else:
+            msg = "Frames per reference must be a positive integer.  You tried " + str(RefFramesTemp) + ".  Setting value to 1."
+            self.RefFrames = 1
+            self.entryref.delete(0, 'end')
+            self.entryref.insert(0, self.RefFrames)
+            messagebox.showerror("Entry error", msg)
         
     def AbMode(self, event):
         if self.DisplayCode == 1:
@@ -269,19 +969,29 @@ class App(tk.Frame):
             self.button_AbMode.configure(text='Absorbance Mode (off)', background = 'light grey')
             self.reset_y(self)
             self.line.set_color('blue')
-            self.update_graph()
+            self.canvas.draw()
         else:
             self.DisplayCode = 1
             self.ax1.set_ylabel('Absorbance')
             self.ax1.set_ylim(-0.1,1.2)
             self.button_AbMode.configure(text='Absorbance Mode (on)', background = 'light green')
             self.line.set_color('red')
+            self.canvas.draw()
+
+    def displayed_counts(self):
+        # raw counts of the spectrum on screen: the live average, else the newest frame seen
+        if self.average is not None and self.average.count:
+            return np.array(self.average.mean)
+        frame = self.cache.latest()
+        if frame is None:
+            frame = self.engine.latest()  #the display has not run yet, the newest frame is as good
+        return np.array(frame.ydata)
 
     def reset_y(self, event):
         if self.DisplayCode == 0:
             index_xmin = np.searchsorted(self.wavelengths, self.xmin, side='left')
             index_xmax = np.searchsorted(self.wavelengths, self.xmax, side='left')
-            ydata = np.around(get_intensities(), decimals=2)
+            ydata = np.around(self.displayed_counts(), decimals=2)
             self.ymin = np.around(min(ydata[index_xmin:index_xmax])*0.9, decimals=2)
             self.ymax = np.around(max(ydata[index_xmin:index_xmax])*1.1, decimals=2)
             self.ax1.set_ylim(self.ymin, self.ymax)
@@ -291,6 +1001,9 @@ class App(tk.Frame):
 
 
     def EntryInt_return(self, event):
+        if self.exposure is not None and self.entryint.get() != str(self.IntTime):
+            self.autoexposure.set(0)  #a time typed in by hand ends auto integration time
+            self.auto_exposure_change()
         IntTimeTemp = self.entryint.get()
         if IntTimeTemp.isdigit() == True:
             if int(IntTimeTemp) > 65000:
@@ -336,6 +1049,7 @@ class App(tk.Frame):
                 self.xmaxentry.delete(0, 'end')
                 self.xmaxentry.insert(0, self.xmax)  #set text in xmax box
                 self.ax1.set_xlim(self.xmin, self.xmax)  # set the new value on plot area
+                self.set_display_geometry()
                 self.canvas.draw()
             else:
                 msg = "Minimum wavelength must be greater than " + str(self.xminlimit) + "nm and maximum smaller than " + str(self.xmaxlimit) + "nm.  Also, max greater than min.  You entered: min = " + str(xmintemp) + " nm and max = " + str(xmaxtemp) + " nm."
@@ -355,13 +1069,13 @@ class App(tk.Frame):
         try:
             float(monitorwavetemp)  #can string be converted to float?
             if (float(monitorwavetemp) < self.xmax) and (float(monitorwavetemp) > self.xmin): #entry is within current bounds
-                self.monitorindex = np.searchsorted(self.wavelengths, monitorwavetemp, side='left')
+                self.monitorindex = np.searchsorted(self.wavelengths, float(monitorwavetemp), side='left')
                 self.monitorwave = np.around(self.wavelengths[self.monitorindex], decimals=2)
                 self.entrymonitor.delete(0, 'end')
                 self.entrymonitor.insert(0,self.monitorwave)
-                self.ax1.lines[1].remove()
-                self.ax1.axvline(x=self.monitorwave, lw=2, color='blue', alpha  = 0.5)
-                self.canvas.draw()
+                self.monitors.set(0, self.monitorwave)
+                self.monitorline.set_xdata([self.monitorwave, self.monitorwave])  #animated, so a blit shows it
+                self.bm.update()
             else:
                 msg = "Monitored wavelength must be within the detected range.  Range is " + str(self.xmin) + " to " + str(self.xmax) + " nm."
                 self.entrymonitor.delete(0, 'end')
@@ -372,8 +1086,7 @@ class App(tk.Frame):
             self.entrymonitor.insert(0, self.monitorwave)
 
     def monitoraction(self, event):
-        self.monitorwave = self.entrymonitor.get()
-        self.ax1.axvline(x=self.monitorwave, lw=2, color='blue', alpha  = 0.5)
+        self.entrymonitor_return(event)
 
     def saveFile(self, event):
         filenameforWriting = asksaveasfilename(defaultextension=".txt", filetypes=[("Text files", "*.txt"),("All files", "*.*")])
@@ -382,8 +1095,8 @@ class App(tk.Frame):
         else:
             path_ext = os.path.splitext(filenameforWriting)
             xdata = np.asarray(self.wavelengths)
-            ydata = get_intensities()
-            ydata = np.asarray(ydata)
+            ydata = self.displayed_counts()  # what is on screen, without waiting for another acquisition
+            ydata = np.array(self.processor.process(ydata, self.DisplayCode))  # save what the header says, not always raw counts
             file_to_write = str(path_ext[0] + path_ext[1])
 
             if self.DisplayCode == 0:
@@ -395,14 +1108,124 @@ class App(tk.Frame):
 
     def ButtonQuit(self):
         self.StopCode = True
+        if self.after_id is not None:
+            self.after_cancel(self.after_id)
+        if self.kinetics is not None:
+            self.kinetics.close()
+        if self.recorder is not None:
+            self.stop_recording()  # a write error is shown, and quitting goes on
+        if self.peaklog is not None:
+            self.peaklog.close()
+        if self.matcher is not None:
+            self.matcher.stop()
+        self.startup.stop()  # the engine, or the spectrometers opened so far
+        if self.timing is not None and self.timing_log and self.timing.frames:
+            self.timing.dump(self.timing_log)
         App.destroy(self)
         tk.Frame.quit(self)
         exit(0)
 
 ## end Shared (OO/Stellarnet) defs
 
+class KineticsWindow(tk.Toplevel):
+    # strip chart of a kinetics run, read straight from the memory-mapped log
+    def __init__(self, master, log, ylabel, span=600):
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
+        tk.Toplevel.__init__(self, master)
+        self.wm_title("Kinetics:  " + os.path.basename(log.path))
+        self.log = log
+        self.span = span  #number of most recent points shown while running
+        self.last_draw = 0
+        self.fig = Figure(figsize=(6.0, 3.0))
+        self.ax = self.fig.add_subplot(111)
+        self.ax.set_xlabel('Time (s)')
+        self.ax.set_ylabel(ylabel)
+        self.ax.grid(True, color='0.3', ls='dotted')
+        self.line, = self.ax.plot([], [], lw=1, color='red')
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self)
+        self.canvas.get_tk_widget().pack(fill="both", expand=True)
+        self.button_export = tk.Button(self, text='Export CSV', state='disabled', command=self.export)
+        self.button_export.pack(side=tk.RIGHT)
+
+    def update_chart(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_draw < 0.25:  #a few redraws per second are plenty for a strip chart
+            return
+        self.last_draw = now
+        rows = self.log.tail(self.span)
+        if len(rows) == 0:
+            return
+        self.line.set_data(rows['timestamp'] - self.log.start, rows['value'])
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.canvas.draw_idle()
+
+    def finished(self, path):
+        # the run is over: show all of it and allow export
+        self.log = KineticsLog.open(path)
+        self.span = self.log.count
+        self.update_chart(force=True)
+        self.button_export.configure(state='normal')
+
+    def export(self):
+        filenameforWriting = asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv"),("All files", "*.*")])
+        if filenameforWriting:
+            self.log.export_csv(filenameforWriting, spectra=bool(self.log.npix), wavelengths=self.master.wavelengths)
+
+
+class MonitorWindow(tk.Toplevel):
+    # the monitor table: wavelengths and bands to watch, their values are shown on the spectrum
+    def __init__(self, master):
+        tk.Toplevel.__init__(self, master)
+        self.wm_title("Monitored wavelengths and bands")
+        self.app = master
+        tk.Label(self, text='Wavelength (nm)').grid(column=0, row=0, pady=2)
+        self.entrycenter = tk.Entry(self, width='7')
+        self.entrycenter.grid(column=1, row=0, pady=2)
+        tk.Label(self, text='± nm (0 for one wavelength)').grid(column=0, row=1, pady=2)
+        self.entrywidth = tk.Entry(self, width='7')
+        self.entrywidth.grid(column=1, row=1, pady=2)
+        self.entrywidth.insert(0, 0)
+        self.entrycenter.bind('<Return>', self.add) and self.entrywidth.bind('<Return>', self.add)
+        self.button_add = tk.Button(self, text='Add', command=self.add)
+        self.button_add.grid(column=1, row=2, pady=2)
+        self.listbox = tk.Listbox(self, height=8, width=32)
+        self.listbox.grid(column=0, row=3, columnspan=2, pady=2)
+        self.button_remove = tk.Button(self, text='Remove', command=self.remove)
+        self.button_remove.grid(column=1, row=4, pady=2)
+        self.refresh()
+
+    def refresh(self):
+        monitors = self.app.monitors
+        self.listbox.delete(0, 'end')
+        self.listbox.insert('end', "main:  " + monitors.label(0))
+        for row in range(1, len(monitors)):
+            self.listbox.insert('end', str(row) + ":  " + monitors.label(row))
+
+    def add(self, event=None):
+        app = self.app
+        try:
+            center = float(self.entrycenter.get())
+            width = abs(float(self.entrywidth.get()))
+        except ValueError:
+            messagebox.showerror("Entry error", "Wavelength and width must be numbers.", parent=self)
+            return
+        if not app.xminlimit <= center <= app.xmaxlimit:
+            msg = "Monitored wavelengths must be within the detected range.  Range is " + str(app.xminlimit) + " to " + str(app.xmaxlimit) + " nm."
+            messagebox.showerror("Entry error", msg, parent=self)
+            return
+        app.add_monitor(center, width)
+        self.entrycenter.delete(0, 'end')
+
+    def remove(self):
+        selection = self.listbox.curselection()
+        if selection:
+            self.app.remove_monitor(selection[0])
+
+
 class BlitManager:
-    def __init__(self, canvas, animated_artists=()):
+    def __init__(self, canvas, animated_artists=(), timing=None, flush=True):
         """
         Parameters
         ----------
@@ -413,25 +1236,61 @@ class BlitManager:
 
         animated_artists : Iterable[Artist]
             List of the artists to manage
+
+        timing : StageTimer or None
+            Times restore_region, drawing, blit and flush_events of update()
+
+        flush : bool
+            Call flush_events after each blit.  Not needed when update() is
+            called from the GUI event loop, which repaints by itself.
+
+        Only the dirty region -- the axes of the artists plus the boxes of
+        text artists, which may stick out of the axes -- is restored and
+        blitted.  Its background is kept until the figure is drawn again,
+        which happens after a resize or a change of the axis limits.
         """
         self.canvas = canvas
+        self.timing = timing
+        self.flush = flush
         self._bg = None
+        self._region = None
+        self._key = None
+        self._dirty = True  # redraw even if the data did not change
         self._artists = []
+        self._texts = []
+        self._text_lengths = []  # longest text of each text artist known to fit the region
 
         for a in animated_artists:
             self.add_artist(a)
         # grab the background on every draw
         self.cid = canvas.mpl_connect("draw_event", self.on_draw)
+        self.resize_cid = canvas.mpl_connect("resize_event", self.invalidate)
 
     def on_draw(self, event):
         """Callback to register with 'draw_event'."""
+        from matplotlib.transforms import Bbox
         cv = self.canvas
         if event is not None:
             if event.canvas != cv:
                 raise RuntimeError
-        self._bg = cv.copy_from_bbox(cv.figure.bbox)
+        renderer = cv.get_renderer()
+        boxes = [ax.bbox for ax in self._axes()] + [a.get_window_extent(renderer) for a in self._texts]
+        self._region = Bbox.union(boxes).padded(2) if boxes else cv.figure.bbox
+        self._text_lengths = [len(a.get_text()) for a in self._texts]
+        self._bg = cv.copy_from_bbox(self._region)
         self._draw_animated()
 
+    def _axes(self):
+        axes = []
+        for a in self._artists:
+            if a.axes is not None and a.axes not in axes:
+                axes.append(a.axes)
+        return axes
+
+    def invalidate(self, *args):
+        """Drop the cached background; the next update() draws the whole figure."""
+        self._bg = None
+
     def add_artist(self, art):
         """
         Add an artist to be managed.
@@ -448,7 +1307,24 @@ class BlitManager:
         if art.figure != self.canvas.figure:
             raise RuntimeError
         art.set_animated(True)
+        if art.axes is not None and art.axes not in self._axes():
+            # new limits move everything, so the background is redrawn
+            art.axes.callbacks.connect('xlim_changed', self.invalidate)
+            art.axes.callbacks.connect('ylim_changed', self.invalidate)
         self._artists.append(art)
+        if hasattr(art, 'get_text'):
+            self._texts.append(art)
+            self._text_lengths.append(0)
+            self._bg = None  # the region has to include its box
+        self._dirty = True
+
+    def remove_artist(self, art):
+        """Stop managing *art*."""
+        self._artists.remove(art)
+        if art in self._texts:
+            del self._text_lengths[self._texts.index(art)]
+            self._texts.remove(art)
+        self._dirty = True
 
     def _draw_animated(self):
         """Draw all of the animated artists."""
@@ -456,30 +1332,96 @@ class BlitManager:
         for a in self._artists:
             fig.draw_artist(a)
 
-    def update(self):
-        """Update the screen with animated artists."""
+    def _texts_inside(self):
+        # text that grew out of the region needs a larger one; the text layout is
+        # only measured when a text is longer than any that was found to fit
+        region = self._region
+        for i, a in enumerate(self._texts):
+            n = len(a.get_text())
+            if n > self._text_lengths[i]:
+                box = a.get_window_extent(self.canvas.get_renderer())
+                if box.x0 < region.x0 or box.y0 < region.y0 or box.x1 > region.x1 or box.y1 > region.y1:
+                    return False
+                self._text_lengths[i] = n
+        return True
+
+    def update(self, key=None):
+        """
+        Update the screen with animated artists.
+
+        *key* identifies what is shown, e.g. a hash of the data; when it is
+        the same as last time and nothing else changed, nothing is redrawn.
+        """
+        if key is not None and key == self._key and not self._dirty and self._bg is not None:
+            return
+        self._key = key
+        self._dirty = False
         cv = self.canvas
-        fig = cv.figure
-        # paranoia in case we missed the draw event,
-        #...let's try removing the paranoia??
+        timing = self.timing
         if self._bg is None:
-            self.on_draw(None)
+            cv.draw()  # full redraw, on_draw grabs the new background
+            if timing is not None:
+                timing.lap(DRAW)
         else:
             # restore the background
             cv.restore_region(self._bg)
+            if timing is not None:
+                timing.lap(RESTORE)
             # draw all of the animated artists
             self._draw_animated()
-            # update the GUI state
-            cv.blit(fig.bbox)
-        # let the GUI event loop process anything it has to do
-        cv.flush_events()
+            if timing is not None:
+                timing.lap(DRAW)
+            if self._texts_inside():
+                # update the GUI state
+                cv.blit(self._region)
+            else:
+                cv.draw()  # a text outgrew the region, on_draw takes a larger one
+            if timing is not None:
+                timing.lap(BLIT)
+        if self.flush:
+            # let the GUI event loop process anything it has to do
+            cv.flush_events()
+            if timing is not None:
+                timing.lap(FLUSH)
+
+
+class StartupProfile:
+    # time from launch to each startup stage, printed by --profile-startup to compare OS images and hardware
+    def __init__(self):
+        self.marks = [("imports", IMPORTED)]
+
+    def mark(self, stage):
+        self.marks.append((stage, time.perf_counter()))
 
+    def report(self, file=sys.stdout):
+        import matplotlib
+        print("Startup profile  (Python " + platform.python_version() + ", numpy " + np.__version__ +
+              ", matplotlib " + matplotlib.__version__ + ", Tk " + str(tk.TkVersion) + ", " + platform.platform() + ")", file=file)
+        print("  {:<18} {:>9} {:>9}".format("stage", "step (s)", "total (s)"), file=file)
+        last = STARTED
+        for stage, t in self.marks:
+            print("  {:<18} {:9.3f} {:9.3f}".format(stage, t - last, t - STARTED), file=file)
+            last = t
 
 
 def main():
+    parser = argparse.ArgumentParser(description="StellarNet Spectrometer Control")
+    parser.add_argument('--simulate', action='store_true', help="use the simulated spectrometer instead of the StellarNet driver")
+    parser.add_argument('--profile-startup', action='store_true', help="print how long each startup stage takes, then quit")
+    parser.add_argument('--max-fps', type=float, default=60, help="most redraws per second, normally the screen refresh rate (default 60)")
+    parser.add_argument('--no-timing', action='store_true', help="turn off the display loop timing (frame rate and stage latencies)")
+    parser.add_argument('--replay', metavar='PATH', help="play back a recording, or a directory of saved raw count spectra, instead of a spectrometer")
+    parser.add_argument('--speed', type=parse_speed, default=1.0,
+                        help="replay speed: 1 is the recorded pace, 10 ten times faster, max as fast as possible (default 1)")
+    parser.add_argument('--timing-log', default=os.path.join(os.path.expanduser('~'), 'pispec_timing.log'),
+                        help="file the stage latency histograms are appended to on quit (default ~/pispec_timing.log)")
+    args = parser.parse_args()
+    profile = StartupProfile() if args.profile_startup else None
+    timing = None if args.no_timing else StageTimer()
     root = tk.Tk()
     root.wm_title("StellarNet Spectrometer Control")
-    app = App(root)
+    app = App(root, driver='simulated' if args.simulate else 'stellarnet', profile=profile,
+              timing=timing, timing_log=args.timing_log, max_fps=args.max_fps, replay=args.replay, speed=args.speed)
     app.pack()
     root.mainloop()
 
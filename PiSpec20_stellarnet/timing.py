@@ -0,0 +1,123 @@
+# Hot path timing
+# Each stage of the display loop is timed with the monotonic perf_counter and
+# counted in a fixed histogram with log-spaced buckets.  Recording a sample is a
+# bisect and an increment into lists made up front, so nothing is allocated per
+# frame; percentiles are read from the histograms only when they are shown.
+# Code that is timed holds a StageTimer or None, with timing off the only cost
+# left in the hot path is the "is not None" test.
+
+import time
+from bisect import bisect_left
+
+# stages of App.update_graph and BlitManager.update, in the order they run
+AGE = 0        # frame written by the acquisition process -> picked up by the display loop
+ACQUIRE = 1    # reading the frame(s) from the ring buffer, live average, kinetics log, recorder
+PROCESS = 2    # absorbance/transmittance and decimation (NumPy)
+ARTISTS = 3    # set_data / set_text
+RESTORE = 4    # BlitManager: restore_region
+DRAW = 5       # BlitManager: draw the animated artists
+BLIT = 6       # BlitManager: blit
+FLUSH = 7      # BlitManager: flush_events
+GC = 8         # gc.collect()
+FRAME = 9      # the whole update, from picking up the frame to the end of the blit
+STAGES = ('age', 'acquire', 'process', 'artists', 'restore', 'draw', 'blit', 'flush', 'gc', 'frame')
+
+# upper bucket edges in seconds, 10 per decade from 1 us to 100 s (a bucket is +26 %)
+EDGES = [10 ** (k / 10.0) * 1e-6 for k in range(81)]
+
+
+class StageTimer:
+    """Latency histograms for the stages above, plus a frame counter for the frame rate."""
+
+    def __init__(self, stages=STAGES):
+        self.stages = stages
+        self.counts = [[0] * (len(EDGES) + 1) for stage in stages]  # last bucket: longer than EDGES[-1]
+        self.maxima = [0.0] * len(stages)
+        self.t0 = 0.0
+        self.frame_t0 = 0.0
+        self.active = False  # between start() and end_frame(); laps outside a timed frame are not counted
+        self.frames = 0
+        self.fps_frames = 0
+        self.fps_time = time.perf_counter()
+        self.started = time.time()
+
+    def start(self):
+        """Start timing a frame; the first lap() is measured from here."""
+        self.t0 = self.frame_t0 = time.perf_counter()
+        self.active = True
+
+    def lap(self, stage):
+        """Count the time since start() or the previous lap() towards *stage*."""
+        if not self.active:
+            return  # e.g. a redraw after a settings change, outside any frame
+        now = time.perf_counter()
+        self.add(stage, now - self.t0)
+        self.t0 = now
+
+    def add(self, stage, seconds):
+        self.counts[stage][bisect_left(EDGES, seconds)] += 1
+        if seconds > self.maxima[stage]:
+            self.maxima[stage] = seconds
+
+    def end_frame(self):
+        self.add(FRAME, time.perf_counter() - self.frame_t0)
+        self.frames += 1
+        self.active = False
+
+    def fps(self):
+        """Frames per second since the previous call."""
+        now = time.perf_counter()
+        fps = (self.frames - self.fps_frames) / (now - self.fps_time) if now > self.fps_time else 0.0
+        self.fps_frames = self.frames
+        self.fps_time = now
+        return fps
+
+    def samples(self, stage):
+        return sum(self.counts[stage])
+
+    def percentile(self, stage, q):
+        """Upper edge (seconds) of the bucket holding the *q* th percentile, at most the maximum; None without samples."""
+        counts = self.counts[stage]
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = q / 100.0 * total
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= rank and count:
+                return min(EDGES[i], self.maxima[stage]) if i < len(EDGES) else self.maxima[stage]
+        return self.maxima[stage]
+
+    def status(self):
+        """Short text for the status bar: frame rate and p50/p99 (ms) of the stages that ran."""
+        parts = ["{:.1f} fps".format(self.fps())]
+        for stage, name in enumerate(self.stages):
+            if self.samples(stage):
+                parts.append("{} {:.2g}/{:.2g}".format(name, self.percentile(stage, 50) * 1000,
+                                                       self.percentile(stage, 99) * 1000))
+        return "   ".join(parts) + "  ms (p50/p99)"
+
+    def report(self):
+        """Percentile table of every stage, and the non-empty histogram buckets."""
+        elapsed = time.time() - self.started
+        lines = ["Display loop timing, " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)) +
+                 ", {} frames in {:.1f} s ({:.1f} fps)".format(self.frames, elapsed, self.frames / elapsed if elapsed > 0 else 0.0),
+                 "{:<10}{:>9}{:>10}{:>10}{:>10}{:>10}".format("stage", "samples", "p50 ms", "p90 ms", "p99 ms", "max ms")]
+        for stage, name in enumerate(self.stages):
+            n = self.samples(stage)
+            if n:
+                lines.append("{:<10}{:>9}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+                    name, n, *[self.percentile(stage, q) * 1000 for q in (50, 90, 99)], self.maxima[stage] * 1000))
+        lines.append("histograms, samples per bucket (upper edge in ms)")
+        for stage, name in enumerate(self.stages):
+            buckets = ["<={:.3g}:{}".format(EDGES[i] * 1000 if i < len(EDGES) else float('inf'), count)
+                       for i, count in enumerate(self.counts[stage]) if count]
+            if buckets:
+                lines.append("{:<10}".format(name) + " ".join(buckets))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Append report() to *path*."""
+        with open(path, 'a') as f:
+            f.write(self.report() + "\n")
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from batch import read_spectrum
+from processing import RAW, ABSORBANCE
+
+
+def test_saved_spectrum(tmp_path):
+    path = tmp_path / 'a.txt'
+    np.savetxt(path, np.transpose([[400.0, 401.0, 402.0], [1.5, 2.5, 3.5]]), delimiter=',', newline='\n',
+               header="# Wavelength (nm), Absorbance", comments='')
+    x, y, mode = read_spectrum(str(path))
+    assert mode == ABSORBANCE
+    assert x.tolist() == [400.0, 401.0, 402.0] and y.tolist() == [1.5, 2.5, 3.5]
+
+
+@pytest.mark.parametrize('body', [b'400,1\n401,2\n402,x\n403,4\n',   # stops at x with an even number of values
+                                  b'400,1\n401,2,3\n402\n',         # right count, wrong rows
+                                  b'400,1\n401\n',
+                                  b''])
+def test_malformed_spectrum_is_rejected(tmp_path, body):
+    path = tmp_path / 'bad.txt'
+    path.write_bytes(b'# Wavelength (nm), Count\n' + body)
+    with pytest.raises(ValueError, match="not a wavelength,value file"):
+        read_spectrum(str(path))
+
+
+def test_without_header(tmp_path):
+    path = tmp_path / 'raw.txt'
+    path.write_bytes(b'400,10\r\n401,20\r\n')
+    x, y, mode = read_spectrum(str(path))
+    assert mode == RAW and y.tolist() == [10.0, 20.0]
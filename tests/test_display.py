@@ -0,0 +1,30 @@
+import numpy as np
+
+from display import LineDecimator
+
+
+def test_columns_keep_their_min_and_max():
+    wavelengths = np.linspace(300.0, 900.0, 2048)
+    ydata = np.random.default_rng(1).normal(size=2048)
+    ydata[1000] = 50.0  # a line one pixel wide must survive the decimation
+    ydata[1500] = np.nan
+    decimator = LineDecimator(wavelengths)
+    assert decimator.set_geometry(300.0, 900.0, 100)
+    assert not decimator.set_geometry(300.0, 900.0, 100)  # nothing to redo
+    x, y = decimator.decimate(ydata)
+    assert len(x) == len(y) == 200
+    assert np.nanmax(y) == 50.0
+    visible = ydata[decimator.i0:decimator.i1]
+    columns = np.split(visible, decimator.starts[1:])
+    assert np.array_equal(y[0::2], [np.nanmin(c) for c in columns])
+    assert np.array_equal(y[1::2], [np.nanmax(c) for c in columns])
+
+
+def test_narrow_window_is_drawn_in_full():
+    wavelengths = np.linspace(300.0, 900.0, 2048)
+    ydata = np.arange(2048.0)
+    decimator = LineDecimator(wavelengths)
+    decimator.set_geometry(500.0, 510.0, 800)
+    x, y = decimator.decimate(ydata)
+    assert np.array_equal(y, ydata[decimator.i0:decimator.i1]) and np.array_equal(x, wavelengths[decimator.i0:decimator.i1])
+    assert x[0] < 500.0 and x[-1] > 510.0  # one pixel past each edge
@@ -0,0 +1,31 @@
+import pytest
+
+from exposure import AutoExposure
+
+
+def detector(offset, rate, full_scale=65535):
+    return lambda int_time: min(offset + rate * int_time, full_scale)
+
+
+@pytest.mark.parametrize('offset, rate', [(0, 500.0), (1500, 500.0), (3000, 40.0)])
+@pytest.mark.parametrize('start', [3, 20, 400, 5000])
+def test_converges_within_three_steps(offset, rate, start):
+    peak = detector(offset, rate)
+    control = AutoExposure(target=0.8, tolerance=0.02)
+    int_time, steps = start, 0
+    for k in range(10):
+        if steps or peak(int_time) < 0.98 * 65535:
+            steps += 1  # saturated frames are backed off geometrically first, the count starts on scale
+        new = control.update(int_time, peak(int_time))
+        if new is None:
+            break
+        int_time = new
+    assert control.converged and steps <= 3
+    assert abs(peak(int_time) / 65535 - 0.8) <= 0.02
+
+
+def test_limits():
+    control = AutoExposure(max_int_time=1000)
+    assert control.update(500, 100.0) == 1000  # far too dark, but not beyond the longest time
+    control = AutoExposure(min_int_time=3)
+    assert control.update(4, 65535) == 3
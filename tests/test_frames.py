@@ -0,0 +1,77 @@
+import errno
+import time
+
+import numpy as np
+import pytest
+
+from acquisition import Frame, FrameCache, FrameRing
+from kinetics import KineticsLog
+from recorder import SpectrumRecorder
+
+
+def test_ring_read_copies_and_detects_overwrite():
+    ring = FrameRing(4, nslots=4)
+    try:
+        out = np.empty(4)
+        for i in range(1, 7):
+            ring.write(np.full(4, float(i)), 100.0 + i, 20, 1)
+        frame = ring.read(6, out)
+        assert frame.ydata is out and out.tolist() == [6.0] * 4
+        assert (frame.seq, frame.timestamp, frame.int_time, frame.averages) == (6, 106.0, 20, 1)
+        assert ring.read(2, out) is None  # lapped by frame 6
+    finally:
+        ring.close()
+
+
+def test_cache_keeps_only_checked_copies():
+    ring = FrameRing(4, nslots=4)
+    cache = FrameCache(4, history=8)
+    try:
+        for i in range(1, 7):
+            ring.write(np.full(4, float(i)), 100.0 + i, 20, 1)
+        assert cache.read(ring, 6).ydata.tolist() == [6.0] * 4
+        assert cache.read(ring, 1) is None  # overwritten, not cached
+        ring.write(np.full(4, 7.0), 107.0, 20, 1)  # the ring slot is reused, the cached copy stays
+        assert [frame.seq for frame in cache.recent(4)] == [6]
+        assert cache.latest().ydata.tolist() == [6.0] * 4
+    finally:
+        ring.close()
+
+
+def test_missed_frames_are_counted(tmp_path):
+    recorder = SpectrumRecorder(str(tmp_path / 'run.psr'), np.arange(4.0))
+    recorder.missed(3)
+    recorder.close()
+    assert (recorder.frames, recorder.dropped) == (3, 3)
+    log = KineticsLog(str(tmp_path / 'run.kin'))
+    log.missed(2)
+    log.close()
+    assert KineticsLog.open(str(tmp_path / 'run.kin')).dropped == 2
+
+
+class FullCard:
+    # a file that takes the header, then fails like a full SD card
+    def __init__(self, file):
+        self.file = file
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def close(self):
+        self.file.close()
+
+
+def test_write_error_stops_writing_and_is_raised_on_close(tmp_path):
+    recorder = SpectrumRecorder(str(tmp_path / 'run.psr'), np.arange(4.0), chunk_frames=2)
+    recorder.file = FullCard(recorder.file)
+    for i in range(1, 7):
+        recorder.add(Frame(i, 100.0 + i, 20, 1, np.full(4, float(i))))
+    deadline = time.monotonic() + 5
+    while recorder.error is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert recorder.error is not None and recorder.error.errno == errno.ENOSPC
+    with pytest.raises(OSError):
+        recorder.close()
+    assert recorder.file.writes == 1  # the chunks after the failed one were not written
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from library import ReferenceLibrary
+
+WAVELENGTHS = np.linspace(400.0, 700.0, 1024)
+
+
+def band(center, width):
+    return np.exp(-0.5 * ((WAVELENGTHS - center) / width) ** 2)
+
+
+@pytest.fixture
+def library(tmp_path):
+    paths = []
+    for name, center in (('red', 620.0), ('green', 530.0), ('blue', 460.0)):
+        path = tmp_path / (name + '.txt')
+        np.savetxt(path, np.transpose([WAVELENGTHS, band(center, 20.0)]), delimiter=',',
+                   header="# Wavelength (nm), Absorbance", comments='')
+        paths.append(str(path))
+    return ReferenceLibrary.build(paths, WAVELENGTHS)
+
+
+def test_scores_are_cosine_similarities(library):
+    spectrum = 3.0 * band(530.0, 20.0) + 0.5  # scale and baseline do not change the shape
+    scores = library.scores(spectrum)
+    assert scores[library.names.index('green')] == pytest.approx(1.0, abs=1e-5)
+    centred = [row - row.mean() for row in (band(c, 20.0) for c in (620.0, 530.0, 460.0))]
+    live = spectrum - spectrum.mean()
+    expected = [np.dot(row, live) / np.linalg.norm(row) / np.linalg.norm(live) for row in centred]
+    assert np.allclose(scores, expected, atol=1e-5)
+    assert np.all(scores <= 1.0 + 1e-6) and np.all(scores >= -1.0 - 1e-6)
+
+
+def test_derivative_scores_ignore_a_sloped_baseline(library):
+    spectrum = band(460.0, 20.0) + 0.002 * (WAVELENGTHS - 400.0)
+    assert library.match(spectrum, top=1, derivative=True)[0][0] == library.names.index('blue')
+    assert library.scores(np.full(len(WAVELENGTHS), np.nan)).tolist() == [0.0, 0.0, 0.0]  # nothing to compare
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from monitor import MonitorTable
+
+
+def test_wavelengths_and_band_integrals():
+    wavelengths = np.arange(400.0, 500.25, 0.5)
+    table = MonitorTable(wavelengths)
+    table.add(450.2)
+    table.add(450.0, 5.0)
+    table.add(420.0, 10.0)
+    ydata = np.where(wavelengths < 440.0, 1.0, 2.0)
+    ydata[wavelengths == 415.0] = np.nan  # undefined pixels count as zero
+    values = table.evaluate(ydata)
+    assert values[0] == 2.0 and table.label(0) == "450.50 nm"
+    assert values[1] == pytest.approx(2.0 * 10.0, abs=2.0 * 0.5)  # 2 over 445..455 nm, within a pixel
+    assert values[2] == pytest.approx(1.0 * 20.0 - 0.5, abs=0.5)
+    table.remove(1)
+    assert len(table) == 2 and table.evaluate(ydata)[1] == pytest.approx(values[2])
@@ -0,0 +1,43 @@
+import numpy as np
+
+from peaks import PeakFinder, PeakTracker
+
+
+def gaussian(wavelengths, center, sigma, height):
+    return height * np.exp(-0.5 * ((wavelengths - center) / sigma) ** 2)
+
+
+def test_finds_position_and_width():
+    wl = np.linspace(280.0, 900.0, 2048)
+    y = 1000 + gaussian(wl, 450.0, 3.0, 20000) + gaussian(wl, 600.0, 5.0, 8000)
+    peaks = PeakFinder(wl).find(y)
+    assert len(peaks) == 2
+    assert np.allclose(peaks['wavelength'], [450.0, 600.0], atol=0.05)
+    assert np.allclose(peaks['fwhm'], 2.3548 * np.array([3.0, 5.0]), rtol=0.01)
+    assert np.allclose(peaks['prominence'], [20000, 8000], rtol=0.01)
+
+
+def test_narrower_search_after_wider_one():
+    # the padding past a narrow range must stop the search like the edge does, not hold pixels of an earlier, wider search
+    wl = np.linspace(400.0, 500.0, 1000)
+    y = np.zeros(1000)
+    y[598], y[599] = 10.0, 5.0  # a peak next to the right edge of the range 0..600
+    fresh = PeakFinder(wl).find(y, 0, 600)
+    finder = PeakFinder(wl)
+    wide = np.zeros(1000)
+    wide[100] = 1.0
+    finder.find(wide, 0, 1000)
+    reused = finder.find(y, 0, 600)
+    assert fresh['prominence'].tolist() == [5.0]
+    assert np.array_equal(fresh['index'], reused['index'])
+    assert np.allclose(fresh['prominence'], reused['prominence'])
+    assert np.allclose(fresh['fwhm'], reused['fwhm'])
+
+
+def test_tracker_keeps_numbers_while_peaks_drift():
+    wl = np.linspace(280.0, 900.0, 2048)
+    finder, tracker = PeakFinder(wl), PeakTracker(search=2.0)
+    for shift in (0.0, 0.5, 1.0):
+        y = gaussian(wl, 450.0 + shift, 3.0, 20000) + gaussian(wl, 600.0 + shift, 5.0, 8000)
+        ids = tracker.update(finder.find(y))
+    assert ids.tolist() == [1, 2]
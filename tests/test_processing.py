@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from processing import SpectrumProcessor, RAW, ABSORBANCE, TRANSMITTANCE
+
+
+@pytest.fixture
+def processor():
+    processor = SpectrumProcessor(6)
+    processor.set_dark(np.full(6, 100.0))
+    processor.set_incident(np.array([1100.0, 600.0, 2100.0, 100.0, 50.0, 1100.0]))  # pixels 3 and 4: no light
+    return processor
+
+
+SAMPLE = np.array([600.0, 350.0, 100.0, 600.0, 600.0, 80.0])  # pixel 2 at dark, pixel 5 below it
+
+
+def test_transmittance_and_absorbance_closed_form(processor):
+    ok = np.array([True, True, False, False, False, False])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        transmittance = (SAMPLE - processor.dark) / (processor.incident - processor.dark)
+    t = processor.process(SAMPLE, TRANSMITTANCE).copy()
+    a = processor.process(SAMPLE, ABSORBANCE).copy()
+    assert np.allclose(t[ok], transmittance[ok]) and np.allclose(a[ok], -np.log10(transmittance[ok]))
+    assert np.isnan(t[~ok]).all() and np.isnan(a[~ok]).all()
+    assert np.array_equal(processor.process(SAMPLE, RAW), SAMPLE)
+
+
+@pytest.mark.parametrize('mode', [RAW, ABSORBANCE, TRANSMITTANCE])
+def test_value_at_agrees_with_process(processor, mode):
+    processed = processor.process(SAMPLE, mode).copy()
+    values = np.array([processor.value_at(SAMPLE, i, mode) for i in range(len(SAMPLE))])
+    assert np.allclose(values, processed, equal_nan=True)
+
+
+def test_new_reference_is_taken_up(processor):
+    processor.set_incident(np.full(6, 1100.0))
+    assert processor.value_at(SAMPLE, 3, TRANSMITTANCE) == pytest.approx(0.5)
@@ -0,0 +1,52 @@
+import time
+
+import numpy as np
+
+from acquisition import Frame
+from recorder import SpectrumRecorder
+from replay import ReplaySource, MAX
+
+
+def record(path, frames, npix=256, interval=0.003):
+    recorder = SpectrumRecorder(str(path), np.linspace(300.0, 900.0, npix), queue_chunks=64, metadata={'model': 'Sim'})
+    for i in range(frames):
+        recorder.add(Frame(i + 1, 1000.0 + i * interval, 3, 1, np.full(npix, float(i))))
+    recorder.close()
+    assert recorder.dropped == 0
+
+
+def test_max_speed_never_laps_a_slow_consumer(tmp_path):
+    # frames are only taken every so often, and latest() is called more often than that, like the display loop does
+    record(tmp_path / 'run.psr', 600)
+    source = ReplaySource(str(tmp_path / 'run.psr'), MAX)
+    try:
+        lastseq, values, ticks = 0, [], 0
+        deadline = time.monotonic() + 30
+        while len(values) < 600 and time.monotonic() < deadline:
+            frame = source.latest()
+            source.latest_seq()
+            ticks += 1
+            if frame is None or frame.seq == lastseq or ticks % 5:
+                time.sleep(0.001)
+                continue
+            for seq in range(lastseq + 1, frame.seq + 1):
+                values.append(source.frame(seq).ydata[0])
+            lastseq = frame.seq
+            source.acknowledge(lastseq)
+        assert values == [float(i) for i in range(600)]
+    finally:
+        source.stop()
+
+
+def test_recorded_pace(tmp_path):
+    record(tmp_path / 'run.psr', 50, interval=0.01)
+    source = ReplaySource(str(tmp_path / 'run.psr'), 2.0)
+    try:
+        start = time.monotonic()
+        seq = 0
+        while seq < 50:
+            seq = source.wait_frame(seq + 1, timeout=10).seq
+            source.acknowledge(seq)
+        assert 0.2 <= time.monotonic() - start < 1.0  # 49 gaps of 10 ms at twice the speed
+    finally:
+        source.stop()
@@ -0,0 +1,115 @@
+import json
+import socket
+import asyncio
+
+import pytest
+
+from acquisition import start_acquisition
+from server import serve, pack, read_message, unpack_frame
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.setenv('PISPEC_SIM_PIXELS', '256')
+    monkeypatch.setenv('PISPEC_SIM_LATENCY', '0.2')
+    engine = start_acquisition('simulated', int_time=10, max_devices=1)
+    yield engine
+    engine.stop()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def command(reader, writer, request):
+    writer.write(pack(b'CMND', json.dumps(request).encode()))
+    while True:
+        tag, payload = await read_message(reader)
+        if tag != b'FRAM':
+            return tag, json.loads(payload.decode())
+
+
+async def connect(port):
+    for _ in range(100):
+        try:
+            return await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            await asyncio.sleep(0.02)
+    raise OSError("server did not start")
+
+
+def test_frames_and_commands_over_loopback(engine):
+    async def session():
+        port = free_port()
+        server = asyncio.ensure_future(serve(engine, '127.0.0.1', port))
+        reader, writer = await connect(port)
+        try:
+            tag, payload = await read_message(reader)
+            assert tag == b'INFO'
+            info = json.loads(payload.decode())
+            assert len(info['wavelengths']) == 256
+            tag, payload = await read_message(reader)
+            assert tag == b'FRAM'
+            header, spectrum = unpack_frame(payload)
+            assert header['seq'] >= 1 and len(spectrum) == 256
+            tag, reply = await asyncio.wait_for(command(reader, writer, {'cmd': 'dark', 'frames': 2}), 10)
+            assert tag == b'REPL' and reply == {'ok': True, 'reference': 'dark', 'frames': 2}
+            tag, reply = await asyncio.wait_for(command(reader, writer, {'cmd': 'mode', 'mode': 'bogus'}), 10)
+            assert tag == b'REPL' and not reply['ok']
+        finally:
+            writer.close()
+            server.cancel()
+
+    asyncio.run(session())
+
+
+def test_stopped_acquisition_fails_captures_and_closes_clients(engine):
+    async def session():
+        port = free_port()
+        server = asyncio.ensure_future(serve(engine, '127.0.0.1', port))
+        reader, writer = await connect(port)
+        tag, payload = await read_message(reader)
+        assert tag == b'INFO'
+        # a capture that cannot finish before the acquisition process goes away
+        writer.write(pack(b'CMND', json.dumps({'cmd': 'dark', 'frames': 100000}).encode()))
+        await asyncio.sleep(0.2)
+        engine.engines[0].process.terminate()
+        messages = []
+        while True:
+            try:
+                tag, payload = await asyncio.wait_for(read_message(reader), 10)
+            except asyncio.IncompleteReadError:
+                break
+            if tag != b'FRAM':
+                messages.append((tag, json.loads(payload.decode())))
+        writer.close()
+        assert messages[0][0] == b'REPL' and not messages[0][1]['ok']
+        assert messages[-1][0] == b'EROR'
+        assert await asyncio.wait_for(server, 10) == messages[-1][1]['error']
+
+    asyncio.run(session())
+
+
+def test_every_frame_reaches_a_fast_client(engine):
+    async def session():
+        port = free_port()
+        server = asyncio.ensure_future(serve(engine, '127.0.0.1', port))
+        reader, writer = await connect(port)
+        try:
+            tag, payload = await read_message(reader)
+            assert tag == b'INFO'
+            tag, reply = await asyncio.wait_for(command(reader, writer, {'cmd': 'config', 'int_time': 3}), 10)
+            assert reply['ok'] and reply['int_time'] == 3
+            seqs = []
+            while len(seqs) < 200:
+                tag, payload = await asyncio.wait_for(read_message(reader), 10)
+                if tag == b'FRAM':
+                    seqs.append(unpack_frame(payload)[0]['seq'])
+            assert seqs == list(range(seqs[0], seqs[0] + 200))  # several frames come in between polls of the server
+        finally:
+            writer.close()
+            server.cancel()
+
+    asyncio.run(session())
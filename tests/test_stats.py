@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from stats import BoxcarAverage, ExponentialAverage, WelfordStats
+
+
+FRAMES = np.random.default_rng(2).normal(1000.0, 5.0, size=(40, 16))
+
+
+def test_boxcar_matches_the_last_window_of_frames():
+    boxcar = BoxcarAverage(16, 10)
+    out = np.empty(16)
+    for n, frame in enumerate(FRAMES, 1):
+        boxcar.update(frame)
+        window = FRAMES[max(n - 10, 0):n]
+        assert np.allclose(boxcar.mean, window.mean(axis=0))
+        assert np.allclose(boxcar.std(out), window.std(axis=0), atol=1e-6)
+    assert boxcar.effective_frames == 10
+
+
+def test_welford_matches_numpy():
+    stats = WelfordStats(16)
+    out = np.empty(16)
+    assert not stats.std(out).any()
+    for frame in FRAMES:
+        stats.update(frame)
+    assert np.allclose(stats.mean, FRAMES.mean(axis=0))
+    assert np.allclose(stats.std(out), FRAMES.std(axis=0, ddof=1))
+
+
+def test_exponential_average():
+    average = ExponentialAverage.from_frames(16, 9)
+    assert average.alpha == pytest.approx(0.2)
+    average.update(np.zeros(16))
+    for k in range(60):
+        average.update(np.full(16, 10.0))
+    assert np.allclose(average.mean, 10.0, atol=1e-4)
+    assert average.effective_frames == pytest.approx(9.0)
+    constant = ExponentialAverage(16, 0.5)
+    for k in range(5):
+        constant.update(np.full(16, 3.0))
+    assert not constant.std(np.empty(16)).any()
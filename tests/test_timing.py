@@ -0,0 +1,14 @@
+import time
+
+from timing import StageTimer, DRAW, FRAME
+
+
+def test_laps_outside_a_frame_are_not_counted():
+    timing = StageTimer()
+    timing.start()
+    timing.lap(DRAW)
+    timing.end_frame()
+    time.sleep(0.05)
+    timing.lap(DRAW)  # e.g. BlitManager.update() after a settings change
+    assert sum(timing.counts[DRAW]) == 1 and timing.maxima[DRAW] < 0.05
+    assert sum(timing.counts[FRAME]) == 1